@@ -1,3 +1,18 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import CollectionVersion
+
+
+@admin.register(CollectionVersion)
+class CollectionVersionAdmin(admin.ModelAdmin):
+    """
+    Admin of the versions of the collections, read only: they are managed by the
+    indexing.
+    """
+
+    list_display = ("name", "category", "points_count", "created_at", "activated_at", "retired_at")
+    list_filter = ("category",)
+    readonly_fields = [field.name for field in CollectionVersion._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from ai.services.anonymize_service import Anonymizer
+from ai.services.model_registry import get_anonymizer
 
 
 class Command(BaseCommand):
@@ -14,6 +14,6 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         query = options["query"]
-        anonymized_query = Anonymizer().anonymize(query)
+        anonymized_query = get_anonymizer().anonymize(query)
 
         self.stdout.write(anonymized_query)
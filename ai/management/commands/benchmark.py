@@ -49,7 +49,10 @@ class Command(BaseCommand):
         for engine in engines:
             try:
                 res = search_documents(
-                    query, engine=engine, category_slug=category_slug
+                    query,
+                    engine=engine,
+                    category_slug=category_slug,
+                    use_corrections=False,
                 )
                 answer = res["result"]
                 results[engine] = answer
@@ -0,0 +1,140 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ai.services.anonymize_service import DEFAULT_NER_MODEL, Anonymizer
+
+DEFAULT_CORPUS = os.path.join(settings.BASE_DIR, "ai/data/ner_corpus.txt")
+QUANTIZATION_ARCHS = ("avx2", "avx512", "avx512_vnni", "arm64")
+
+
+def read_corpus(path):
+    """
+    Reads the validation queries, one per line, ignoring blank lines and comments.
+    """
+    with open(path, encoding="utf-8") as corpus:
+        return [
+            line.strip()
+            for line in corpus
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+
+
+def time_anonymizer(anonymizer, queries):
+    """
+    Anonymizes the queries one by one, as the search view does.
+
+    Returns:
+        tuple: The anonymized queries and the mean latency in milliseconds.
+    """
+    outputs = []
+    start = time.perf_counter()
+    for query in queries:
+        outputs.append(anonymizer.anonymize(query))
+    elapsed = time.perf_counter() - start
+    return outputs, elapsed * 1000 / max(len(queries), 1)
+
+
+class Command(BaseCommand):
+    """
+    This command exports the NER model used for anonymization to ONNX, quantizes
+    it to int8 and checks that the quantized model anonymizes a sample corpus
+    the same way as the fp32 model.
+    """
+
+    help = "Export the NER model to a quantized ONNX model and validate it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model", type=str, default=DEFAULT_NER_MODEL, help="The model to export"
+        )
+        parser.add_argument(
+            "--output",
+            type=str,
+            default=settings.ANONYMIZER_ONNX_MODEL_DIR,
+            help="The directory of the exported model",
+        )
+        parser.add_argument(
+            "--arch",
+            type=str,
+            choices=QUANTIZATION_ARCHS,
+            default="avx2",
+            help="The CPU instruction set targeted by the quantization",
+        )
+        parser.add_argument(
+            "--corpus",
+            type=str,
+            default=DEFAULT_CORPUS,
+            help="The queries used to compare the quantized and fp32 models",
+        )
+        parser.add_argument(
+            "--min-agreement",
+            type=float,
+            default=0.95,
+            help="The minimum share of queries anonymized identically",
+        )
+        parser.add_argument(
+            "--skip-export",
+            action="store_true",
+            help="Only validate an already exported model",
+        )
+
+    def handle(self, *args, **options):
+        output = options["output"]
+
+        if not options["skip_export"]:
+            self.export(options["model"], output, options["arch"])
+
+        queries = read_corpus(options["corpus"])
+        if not queries:
+            raise CommandError(f"No queries found in {options['corpus']}")
+
+        reference, reference_latency = time_anonymizer(
+            Anonymizer(model_name=options["model"]), queries
+        )
+        quantized, quantized_latency = time_anonymizer(
+            Anonymizer(model_name=options["model"], backend="onnx", model_path=output),
+            queries,
+        )
+
+        mismatches = [
+            (query, expected, actual)
+            for query, expected, actual in zip(queries, reference, quantized)
+            if expected != actual
+        ]
+        for query, expected, actual in mismatches:
+            self.stdout.write(f"- {query}\n  fp32: {expected}\n  int8: {actual}")
+
+        agreement = 1 - len(mismatches) / len(queries)
+        self.stdout.write(
+            f"Agreement: {agreement:.1%} on {len(queries)} queries, "
+            f"latency fp32 {reference_latency:.1f} ms, int8 {quantized_latency:.1f} ms"
+        )
+        if agreement < options["min_agreement"]:
+            raise CommandError(
+                f"The quantized model agrees on {agreement:.1%} of the queries, "
+                f"below the {options['min_agreement']:.1%} threshold"
+            )
+
+    def export(self, model_name, output, arch):
+        """
+        Exports the model to ONNX and writes its dynamically quantized int8
+        version, with the tokenizer, to the output directory.
+        """
+        # pylint: disable=import-outside-toplevel
+        from optimum.onnxruntime import ORTModelForTokenClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        self.stdout.write(f"Exporting {model_name} to {output}")
+        model = ORTModelForTokenClassification.from_pretrained(model_name, export=True)
+        model.save_pretrained(output)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(output)
+
+        quantization_config = getattr(AutoQuantizationConfig, arch)(
+            is_static=False, per_channel=False
+        )
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(save_dir=output, quantization_config=quantization_config)
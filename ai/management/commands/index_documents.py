@@ -15,7 +15,12 @@ class Command(BaseCommand):
         parser.add_argument(
             "--category_id", type=str, default=None, help="The category id"
         )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Rebuild the collections instead of indexing the changed documents",
+        )
 
     def handle(self, *args, **options):
         category_id = options["category_id"]
-        index_documents(category_id)
+        index_documents(category_id, rebuild=options["rebuild"])
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ai.services.model_registry import build_server_registry
+from ai.services.model_server import ModelServer
+
+
+class Command(BaseCommand):
+    """
+    This command runs the model server hosting the NLP models shared by the
+    web and Celery processes of the node.
+    """
+
+    help = "Run the model server on a Unix socket"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--socket",
+            type=str,
+            default=settings.MODEL_SERVER_SOCKET,
+            help="The path of the Unix socket (defaults to MODEL_SERVER_SOCKET)",
+        )
+        parser.add_argument(
+            "--lazy",
+            action="store_true",
+            help="Load the models on first request instead of at startup",
+        )
+
+    def handle(self, *args, **options):
+        socket_path = options["socket"]
+        if not socket_path:
+            raise CommandError("No socket path given and MODEL_SERVER_SOCKET is not set")
+
+        models = build_server_registry()
+        if not options["lazy"]:
+            models.warm_up()
+            for name, stats in models.memory_usage().items():
+                self.stdout.write(
+                    f"{name}: {stats['load_seconds']:.2f}s, "
+                    f"+{stats['rss_delta'] / (1024 * 1024):.1f} MB"
+                )
+
+        with ModelServer(socket_path, models) as server:
+            self.stdout.write(f"Serving {', '.join(models.names())} on {socket_path}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
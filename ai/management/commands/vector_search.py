@@ -1,8 +1,8 @@
 from django.core.management.base import BaseCommand
 
-from ai.services.anonymize_service import Anonymizer
+from ai.services.model_registry import get_anonymizer
 from documents.models import Category
-from ai.services.search_service import DocumentSearch
+from ai.services.search_service import get_document_search
 
 
 class Command(BaseCommand):
@@ -26,10 +26,10 @@ class Command(BaseCommand):
 
         self.stdout.write(f"Category slug: {category_slug}")
 
-        query = Anonymizer().anonymize(query)
+        query = get_anonymizer().anonymize(query)
         category = Category.objects.get(slug=category_slug)
 
-        document_search = DocumentSearch(category=category)
+        document_search = get_document_search(category)
         documents = document_search.get_relevant_documents(query)
         for doc in documents:
             self.stdout.write(doc.page_content)
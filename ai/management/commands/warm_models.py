@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ai.services.model_registry import registry
+
+
+class Command(BaseCommand):
+    """
+    This command loads the registered models of the current process and
+    reports the time and memory taken by each of them.
+    """
+
+    help = "Load the registered models and report their memory usage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "names",
+            nargs="*",
+            type=str,
+            help="The models to load (all registered models by default)",
+        )
+
+    def handle(self, *args, **options):
+        names = options["names"] or registry.names()
+        unknown = set(names) - set(registry.names())
+        if unknown:
+            raise CommandError(f"Unknown model(s): {', '.join(sorted(unknown))}")
+
+        registry.warm_up(names)
+
+        for name, stats in registry.memory_usage().items():
+            self.stdout.write(
+                f"{name}: {stats['load_seconds']:.2f}s, "
+                f"+{stats['rss_delta'] / (1024 * 1024):.1f} MB"
+            )
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collectionversion',
+            name='last_document_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
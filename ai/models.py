@@ -1,3 +1,61 @@
 from django.db import models
 
-# Create your models here.
+from documents.models import Category
+
+
+class CollectionVersion(models.Model):
+    """
+    This is the CollectionVersion model. It represents a version of the vector
+    database collection of a category. The active version is served through the
+    alias named after the slug of the category; the versions it replaced are
+    retired, then deleted after COLLECTION_RETENTION_SECONDS. A version is built
+    document by document, in the order of their ids, and its build resumes after
+    the last indexed document when it was interrupted.
+    """
+
+    category = models.ForeignKey(
+        Category, on_delete=models.CASCADE, related_name="collection_versions"
+    )
+    version = models.PositiveIntegerField()
+    name = models.CharField(max_length=255, unique=True)
+    points_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    activated_at = models.DateTimeField(null=True, blank=True)
+    retired_at = models.DateTimeField(null=True, blank=True)
+    # The build of an unactivated version resumes after this document
+    last_document_id = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    class Meta:
+        """
+        Meta class for the CollectionVersion model.
+        """
+
+        unique_together = (("category", "version"),)
+        ordering = ["category", "-version"]
+
+    def __str__(self):
+        return str(self.name)
+
+
+class ChunkEmbedding(models.Model):
+    """
+    This is the ChunkEmbedding model. It stores the embedding of a chunk, keyed
+    by the embedding model and the SHA-256 hash of the text of the chunk, so that
+    the indexing only embeds the chunks it never embedded before. The vector is
+    packed into float32 bytes.
+    """
+
+    model = models.CharField(max_length=255)
+    text_hash = models.CharField(max_length=64)
+    vector = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        """
+        Meta class for the ChunkEmbedding model.
+        """
+
+        unique_together = (("model", "text_hash"),)
+
+    def __str__(self):
+        return f"{self.model}:{self.text_hash}"
@@ -0,0 +1,137 @@
+"""
+This module provides the helpers of the async search pipeline: the bounded
+thread pools running the blocking steps, the coalescing of the streamed tokens,
+and the HTTP session shared by the async OpenAI calls of an event loop.
+"""
+import asyncio
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+_executors = {}
+_executors_lock = threading.Lock()
+# The sessions are bound to their event loop
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_executor(name, max_workers):
+    """
+    Returns the thread pool of the given name, created once per process.
+
+    Args:
+        name (str): The name of the pool, also used to name its threads.
+        max_workers (int): The maximum number of threads of the pool.
+
+    Returns:
+        ThreadPoolExecutor: The shared pool.
+    """
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+                _executors[name] = executor
+    return executor
+
+
+class TokenCoalescer:
+    """
+    This class gathers the streamed tokens and sends them as one text when the
+    oldest buffered token waited for the flush interval, or when the buffered
+    text reaches the maximum size. The texts are sent in order.
+    """
+
+    def __init__(self, send, interval, max_chars):
+        """
+        Args:
+            send (coroutine function): Sends a text.
+            interval (float): The maximum delay of a token, in seconds.
+            max_chars (int): The size of the text flushed without waiting.
+        """
+        self.send = send
+        self.interval = interval
+        self.max_chars = max_chars
+        self.buffer = []
+        self.size = 0
+        self.timer = None
+        self.lock = asyncio.Lock()
+
+    async def add(self, token):
+        """
+        This method buffers a token, flushing the buffer when it is full.
+        """
+        self.buffer.append(token)
+        self.size += len(token)
+        if self.size >= self.max_chars:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        """
+        This method flushes the buffer once the interval has elapsed.
+        """
+        await asyncio.sleep(self.interval)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        This method sends the buffered text, if any.
+        """
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+            self.timer = None
+        async with self.lock:
+            if not self.buffer:
+                return
+            text = "".join(self.buffer)
+            self.buffer = []
+            self.size = 0
+            await self.send(text)
+
+    def discard(self):
+        """
+        This method drops the buffered text, without sending it.
+        """
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+        self.timer = None
+        self.buffer = []
+        self.size = 0
+
+
+async def run_in_executor(executor, func, *args):
+    """
+    Runs a blocking function in the given thread pool (None for the default pool
+    of the event loop) and returns its result.
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def get_aiohttp_session():
+    """
+    Returns the aiohttp session of the running event loop, whose connections are
+    kept alive between the requests.
+    """
+    # pylint: disable=import-outside-toplevel
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession()
+        _sessions[loop] = session
+    return session
+
+
+def use_shared_openai_session():
+    """
+    Makes the async OpenAI calls of the current task (and of the tasks it creates)
+    reuse the aiohttp session of the event loop instead of opening a new
+    connection for each call.
+    """
+    openai.aiosession.set(get_aiohttp_session())
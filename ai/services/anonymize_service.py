@@ -1,44 +1,321 @@
+import logging
+import os
+import queue
 import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
 from transformers import AutoTokenizer, AutoModelForTokenClassification, pipeline
-from pybloom_live import BloomFilter
+
+logger = logging.getLogger("cassandre")
+
+DEFAULT_NER_MODEL = "Jean-Baptiste/camembert-ner-with-dates"
+ONNX_MODEL_FILE_NAME = "model_quantized.onnx"
+NER_BACKENDS = ("torch", "torch_int8", "onnx")
+
+PERSON_PLACEHOLDER = "Madame/Monsieur"
+EMAIL_PLACEHOLDER = "private@example.com"
+CONFIDENTIAL_PLACEHOLDER = "CONFIDENTIEL"
+
+EMAIL_PATTERN = re.compile(r"[\w\.-]+@[\w\.-]+")
+PHONE_NUMBER_PATTERN = re.compile(r"\b0\d(?:[\s.-]?\d{2}){4}\b")
+NUMEN_PATTERN = re.compile(r"\b\d{2}[A-Z]\d{7}[A-Z]{3}\b")
+INSEE_PATTERN = re.compile(r"\d{15}")
+
+# All the PII patterns in a single alternation. Emails come first so that an address
+# containing digits is redacted as a whole rather than as a phone or INSEE number.
+PII_PATTERN = re.compile(
+    "|".join(
+        f"(?P<{label}>{pattern.pattern})"
+        for label, pattern in (
+            ("email", EMAIL_PATTERN),
+            ("phone", PHONE_NUMBER_PATTERN),
+            ("numen", NUMEN_PATTERN),
+            ("insee", INSEE_PATTERN),
+        )
+    )
+)
+PII_PLACEHOLDERS = {
+    "email": EMAIL_PLACEHOLDER,
+    "phone": CONFIDENTIAL_PLACEHOLDER,
+    "numen": CONFIDENTIAL_PLACEHOLDER,
+    "insee": CONFIDENTIAL_PLACEHOLDER,
+}
+
+# A span of the original text to redact: [start, end) offsets, the kind of data
+# (entity group or PII pattern name), the redacted text and its placeholder.
+Redaction = namedtuple("Redaction", ["start", "end", "label", "text", "placeholder"])
+RedactionResult = namedtuple("RedactionResult", ["text", "redactions"])
+
+
+def find_pattern_spans(text):
+    """
+    Returns the spans of the email addresses, phone numbers, NUMEN numbers and
+    INSEE numbers found in the text.
+
+    Args:
+        text (str): The text to search.
+
+    Returns:
+        list: The Redaction candidates for the PII patterns.
+    """
+    return [
+        Redaction(
+            match.start(),
+            match.end(),
+            match.lastgroup,
+            match.group(),
+            PII_PLACEHOLDERS[match.lastgroup],
+        )
+        for match in PII_PATTERN.finditer(text)
+    ]
+
+
+def apply_redactions(text, candidates):
+    """
+    Resolves the overlaps between the redaction candidates and rebuilds the text
+    in a single pass. When candidates overlap, the one starting first wins, then
+    the longest one, then the one listed first.
+
+    Args:
+        text (str): The original text.
+        candidates (list): The Redaction candidates, with offsets in the text.
+
+    Returns:
+        RedactionResult: The anonymized text and the redactions applied to it.
+    """
+    redactions = []
+    covered_until = 0
+    for span in sorted(candidates, key=lambda span: (span.start, span.start - span.end)):
+        if span.start < covered_until:
+            continue
+        redactions.append(span)
+        covered_until = span.end
+
+    pieces = []
+    position = 0
+    for span in redactions:
+        pieces.append(text[position : span.start])
+        pieces.append(span.placeholder)
+        position = span.end
+    pieces.append(text[position:])
+
+    return RedactionResult("".join(pieces), redactions)
+
+
+def find_entity_spans(text, entities):
+    """
+    Returns the spans of every occurrence of the person names recognized in the
+    text. Only the names of the text itself are redacted: the entities of the
+    other groups (places, organizations, dates...) are kept.
+
+    Args:
+        text (str): The text the entities were recognized in.
+        entities (list): The recognized entities from the text.
+
+    Returns:
+        list: The Redaction candidates for the names.
+    """
+    names = {entity["word"] for entity in entities if entity["entity_group"] == "PER"}
+    spans = []
+    for word in names:
+        if not word:
+            continue
+        start = text.find(word)
+        while start != -1:
+            end = start + len(word)
+            spans.append(Redaction(start, end, "PER", word, PERSON_PLACEHOLDER))
+            start = text.find(word, end)
+    return spans
+
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+# Words that are capitalised at the start of a sentence without being names
+COMMON_WORDS = frozenset(
+    """
+    a à après au aucun aussi aux avant avec bonjour bonsoir c ça ce cela celle celui
+    ces cet cette chaque combien comment concernant d dans de depuis des doit doivent
+    du elle elles en est et existe faut hello il ils j je l la le les leur lors
+    ma mais me merci mes moi mon n ne nous on ou où par peut peuvent pour pourquoi
+    pouvez puis qu quand que quel quelle quelles quels qui s sa sans se ses si t
+    sont suis sur svp ta toi ton tous tout toute toutes tu un une vos votre vous y
+    """.split()
+)
+
+# Words announcing a person name even when it is not capitalised
+NAME_CUES = frozenset(
+    "appelle appelais madame mademoiselle mlle mme monsieur mr nom prénom signé".split()
+)
+
+STATS_LOG_INTERVAL = 1000
+
+
+class NamePrescreen:
+    """
+    This class is a cheap heuristic deciding whether a text may contain a person
+    name, so that the NER model is only run when it can find something. A text is
+    a candidate when it contains a known first name, a word announcing a name, or
+    a capitalised word that is neither a common sentence starter nor an acronym.
+    It never affects the redaction of emails, phone, NUMEN and INSEE numbers.
+    It keeps counters of the texts checked and skipped.
+    """
+
+    def __init__(self, first_names=(), common_words=COMMON_WORDS):
+        self.first_names = frozenset(name.lower() for name in first_names)
+        self.common_words = frozenset(word.lower() for word in common_words)
+        self.checked = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        Builds a pre-screen from a file of first names, one per line. Empty lines
+        and lines starting with "#" are ignored.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            NamePrescreen: The pre-screen.
+        """
+        with open(path, encoding="utf-8") as names_file:
+            first_names = [
+                line.strip()
+                for line in names_file
+                if line.strip() and not line.startswith("#")
+            ]
+        return cls(first_names, **kwargs)
+
+    def has_candidates(self, text):
+        """
+        Returns True if the text may contain a person name and must go through NER.
+
+        Args:
+            text (str): The text to check.
+
+        Returns:
+            bool: False only if the text clearly contains no person name.
+        """
+        result = self._has_candidates(text)
+        with self._lock:
+            self.checked += 1
+            if not result:
+                self.skipped += 1
+            if self.checked % STATS_LOG_INTERVAL == 0:
+                logger.info(
+                    "NER pre-screen skipped %d/%d texts (%.1f%%)",
+                    self.skipped,
+                    self.checked,
+                    100 * self.skipped / self.checked,
+                )
+        return result
+
+    def _has_candidates(self, text):
+        for word in WORD_PATTERN.findall(text):
+            lowered = word.lower()
+            if lowered in self.first_names or lowered in NAME_CUES:
+                return True
+            if not word[0].isupper() or lowered in self.common_words:
+                continue
+            if word.isupper() and len(word) <= 5:
+                # Acronyms such as NUMEN, INSEE or SFT
+                continue
+            return True
+        return False
+
+    def stats(self):
+        """
+        Returns the counters of the pre-screen.
+
+        Returns:
+            dict: The number of texts checked and skipped, and the skip rate.
+        """
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "skipped": self.skipped,
+                "skip_rate": self.skipped / self.checked if self.checked else 0.0,
+            }
+
+
+def load_ner_model(model_name, backend="torch", model_path=None):
+    """
+    Loads the tokenizer and the token classification model for the given backend.
+
+    Args:
+        model_name (str): The name of the Hugging Face model.
+        backend (str, optional): "torch" for the fp32 PyTorch model, "torch_int8" for
+            the PyTorch model with dynamic int8 quantization of its linear layers,
+            "onnx" for an int8 ONNX Runtime export (see the export_ner_model command).
+            Defaults to "torch".
+        model_path (str, optional): The directory of the ONNX export.
+            Required for the "onnx" backend.
+
+    Returns:
+        tuple: The tokenizer and the model.
+    """
+    # pylint: disable=import-outside-toplevel
+    if backend not in NER_BACKENDS:
+        raise ValueError(f"Unknown NER backend: {backend}")
+
+    if backend == "onnx":
+        if not model_path:
+            raise ValueError("The onnx backend requires the path of the exported model")
+
+        from optimum.onnxruntime import ORTModelForTokenClassification
+
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = ORTModelForTokenClassification.from_pretrained(
+            model_path, file_name=ONNX_MODEL_FILE_NAME
+        )
+        return tokenizer, model
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForTokenClassification.from_pretrained(model_name)
+    if backend == "torch_int8":
+        import torch
+
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return tokenizer, model
 
 
 class Anonymizer:
     """
-    This class is used to anonymize sensitive information in a text. It uses a Bloom Filter
-    to store the named entities found in the text and replaces them with a generic placeholder.
+    This class is used to anonymize sensitive information in a text. It replaces the person
+    names found in the text by its NER model with a generic placeholder.
     It also anonymizes email addresses, phone numbers, NUMEN numbers, and INSEE numbers by replacing
     them with a placeholder.
+
+    An instance is meant to be shared by all the threads of a process (see
+    ai.services.model_registry): the NER pipeline is guarded by a lock.
     """
 
     def __init__(
         self,
-        model_name="Jean-Baptiste/camembert-ner-with-dates",
-        capacity=1000000,
-        error_rate=0.1,
+        model_name=DEFAULT_NER_MODEL,
+        batch_size=16,
+        prescreen=None,
+        backend="torch",
+        model_path=None,
     ):
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForTokenClassification.from_pretrained(model_name)
+        self.tokenizer, self.model = load_ner_model(model_name, backend, model_path)
         self.nlp = pipeline(
             "ner",
             model=self.model,
             tokenizer=self.tokenizer,
             aggregation_strategy="simple",
         )
-        self.filter = BloomFilter(capacity=capacity, error_rate=error_rate)
+        self.batch_size = batch_size
+        self.prescreen = prescreen
+        self._lock = threading.Lock()
 
-    def add_to_filter(self, entities):
-        """
-        This method adds the named entities found in the entities list to the Bloom Filter.
-
-        Args:
-            entities (list): The recognized entities from the text.
-        """
-        for entity in entities:
-            if entity["entity_group"] == "PER":  # Adjust this label if necessary
-                self.filter.add(entity["word"])
-
-    def anonymize_email(self, text, placeholder="private@example.com"):
+    def anonymize_email(self, text, placeholder=EMAIL_PLACEHOLDER):
         """
         This method anonymizes the email addresses found in the text by replacing them
         with a placeholder.
@@ -51,11 +328,9 @@ class Anonymizer:
         Returns:
             str: The anonymized text.
         """
-        email_pattern = r"[\w\.-]+@[\w\.-]+"
-        anonymized_text = re.sub(email_pattern, placeholder, text)
-        return anonymized_text
+        return EMAIL_PATTERN.sub(placeholder, text)
 
-    def anonymize_phone_numbers(self, text, placeholder="CONFIDENTIEL"):
+    def anonymize_phone_numbers(self, text, placeholder=CONFIDENTIAL_PLACEHOLDER):
         """
         This method anonymizes the phone numbers found in the text by replacing them
         with a placeholder.
@@ -68,11 +343,9 @@ class Anonymizer:
         Returns:
             str: The anonymized text.
         """
-        phone_number_pattern = r"\b0\d(?:[\s.-]?\d{2}){4}\b"
-        anonymized_text = re.sub(phone_number_pattern, placeholder, text)
-        return anonymized_text
+        return PHONE_NUMBER_PATTERN.sub(placeholder, text)
 
-    def anonymize_numen(self, text, placeholder="CONFIDENTIEL"):
+    def anonymize_numen(self, text, placeholder=CONFIDENTIAL_PLACEHOLDER):
         """
         This method anonymizes the NUMEN (numero d'identification de l'education nationale)
         found in the text by replacing them with a placeholder.
@@ -85,11 +358,9 @@ class Anonymizer:
         Returns:
             str: The anonymized text.
         """
-        numen_pattern = r"\b\d{2}[A-Z]\d{7}[A-Z]{3}\b"
-        anonymized_text = re.sub(numen_pattern, placeholder, text)
-        return anonymized_text
+        return NUMEN_PATTERN.sub(placeholder, text)
 
-    def anonymize_insee(self, text, placeholder="CONFIDENTIEL"):
+    def anonymize_insee(self, text, placeholder=CONFIDENTIAL_PLACEHOLDER):
         """
         This method anonymizes the INSEE
         (Institut national de la statistique et des études économiques)
@@ -103,9 +374,7 @@ class Anonymizer:
         Returns:
             str: The anonymized text.
         """
-        insee_pattern = r"(\d{15})"
-        anonymized_text = re.sub(insee_pattern, placeholder, text)
-        return anonymized_text
+        return INSEE_PATTERN.sub(placeholder, text)
 
     def anonymize(self, text):
         """
@@ -118,26 +387,167 @@ class Anonymizer:
         Returns:
             str: The anonymized text.
         """
-        anonymized_text = text
+        return self.redact(text).text
+
+    def anonymize_many(self, texts, batch_size=None):
+        """
+        This method anonymizes several texts, sending them through the NER pipeline
+        in batches. The result for each text is the same as calling anonymize on it,
+        the texts being processed in order.
 
-        entities = self.nlp(anonymized_text)
-        self.add_to_filter(entities)
+        Args:
+            texts (list): The texts to anonymize.
+            batch_size (int, optional): The number of texts per forward pass.
+                Defaults to the batch size of the anonymizer.
 
-        for entity in entities:
-            if entity["word"] in self.filter:
-                anonymized_text = anonymized_text.replace(
-                    entity["word"], "Madame/Monsieur"
+        Returns:
+            list: The anonymized texts, in the same order.
+        """
+        return [result.text for result in self.redact_many(texts, batch_size)]
+
+    def redact(self, text):
+        """
+        This method anonymizes the text and reports what has been redacted.
+
+        Args:
+            text (str): The text to anonymize.
+
+        Returns:
+            RedactionResult: The anonymized text and its redactions.
+        """
+        return self.redact_many([text])[0]
+
+    def redact_many(self, texts, batch_size=None):
+        """
+        This method anonymizes several texts and reports what has been redacted
+        in each of them. The named entities and the PII patterns are collected as
+        spans of the original text, then every text is rebuilt in a single pass.
+
+        Args:
+            texts (list): The texts to anonymize.
+            batch_size (int, optional): The number of texts per forward pass.
+                Defaults to the batch size of the anonymizer.
+
+        Returns:
+            list: A RedactionResult per text, in the same order.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+
+        # Only the texts that may contain a person name go through the NER model
+        ner_indexes = [
+            index
+            for index, text in enumerate(texts)
+            if self.prescreen is None or self.prescreen.has_candidates(text)
+        ]
+        entity_spans = [[] for _ in texts]
+        if ner_indexes:
+            with self._lock:
+                batch_entities = self.nlp(
+                    [texts[index] for index in ner_indexes],
+                    batch_size=batch_size or self.batch_size,
                 )
+                for index, entities in zip(ner_indexes, batch_entities):
+                    entity_spans[index] = find_entity_spans(texts[index], entities)
+
+        return [
+            apply_redactions(text, find_pattern_spans(text) + spans)
+            for text, spans in zip(texts, entity_spans)
+        ]
+
+
+class MicroBatcher:
+    """
+    This class gathers the anonymize calls made concurrently by several threads
+    during a few milliseconds and runs them as a single batch through
+    Anonymizer.redact_many. It exposes the same anonymize/redact interface
+    as the Anonymizer it wraps.
+    """
+
+    def __init__(self, anonymizer, max_batch_size=16, max_wait_ms=5):
+        self.anonymizer = anonymizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # The worker thread does not survive a fork, so it is (re)started
+        # lazily from the process that uses it.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            worker = threading.Thread(
+                target=self._run, args=(self._queue,), name="anonymizer-batcher"
+            )
+            worker.daemon = True
+            worker.start()
+            self._pid = os.getpid()
+
+    def anonymize(self, text):
+        """
+        Anonymizes the text as part of the next micro-batch.
+
+        Args:
+            text (str): The text to anonymize.
+
+        Returns:
+            str: The anonymized text.
+        """
+        return self.redact(text).text
+
+    def redact(self, text):
+        """
+        Anonymizes the text as part of the next micro-batch and reports what
+        has been redacted.
+
+        Args:
+            text (str): The text to anonymize.
 
-        # Anonymize phone numbers
-        anonymized_text = self.anonymize_phone_numbers(anonymized_text)
+        Returns:
+            RedactionResult: The anonymized text and its redactions.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def anonymize_many(self, texts, batch_size=None):
+        """
+        Anonymizes several texts directly, they already form a batch.
+        """
+        return self.anonymizer.anonymize_many(texts, batch_size=batch_size)
+
+    def redact_many(self, texts, batch_size=None):
+        """
+        Redacts several texts directly, they already form a batch.
+        """
+        return self.anonymizer.redact_many(texts, batch_size=batch_size)
 
-        # Anonymize NUMEN numbers
-        anonymized_text = self.anonymize_numen(anonymized_text)
+    def _run(self, pending):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
 
-        # Anonymize INSEE numbers
-        anonymized_text = self.anonymize_insee(anonymized_text)
+            try:
+                results = self.anonymizer.redact_many([text for text, _ in batch])
+            except Exception as err:  # pylint: disable=broad-except
+                for _, future in batch:
+                    future.set_exception(err)
+                continue
 
-        # Anonymize email addresses
-        anonymized_text = self.anonymize_email(anonymized_text)
-        return anonymized_text
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,102 @@
+"""
+This module provides the token budgeting of the prompts: the token counts of
+the chunks (computed once at index time and stored in their payload) and the
+packing of the retrieved chunks into the budget left by the prompt in the
+context window of the engine.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+
+from .model_registry import get_token_encoding
+
+# Tokens of the separators and of the source line added to each chunk
+CHUNK_OVERHEAD_TOKENS = 16
+
+PackedContext = namedtuple(
+    "PackedContext", ["documents", "prompt_tokens", "context_tokens", "dropped"]
+)
+
+
+def count_tokens(text):
+    """
+    Returns the number of tokens of the text.
+    """
+    return len(get_token_encoding().encode(text))
+
+
+def add_token_counts(documents):
+    """
+    Stores the number of tokens of each chunk in its metadata, so that it is
+    saved in the payload of the vector database.
+
+    Args:
+        documents (list): The chunks to index.
+    """
+    for doc in documents:
+        # Chunks of the same page may share their metadata dictionary
+        doc.metadata = {**doc.metadata, "token_count": count_tokens(doc.page_content)}
+
+
+def get_document_tokens(doc):
+    """
+    Returns the number of tokens of a retrieved chunk, counting it only when
+    it was indexed without its token count.
+    """
+    token_count = doc.metadata.get("token_count")
+    if token_count is None:
+        token_count = count_tokens(doc.page_content)
+    return token_count + CHUNK_OVERHEAD_TOKENS
+
+
+def pack_documents(documents, budget):
+    """
+    Selects the chunks fitting in the token budget, greedily by decreasing score.
+    A chunk too large for the remaining budget is dropped and the following
+    (smaller) ones are still considered.
+
+    Args:
+        documents (list): The retrieved chunks, with their "score" in metadata.
+        budget (int): The number of tokens available for the context.
+
+    Returns:
+        tuple: The selected chunks, in decreasing score order, the number of tokens
+        they use and the number of dropped chunks.
+    """
+    ranked = sorted(documents, key=lambda doc: doc.metadata.get("score", 0), reverse=True)
+    selected = []
+    used = 0
+    for doc in ranked:
+        tokens = get_document_tokens(doc)
+        if used + tokens > budget:
+            continue
+        selected.append(doc)
+        used += tokens
+    return selected, used, len(documents) - len(selected)
+
+
+def pack_context(context_window, prompt, query, documents):
+    """
+    Fits the retrieved chunks into the context window of an engine, keeping
+    CONTEXT_ANSWER_TOKENS for the answer and at most CONTEXT_MAX_TOKENS of context.
+
+    Only the prompt and the query are tokenized here, the chunks use the token
+    counts stored at index time.
+
+    Args:
+        context_window (int): The context window of the engine, in tokens.
+        prompt (str): The prompt template, with its {context} and {question} variables.
+        query (str): The search query.
+        documents (list): The retrieved chunks.
+
+    Returns:
+        PackedContext: The selected chunks, the tokens of the prompt without its
+        context, the tokens of the context and the number of dropped chunks.
+    """
+    prompt_tokens = count_tokens(prompt) + count_tokens(query)
+    budget = context_window - prompt_tokens - settings.CONTEXT_ANSWER_TOKENS
+    if settings.CONTEXT_MAX_TOKENS:
+        budget = min(budget, settings.CONTEXT_MAX_TOKENS)
+
+    selected, used, dropped = pack_documents(documents, max(budget, 0))
+    return PackedContext(selected, prompt_tokens, used, dropped)
@@ -0,0 +1,133 @@
+"""
+This module provides the lookup of the manual corrections matching a query,
+used to answer the questions already corrected without searching the
+documents nor calling the LLM.
+"""
+import re
+import threading
+import time
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from documents.models import Correction
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+CorrectionMatch = namedtuple("CorrectionMatch", ["id", "answer"])
+
+_corrections = {}
+_corrections_lock = threading.Lock()
+
+
+def normalize_query(query):
+    """
+    Normalizes a query for the comparison with the corrected queries: lowercase,
+    punctuation removed and whitespace collapsed.
+
+    Args:
+        query (str): The query.
+
+    Returns:
+        str: The normalized query.
+    """
+    query = PUNCTUATION_PATTERN.sub(" ", query.lower())
+    return WHITESPACE_PATTERN.sub(" ", query).strip()
+
+
+def get_corrections(category_id):
+    """
+    Returns the corrections of a category indexed by normalized query. The map
+    is kept in memory for CORRECTION_CACHE_TTL seconds.
+
+    Args:
+        category_id (int): The id of the category.
+
+    Returns:
+        dict: The CorrectionMatch of each normalized query.
+    """
+    now = time.monotonic()
+    entry = _corrections.get(category_id)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    corrections = {}
+    # Ordered by id so that the most recent correction wins on a collision
+    for correction_id, query, answer in (
+        Correction.objects.filter(category_id=category_id)
+        .order_by("id")
+        .values_list("id", "query", "answer")
+    ):
+        corrections[normalize_query(query)] = CorrectionMatch(correction_id, answer)
+
+    with _corrections_lock:
+        _corrections[category_id] = (now + settings.CORRECTION_CACHE_TTL, corrections)
+    return corrections
+
+
+def clear_corrections(category_id=None):
+    """
+    Drops the cached corrections of the given category, or of all categories.
+    """
+    with _corrections_lock:
+        if category_id is None:
+            _corrections.clear()
+        else:
+            _corrections.pop(category_id, None)
+
+
+@receiver(post_save, sender=Correction)
+@receiver(post_delete, sender=Correction)
+def invalidate_corrections(sender, instance, **kwargs):
+    """
+    Drops the cached corrections of a category when one of them changes.
+    """
+    clear_corrections(instance.category_id)
+
+
+def find_correction(category, query):
+    """
+    Returns the correction of the category matching the query, if any.
+
+    The query is first looked up in the in-memory map of the normalized
+    corrected queries, then by hash in the database, which catches the
+    corrections saved by other processes since the map was loaded.
+
+    Args:
+        category (Category): The category of the search.
+        query (str): The query, as typed by the user.
+
+    Returns:
+        CorrectionMatch: The id and answer of the correction, or None.
+    """
+    match = get_corrections(category.id).get(normalize_query(query))
+    if match is not None:
+        return match
+
+    correction = (
+        Correction.objects.filter(category=category, query_hash=Correction.hash_query(query))
+        .values_list("id", "answer")
+        .first()
+    )
+    return CorrectionMatch(*correction) if correction is not None else None
+
+
+async def afind_correction(category, query):
+    """
+    Async version of find_correction, for the async search pipeline.
+    """
+    corrections = await sync_to_async(get_corrections)(category.id)
+    match = corrections.get(normalize_query(query))
+    if match is not None:
+        return match
+
+    correction = await (
+        Correction.objects.filter(category=category, query_hash=Correction.hash_query(query))
+        .values_list("id", "answer")
+        .afirst()
+    )
+    return CorrectionMatch(*correction) if correction is not None else None
@@ -1,9 +1,10 @@
 """
 This module provides functions for working with language embeddings.
 """
+from django.conf import settings
 from langchain.embeddings import OpenAIEmbeddings
 
-# from langchain.embeddings import SentenceTransformerEmbeddings
+from .model_registry import get_local_embeddings
 
 
 def get_embedding():
@@ -11,10 +12,12 @@ def get_embedding():
     Return an embedding model.
 
     Returns:
-        OpenAIEmbeddings: An instance of the OpenAIEmbeddings class.
+        Embeddings: An instance of the OpenAIEmbeddings class, or the shared local
+        model when the LOCAL_EMBEDDING_MODEL setting is set
+        (e.g. "BAAI/bge-small-en").
     """
-    # return SentenceTransformerEmbeddings(model_name="hkunlp/instructor-xl")
-    # return SentenceTransformerEmbeddings(model_name="BAAI/bge-small-en")
+    if settings.LOCAL_EMBEDDING_MODEL:
+        return get_local_embeddings()
     return OpenAIEmbeddings()
 
 
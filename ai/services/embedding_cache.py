@@ -0,0 +1,321 @@
+"""
+This module provides a two-tier cache for query embeddings: an in-process LRU
+in front of the "shared" Django cache (Redis in production), so that repeated
+questions do not call the embedding API again.
+
+The embeddings of the indexed chunks are stored in the database instead, see
+embed_documents: they are kept as long as their chunks may be indexed again.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from langchain.embeddings.base import Embeddings
+
+from ai.models import ChunkEmbedding
+
+from .embedding import get_embedding
+
+logger = logging.getLogger("cassandre")
+
+STATS_LOG_INTERVAL = 1000
+
+
+def get_model_id(embeddings):
+    """
+    Returns an identifier of the model behind the embeddings, used to keep the
+    vectors of different models apart in the cache.
+    """
+    model = getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+    return f"{type(embeddings).__name__}:{model}"
+
+
+def get_store_model_id(embeddings):
+    """
+    Returns the identifier of the model of the stored chunk embeddings: the local
+    model is the same whether it is loaded in the process or by the model server.
+    """
+    if settings.LOCAL_EMBEDDING_MODEL:
+        return f"local:{settings.LOCAL_EMBEDDING_MODEL}"
+    return get_model_id(embeddings)
+
+
+def hash_text(text):
+    """
+    Returns the SHA-256 hash of the text of a chunk.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def encode_vector(vector):
+    """
+    Packs an embedding into float32 bytes.
+    """
+    return array("f", vector).tobytes()
+
+
+def decode_vector(data):
+    """
+    Unpacks an embedding packed by encode_vector.
+    """
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    This class caches the query embeddings of another Embeddings instance.
+    Vectors are looked up in a local LRU, then in the shared cache, and only
+    computed on a miss of both. Document embeddings are not cached.
+    """
+
+    def __init__(self, embeddings, cache_alias="shared", max_size=1024, ttl=None):
+        self.embeddings = embeddings
+        self.model_id = get_model_id(embeddings)
+        self.cache_alias = cache_alias
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+
+    def cache_key(self, text):
+        """
+        Returns the cache key of a query: the model id and a digest of the query
+        with its whitespace normalized.
+
+        Args:
+            text (str): The query, as passed to embed_query.
+
+        Returns:
+            str: The cache key.
+        """
+        normalized = re.sub(r"\s+", " ", text).strip()
+        digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        return f"embedding:{self.model_id}:{digest}"
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = self.cache_key(text)
+
+        vector = self._lookup_local(key)
+        if vector is not None:
+            return vector
+
+        vector = self._lookup_shared(key, self._get_shared(key))
+        if vector is not None:
+            return vector
+
+        self._record("misses")
+        data = encode_vector(self.embeddings.embed_query(text))
+        self._set_shared(key, data)
+        return self._store_local(key, data)
+
+    async def aembed_query(self, text):
+        key = self.cache_key(text)
+
+        vector = self._lookup_local(key)
+        if vector is not None:
+            return vector
+
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self._get_shared, key)
+        vector = self._lookup_shared(key, data)
+        if vector is not None:
+            return vector
+
+        self._record("misses")
+        data = encode_vector(await self.embeddings.aembed_query(text))
+        await loop.run_in_executor(None, self._set_shared, key, data)
+        return self._store_local(key, data)
+
+    def _lookup_local(self, key):
+        vector = self._get_local(key)
+        if vector is not None:
+            self._record("local_hits")
+        return vector
+
+    def _lookup_shared(self, key, data):
+        if data is None:
+            return None
+        self._record("shared_hits")
+        return self._store_local(key, data)
+
+    def _store_local(self, key, data):
+        # Keep the float32 values so that a hit returns the same vector as a miss
+        vector = decode_vector(data)
+        self._set_local(key, vector)
+        return vector
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expires_at, vector = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return vector
+
+    def _set_local(self, key, vector):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._local[key] = (expires_at, vector)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _get_shared(self, key):
+        try:
+            return caches[self.cache_alias].get(key)
+        except Exception:  # pylint: disable=broad-except
+            logger.warning("Embedding cache unavailable", exc_info=True)
+            return None
+
+    def _set_shared(self, key, data):
+        try:
+            caches[self.cache_alias].set(key, data, timeout=self.ttl)
+        except Exception:  # pylint: disable=broad-except
+            logger.warning("Embedding cache unavailable", exc_info=True)
+
+    def _record(self, outcome):
+        with self._lock:
+            self._stats[outcome] += 1
+            total = sum(self._stats.values())
+        if total % STATS_LOG_INTERVAL == 0:
+            logger.info("Query embedding cache: %s", self.stats())
+
+    def stats(self):
+        """
+        Returns the hit and miss counters of the cache.
+
+        Returns:
+            dict: The local hits, shared hits, misses and the overall hit rate.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        total = sum(stats.values())
+        hits = stats["local_hits"] + stats["shared_hits"]
+        stats["hit_rate"] = hits / total if total else 0.0
+        return stats
+
+
+_query_embedding = None
+_query_embedding_lock = threading.Lock()
+
+
+def get_query_embedding():
+    """
+    Returns the process-wide cached embeddings used to embed search queries.
+    """
+    global _query_embedding  # pylint: disable=global-statement
+    with _query_embedding_lock:
+        if _query_embedding is None:
+            _query_embedding = CachedEmbeddings(
+                get_embedding(),
+                max_size=settings.EMBEDDING_CACHE_SIZE,
+                ttl=settings.EMBEDDING_CACHE_TTL,
+            )
+    return _query_embedding
+
+
+def get_stored_embeddings(texts, embeddings=None):
+    """
+    Returns the stored embeddings of the texts of chunks, see embed_missing.
+
+    Args:
+        texts (List[str]): The texts of the chunks.
+        embeddings (Embeddings, optional): The embedding model, see get_embedding.
+
+    Returns:
+        dict: The packed vectors of the stored texts, by hash of their text (empty
+        when CHUNK_EMBEDDING_STORE is off).
+    """
+    if not settings.CHUNK_EMBEDDING_STORE:
+        return {}
+    model_id = get_store_model_id(embeddings or get_embedding())
+    stored = ChunkEmbedding.objects.filter(
+        model=model_id, text_hash__in={hash_text(text) for text in texts}
+    )
+    return {
+        text_hash: bytes(data) for text_hash, data in stored.values_list("text_hash", "vector")
+    }
+
+
+def embed_missing(texts, stored, embeddings=None):
+    """
+    Embeds the texts of chunks whose embeddings are not stored, in one batch,
+    without querying the database: it runs in the threads of the indexing.
+
+    Args:
+        texts (List[str]): The texts of the chunks.
+        stored (dict): Their stored embeddings, see get_stored_embeddings.
+        embeddings (Embeddings, optional): The embedding model, see get_embedding.
+
+    Returns:
+        tuple: The embeddings of the texts, in their order, and the new
+        ChunkEmbedding instances to save with store_embeddings.
+    """
+    embeddings = embeddings or get_embedding()
+    if not settings.CHUNK_EMBEDDING_STORE:
+        return embeddings.embed_documents(texts), []
+
+    model_id = get_store_model_id(embeddings)
+    hashes = [hash_text(text) for text in texts]
+    vectors = dict(stored)
+    # The identical chunks are embedded once
+    missing = {
+        text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in vectors
+    }
+    new_embeddings = []
+    if missing:
+        new_vectors = embeddings.embed_documents(list(missing.values()))
+        new_embeddings = [
+            ChunkEmbedding(model=model_id, text_hash=text_hash, vector=encode_vector(vector))
+            for text_hash, vector in zip(missing, new_vectors)
+        ]
+        vectors.update((embedding.text_hash, embedding.vector) for embedding in new_embeddings)
+
+    logger.info("Embedded %s chunk(s), %s stored", len(missing), len(texts) - len(missing))
+    # Keep the float32 values so that a stored vector is the same as a new one
+    return [decode_vector(vectors[text_hash]) for text_hash in hashes], new_embeddings
+
+
+def store_embeddings(new_embeddings):
+    """
+    Saves the new chunk embeddings returned by embed_missing.
+    """
+    if new_embeddings:
+        ChunkEmbedding.objects.bulk_create(new_embeddings, ignore_conflicts=True)
+
+
+def embed_documents(texts, embeddings=None):
+    """
+    Embeds the texts of chunks, looking them up in the stored chunk embeddings
+    first: only the texts never embedded with the model are sent to it, in one
+    batch, and their embeddings are stored.
+
+    Args:
+        texts (List[str]): The texts of the chunks.
+        embeddings (Embeddings, optional): The embedding model, see get_embedding.
+
+    Returns:
+        List[List[float]]: The embeddings of the texts, in their order.
+    """
+    embeddings = embeddings or get_embedding()
+    stored = get_stored_embeddings(texts, embeddings)
+    vectors, new_embeddings = embed_missing(texts, stored, embeddings)
+    store_embeddings(new_embeddings)
+    return vectors
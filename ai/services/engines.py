@@ -0,0 +1,460 @@
+# pylint: disable=no-name-in-module
+# pylint: disable=no-self-argument
+# pylint: disable=unused-argument
+"""
+This module provides the engines answering the queries from the retrieved
+documents, and the registry building each of them once per process.
+
+An engine holds its long-lived client (LangChain LLM, HTTP session with
+keep-alive connections, remote model...) and declares its capabilities:
+streaming of the answer, context window and tokenizer used to budget the prompt.
+The callbacks are given on each query, so that a client is shared by all the
+requests of the process.
+"""
+import locale
+import os
+import re
+import threading
+from datetime import datetime
+from functools import partial
+from typing import List
+
+import requests
+from django.conf import settings
+from langchain.chains import RetrievalQA
+from langchain.prompts import PromptTemplate
+from langchain.schema import BaseRetriever, Document
+from pydantic import BaseModel
+
+from .aio import get_executor, run_in_executor
+from .model_registry import ModelRegistry
+
+DEFAULT_ENGINE = "gpt-3.5-turbo"
+DEFAULT_CONTEXT_WINDOW = 4096
+TEXT_SYNTH_URL = "https://api.textsynth.com/v1/engines/{}/chat"
+REQUEST_TIMEOUT = 300
+
+
+class DocsRetriever(BaseRetriever, BaseModel):
+    """Simple BaseRetriever for qa chain"""
+
+    documents: List[Document]
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return self.documents
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        return self.documents
+
+
+def format_content(content):
+    lines = content.split("\n")
+    if lines:
+        lines[0] = f"### {lines[0]}"
+    return "\n".join(lines)
+
+
+def build_chain(llm, prompt_template, documents):
+    """
+    Builds a "stuff" RetrievalQA chain answering from the documents.
+    """
+    question_answer = RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type="stuff",
+        retriever=DocsRetriever(documents=documents),
+    )
+    question_answer.combine_documents_chain.llm_chain.prompt = prompt_template
+    return question_answer
+
+
+def answer_with_chain(llm, prompt_template, query, documents, callback=None):
+    """
+    Answers the query with a "stuff" RetrievalQA chain over the documents.
+
+    Args:
+        llm (BaseLanguageModel): The shared LLM.
+        prompt_template (PromptTemplate): The prompt, with its context and question variables.
+        query (str): The search query.
+        documents (list): The documents of the context.
+        callback (BaseCallbackHandler, optional): Receives the events of this query only.
+
+    Returns:
+        dict: The outputs of the chain.
+    """
+    question_answer = build_chain(llm, prompt_template, documents)
+    callbacks = [callback] if callback is not None else None
+    return question_answer({"query": query}, callbacks=callbacks, return_only_outputs=True)
+
+
+async def aanswer_with_chain(llm, prompt_template, query, documents, callback=None):
+    """
+    Async version of answer_with_chain, calling the LLM without blocking the event loop.
+    """
+    question_answer = build_chain(llm, prompt_template, documents)
+    callbacks = [callback] if callback is not None else None
+    return await question_answer.acall(
+        {"query": query}, callbacks=callbacks, return_only_outputs=True
+    )
+
+
+class Engine:
+    """
+    This class is the base of the engines.
+
+    Attributes:
+        name (str): The name of the engine, as selected in the forms.
+        streaming (bool): True if the answer is streamed token by token to the callback.
+        context_window (int): The number of tokens of the prompt and the answer.
+        tokenizer (str): The tiktoken encoding used to estimate the number of tokens.
+    """
+
+    streaming = False
+    tokenizer = "cl100k_base"
+
+    def __init__(self, name, context_window=DEFAULT_CONTEXT_WINDOW):
+        self.name = name
+        self.context_window = context_window
+
+    def query(self, prompt, query, documents, callback=None):
+        """
+        This method answers the query from the documents.
+
+        Args:
+            prompt (str): The prompt template, with its context and question variables.
+            query (str): The search query.
+            documents (list): The documents of the context.
+            callback (BaseCallbackHandler, optional): A callback handler receiving the
+                tokens of the answer. Defaults to None.
+
+        Returns:
+            dict: A dictionary containing the answer in "result".
+        """
+        raise NotImplementedError
+
+    async def aquery(self, prompt, query, documents, callback=None):
+        """
+        This method is the async version of query. By default, the blocking query
+        runs in the thread pool of the engines, bounded by ENGINE_EXECUTOR_WORKERS.
+        """
+        executor = get_executor("engines", settings.ENGINE_EXECUTOR_WORKERS)
+        return await run_in_executor(executor, self.query, prompt, query, documents, callback)
+
+
+class OpenAIChatEngine(Engine):
+    """
+    This class answers with an OpenAI chat model, streaming the answer.
+    """
+
+    streaming = True
+
+    def __init__(self, name, context_window=DEFAULT_CONTEXT_WINDOW):
+        super().__init__(name, context_window)
+        # Set the locale to French for the date of the prompt
+        locale.setlocale(locale.LC_TIME, "fr_FR.UTF-8")
+        self.llm = self.build_llm()
+
+    def build_llm(self):
+        """
+        This method builds the LangChain LLM shared by all the queries.
+        """
+        # pylint: disable=import-outside-toplevel
+        from langchain.chat_models import ChatOpenAI
+
+        return ChatOpenAI(
+            streaming=True,
+            temperature=0,
+            model_name=self.name,
+            request_timeout=REQUEST_TIMEOUT,
+        )
+
+    def build_prompt(self, prompt, query, documents):
+        """
+        This method returns the prompt template, dated of the current time, and
+        the formatted prompt sent to the model.
+        """
+        now = datetime.now()
+        formatted_date_time = now.strftime("%d %B %Y à %H:%M")
+
+        prompt_template = PromptTemplate(
+            input_variables=["question", "context"],
+            template=f"Nous sommes le {formatted_date_time}\n{prompt}",
+        )
+
+        context = "\n".join([format_content(doc.page_content) for doc in documents])
+        return prompt_template, prompt_template.format(context=context, question=query)
+
+    def query(self, prompt, query, documents, callback=None):
+        prompt_template, prompt = self.build_prompt(prompt, query, documents)
+        results = answer_with_chain(self.llm, prompt_template, query, documents, callback)
+        return {"result": results["result"], "input": prompt}
+
+    async def aquery(self, prompt, query, documents, callback=None):
+        prompt_template, prompt = self.build_prompt(prompt, query, documents)
+        results = await aanswer_with_chain(
+            self.llm, prompt_template, query, documents, callback
+        )
+        return {"result": results["result"], "input": prompt}
+
+
+class OpenAICompletionEngine(OpenAIChatEngine):
+    """
+    This class answers with an OpenAI completion model, streaming the answer.
+    """
+
+    def build_llm(self):
+        # pylint: disable=import-outside-toplevel
+        from langchain.llms import OpenAI
+
+        # The context was packed to leave this many tokens of the window for the answer
+        return OpenAI(
+            streaming=True,
+            temperature=0,
+            model_name=self.name,
+            request_timeout=REQUEST_TIMEOUT,
+            max_tokens=settings.CONTEXT_ANSWER_TOKENS,
+        )
+
+
+class TextSynthEngine(Engine):
+    """
+    This class answers with a model of the TextSynth API, through a session
+    keeping its HTTPS connections alive.
+    """
+
+    def __init__(self, name, model, stop=None, context_window=DEFAULT_CONTEXT_WINDOW):
+        super().__init__(name, context_window)
+        self.url = TEXT_SYNTH_URL.format(model)
+        self.stop = stop
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {settings.TEXT_SYNTH_API_KEY}",
+            }
+        )
+
+    def query(self, prompt, query, documents, callback=None):
+        prompt_template = PromptTemplate(
+            input_variables=["question", "context"], template=f"{prompt}"
+        )
+
+        context = (
+            "\n***\n" + "\n***\n".join([doc.page_content for doc in documents]) + "\n***\n"
+        )
+        prompt = prompt_template.format(context=context, question=query)
+
+        data = {
+            "system": "Only respond if the answer is contained in the text above",
+            "messages": [prompt],
+            "max_tokens": 500,
+            "temperature": 0.2,
+            "top_k": 10,
+            "top_p": 0.5,
+        }
+        if self.stop:
+            data["stop"] = self.stop
+
+        response = self.session.post(self.url, json=data, timeout=REQUEST_TIMEOUT)
+        response_json = response.json()
+        return {"result": response_json["text"], "input": prompt}
+
+
+class ParadigmEngine(Engine):
+    """
+    This class answers with the LightOn Paradigm model.
+    """
+
+    def __init__(self, name, context_window=DEFAULT_CONTEXT_WINDOW):
+        # pylint: disable=import-outside-toplevel
+        from paradigm_client.remote_model import RemoteModel
+
+        super().__init__(name, context_window)
+        self.model = RemoteModel(os.environ["PARADIGM_HOST"], model_name="llm-mini")
+
+        # Utilise l'API Tokenize pour obtenir les ID de tokens pour "Je ne sais pas"
+        tokenize_response = self.model.tokenize("Je ne sais pas")
+
+        # Récupére les ID de tokens à partir de la réponse
+        token_ids = [list(token.values())[0] for token in tokenize_response.tokens]
+
+        # Ajoute un biais positif pour ces tokens
+        self.biases = {token_id: 5 for token_id in token_ids}
+
+    def query(self, prompt, query, documents, callback=None):
+        context = "###\n".join([doc.page_content for doc in documents])
+        prompt_template = PromptTemplate(
+            input_variables=["question", "context"], template=prompt
+        )
+        prompt = prompt_template.format(context=context, question=query)
+
+        stop_words = [
+            "\n\n",
+            "\nQuestion:",
+        ]  # List of stopping strings to use during the generation
+        parameters = {
+            "n_tokens": 200,
+            "temperature": 0,
+            "biases": self.biases,
+            "stop_regex": r"(?i)(" + "|".join(re.escape(word) for word in stop_words) + ")",
+        }
+
+        paradigm_result = self.model.create(prompt, **parameters)
+        if hasattr(paradigm_result, "completions") and len(paradigm_result.completions) > 0:
+            return {"result": paradigm_result.completions[0].output_text}
+        return {"result": "No completions found"}
+
+
+class VertexAIEngine(Engine):
+    """
+    This class answers with the VertexAI chat model.
+    """
+
+    def __init__(self, name, context_window=DEFAULT_CONTEXT_WINDOW):
+        # pylint: disable=import-outside-toplevel
+        from langchain.chat_models import ChatVertexAI
+
+        super().__init__(name, context_window)
+        self.llm = ChatVertexAI()
+
+    def query(self, prompt, query, documents, callback=None):
+        prompt_template = PromptTemplate(
+            input_variables=["question", "context"], template=f"{prompt}"
+        )
+        return answer_with_chain(self.llm, prompt_template, query, documents, callback)
+
+    async def aquery(self, prompt, query, documents, callback=None):
+        prompt_template = PromptTemplate(
+            input_variables=["question", "context"], template=f"{prompt}"
+        )
+        return await aanswer_with_chain(self.llm, prompt_template, query, documents, callback)
+
+
+class FastChatEngine(Engine):
+    """
+    This class answers with the FastChat model, run in the current process.
+    """
+
+    def __init__(self, name, context_window=DEFAULT_CONTEXT_WINDOW):
+        # pylint: disable=import-outside-toplevel
+        from langchain import HuggingFacePipeline
+        from transformers import AutoTokenizer, pipeline
+
+        super().__init__(name, context_window)
+        # model = "tiiuae/falcon-7b-instruct"
+        model = "lmsys/fastchat-t5-3b-v1.0"
+        tokenizer = AutoTokenizer.from_pretrained(model)
+        pipe = pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer,
+            # torch_dtype=torch.bfloat16,
+            trust_remote_code=True,
+            device="mps",
+            model_kwargs={
+                # "load_in_8bit": False,
+                "max_length": 512,
+                "temperature": 0.0,
+            },
+        )
+        self.llm = HuggingFacePipeline(pipeline=pipe)
+
+    def query(self, prompt, query, documents, callback=None):
+        prompt_template = PromptTemplate(
+            input_variables=["question", "context"], template=prompt
+        )
+        return answer_with_chain(self.llm, prompt_template, query, documents, callback)
+
+
+ENGINE_LABELS = {}
+_engines = ModelRegistry()
+_engines_lock = threading.Lock()
+
+
+def register_engine(name, factory, label=None):
+    """
+    Registers an engine under the given name.
+
+    Args:
+        name (str): The name of the engine, as selected in the forms.
+        factory (callable): Builds the engine, called once per process on first use.
+        label (str, optional): The label of the engine in the forms. Unlabelled
+            engines are not listed in the choices but can still be selected.
+    """
+    _engines.register(name, factory)
+    if label is not None:
+        ENGINE_LABELS[name] = label
+
+
+def is_engine(name):
+    """
+    Returns True if the name designates an engine: a registered one or any
+    OpenAI chat model ("gpt-...").
+    """
+    return name in _engines.names() or name.startswith("gpt-")
+
+
+def get_engine(name):
+    """
+    Returns the engine of the given name, built once per process.
+
+    Args:
+        name (str): The name of the engine.
+
+    Returns:
+        Engine: The shared engine.
+
+    Raises:
+        ValueError: If the name does not designate an engine.
+    """
+    if name not in _engines.names():
+        if not is_engine(name):
+            raise ValueError(f"Unknown engine: {name}")
+        with _engines_lock:
+            if name not in _engines.names():
+                register_engine(name, partial(OpenAIChatEngine, name))
+    return _engines.get(name)
+
+
+def engine_choices():
+    """
+    Returns the choices of the engine fields of the forms.
+    """
+    return list(ENGINE_LABELS.items())
+
+
+def warm_up_engines(names):
+    """
+    Builds the given engines ahead of the first query.
+    """
+    for name in names:
+        get_engine(name)
+
+
+register_engine(
+    "gpt-3.5-turbo", partial(OpenAIChatEngine, "gpt-3.5-turbo", 4096), "ChatGPT 3.5"
+)
+register_engine(
+    "gpt-3.5-turbo-instruct",
+    partial(OpenAICompletionEngine, "gpt-3.5-turbo-instruct", 4096),
+    "GPT 3.5 instruct",
+)
+register_engine("gpt-4", partial(OpenAIChatEngine, "gpt-4", 8192), "ChatGPT 4")
+register_engine(
+    "mistral_instruct",
+    partial(
+        TextSynthEngine,
+        "mistral_instruct",
+        "mistral_7B_instruct",
+        stop="\nQ:",
+        context_window=4096,
+    ),
+    "Mistral Instruct",
+)
+register_engine(
+    "falcon",
+    partial(TextSynthEngine, "falcon", "falcon_40B-chat", context_window=2048),
+    "Falcon",
+)
+register_engine("paradigm", partial(ParadigmEngine, "paradigm", 2048), "LightOn")
+register_engine("vertexai", partial(VertexAIEngine, "vertexai", 8192), "VertexAI")
+register_engine("fastchat", partial(FastChatEngine, "fastchat", 512))
@@ -0,0 +1,272 @@
+"""
+This module provides the execution policy of the engines: the latency of each
+engine is tracked over its last queries, and a query to an engine with a hedge
+(ENGINE_HEDGES) also starts the hedge engine when the primary one has not
+answered after its usual time to first token.
+
+The first engine to stream a token (or to answer, for the engines which do not
+stream) wins: its tokens are forwarded to the callback of the query and the
+other engine is cancelled. An engine failing before it wins is replaced by its
+hedge at once.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+from langchain.callbacks.base import AsyncCallbackHandler
+
+from .aio import run_in_executor
+
+logger = logging.getLogger("cassandre")
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised in the LLM callbacks to abort a generation which was superseded by
+    another question of the session, or whose session was closed.
+    """
+
+
+class LatencyTracker:
+    """
+    This class keeps the last latencies of each engine, in seconds: their time
+    to first token, or to the answer for the engines which do not stream.
+    """
+
+    def __init__(self, window=None):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        """
+        This method records a latency of the engine.
+        """
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = deque(maxlen=self.window or settings.ENGINE_LATENCY_WINDOW)
+                self.samples[name] = samples
+            samples.append(seconds)
+
+    def percentile(self, name, percent):
+        """
+        This method returns the given percentile of the latencies of the engine.
+
+        Returns:
+            float: The latency in seconds, or None before ENGINE_LATENCY_MIN_SAMPLES
+            latencies were recorded.
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(name, ()))
+        if len(samples) < max(settings.ENGINE_LATENCY_MIN_SAMPLES, 1):
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percent / 100))
+        return samples[index]
+
+    def stats(self):
+        """
+        This method returns the number of latencies and the p50 and p95 of each engine.
+        """
+        with self.lock:
+            names = list(self.samples)
+        stats = {}
+        for name in names:
+            with self.lock:
+                samples = sorted(self.samples[name])
+            stats[name] = {
+                "count": len(samples),
+                "p50": samples[len(samples) // 2],
+                "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            }
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+
+latencies = LatencyTracker()
+
+
+def get_hedge_delay(name):
+    """
+    Returns the delay in seconds after which the hedge of an engine is started:
+    the ENGINE_HEDGE_PERCENTILE of its latencies, ENGINE_HEDGE_DELAY until enough
+    latencies are known, and at least ENGINE_HEDGE_MIN_DELAY.
+    """
+    delay = latencies.percentile(name, settings.ENGINE_HEDGE_PERCENTILE)
+    if delay is None:
+        delay = settings.ENGINE_HEDGE_DELAY
+    return max(delay, settings.ENGINE_HEDGE_MIN_DELAY)
+
+
+def get_engine_plan(name):
+    """
+    Returns the engines answering a query to the given engine: the engine and
+    its hedge, if any.
+    """
+    hedge = settings.ENGINE_HEDGES.get(name)
+    return [name, hedge] if hedge and hedge != name else [name]
+
+
+async def forward(callback, method, *args, **kwargs):
+    """
+    Calls a method of a callback handler, sync or async.
+    """
+    if callback is None:
+        return
+    handler = getattr(callback, method)
+    if asyncio.iscoroutinefunction(handler):
+        await handler(*args, **kwargs)
+    elif callback.run_inline:
+        handler(*args, **kwargs)
+    else:
+        await run_in_executor(None, partial(handler, *args, **kwargs))
+
+
+class Race:
+    """
+    This class holds the winner of the engines answering a query.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.winner = None
+        self.decided = asyncio.Event()
+
+    def claim(self, name):
+        """
+        This method makes the engine the winner, if there is none yet, and
+        returns True if the engine is the winner.
+        """
+        if self.winner is None:
+            self.winner = name
+            self.decided.set()
+        return self.winner == name
+
+
+class RaceCallbackHandler(AsyncCallbackHandler):
+    """
+    Callback handler of an engine of a race: it records the time to first token
+    of the engine, forwards its tokens once it won and aborts it once it lost.
+    """
+
+    raise_error = True
+
+    def __init__(self, race, name):
+        super().__init__()
+        self.race = race
+        self.name = name
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            latencies.record(self.name, self.first_token_at - self.started_at)
+        if not self.race.claim(self.name):
+            raise asyncio.CancelledError()
+        await forward(self.race.callback, "on_llm_new_token", token, **kwargs)
+
+    async def on_llm_end(self, response, **kwargs):
+        if self.race.winner == self.name:
+            await forward(self.race.callback, "on_llm_end", response, **kwargs)
+
+    async def on_llm_error(self, error, **kwargs):
+        if self.race.winner == self.name:
+            await forward(self.race.callback, "on_llm_error", error, **kwargs)
+
+
+async def attempt(race, name, run):
+    """
+    Runs an engine of a race, recording its latency when it does not stream.
+    """
+    callback = RaceCallbackHandler(race, name)
+    results = await run(name, callback)
+    if callback.first_token_at is None:
+        latencies.record(name, time.monotonic() - callback.started_at)
+    return results
+
+
+async def aexecute(names, run, callback=None, timeout=None):
+    """
+    Answers a query with the given engines: the first one, then its hedge after
+    its hedge delay, or as soon as it fails.
+
+    Args:
+        names (list): The name of the engine and of its hedge, if any.
+        run (coroutine function): Answers the query with an engine, given its name
+            and the callback handler of the query.
+        callback (BaseCallbackHandler, optional): Receives the events of the winner.
+        timeout (float, optional): The time in seconds given to the engines to
+            stream their first token (or to answer, if they do not stream).
+
+    Returns:
+        dict: The results of the winner, with its name in "engine".
+
+    Raises:
+        asyncio.TimeoutError: If no engine started to answer before the timeout.
+        Exception: The error of the last engine, if all of them failed.
+    """
+    primary = names[0]
+    hedges = list(names[1:])
+    race = Race(callback)
+    loop = asyncio.get_running_loop()
+    tasks = {asyncio.create_task(attempt(race, primary, run)): primary}
+    hedge_at = loop.time() + get_hedge_delay(primary) if hedges else None
+    deadline = loop.time() + timeout if timeout is not None else None
+    error = None
+
+    try:
+        while race.winner is None:
+            delays = [at - loop.time() for at in (hedge_at, deadline) if at is not None]
+            delay = max(0, min(delays)) if delays else None
+            decided = asyncio.create_task(race.decided.wait())
+            done, _ = await asyncio.wait(
+                [*tasks, decided], timeout=delay, return_when=asyncio.FIRST_COMPLETED
+            )
+            decided.cancel()
+
+            for task in done - {decided}:
+                name = tasks.pop(task)
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    error = task.exception()
+                    logger.warning("Engine %s failed: %s", name, error)
+                    continue
+                # An engine which does not stream wins when it answers
+                race.claim(name)
+                tasks[task] = name
+
+            if race.winner is not None:
+                break
+            if deadline is not None and loop.time() >= deadline:
+                raise asyncio.TimeoutError()
+            failed = not tasks
+            if hedges and (failed or loop.time() >= hedge_at):
+                name = hedges.pop(0)
+                logger.info("Hedging %s with %s", primary, name)
+                tasks[asyncio.create_task(attempt(race, name, run))] = name
+                hedge_at = loop.time() + get_hedge_delay(name) if hedges else None
+            elif failed:
+                raise error
+
+        winner = next((task for task, name in tasks.items() if name == race.winner), None)
+        if winner is None:
+            # The winner failed after streaming its first tokens
+            raise error
+        results = await winner
+    finally:
+        losers = [task for task in tasks if tasks[task] != race.winner]
+        for task in losers:
+            task.cancel()
+        await asyncio.gather(*losers, return_exceptions=True)
+
+    results["engine"] = race.winner
+    return results
@@ -0,0 +1,98 @@
+"""
+This module provides the extractive answers given when the engines fail or miss
+the deadline of the search: the sentences of the retrieved chunks sharing the
+most words with the query, with their source.
+"""
+import re
+
+from .correction_service import normalize_query
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?;])\s+|\n+")
+# Source line appended to the chunks by DocumentSearch
+SOURCE_LINE_PATTERN = re.compile(r"\nsource: .* - page .*\n?$")
+STOP_WORDS = set(
+    "les des une est que qui quoi quel quelle quels quelles pour par dans sur avec sans "
+    "aux mon mes nous vous ils elles comment quand pas plus son ses".split()
+)
+
+FALLBACK_INTRODUCTION = (
+    "Je n'ai pas pu générer de réponse à temps. "
+    "Voici les passages des documents qui semblent les plus pertinents :"
+)
+FALLBACK_NO_DOCUMENTS = (
+    "Je n'ai pas pu générer de réponse à temps et aucun document ne correspond à votre "
+    "question. Veuillez réessayer plus tard."
+)
+
+
+def get_words(text):
+    """
+    Returns the significant words of a text.
+    """
+    return {
+        word
+        for word in normalize_query(text).split()
+        if len(word) > 2 and word not in STOP_WORDS
+    }
+
+
+def split_sentences(text):
+    """
+    Returns the sentences of a chunk, without its source line.
+    """
+    text = SOURCE_LINE_PATTERN.sub("", text)
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+
+
+def extract_sentences(query, documents, max_sentences=3, max_documents=3):
+    """
+    Selects the sentences of the best chunks sharing the most words with the query.
+
+    Args:
+        query (str): The search query.
+        documents (list): The retrieved chunks, best first.
+        max_sentences (int): The number of sentences returned.
+        max_documents (int): The number of chunks considered.
+
+    Returns:
+        list: The selected sentences with their chunk, in decreasing relevance.
+    """
+    query_words = get_words(query)
+    candidates = []
+    for rank, doc in enumerate(documents[:max_documents]):
+        for position, sentence in enumerate(split_sentences(doc.page_content)):
+            overlap = len(query_words & get_words(sentence))
+            if overlap:
+                candidates.append((-overlap, rank, position, sentence, doc))
+    candidates.sort(key=lambda candidate: candidate[:3])
+
+    if not candidates and documents:
+        # Without any common word, the beginning of the best chunk
+        sentences = split_sentences(documents[0].page_content)
+        return [(sentence, documents[0]) for sentence in sentences[:max_sentences]]
+    return [(sentence, doc) for _, _, _, sentence, doc in candidates[:max_sentences]]
+
+
+def extractive_answer(query, documents, max_sentences=3):
+    """
+    Returns the extractive answer of the query: an introduction flagging the
+    answer as a fallback, then the selected sentences with their source and page.
+
+    Args:
+        query (str): The search query.
+        documents (list): The retrieved chunks, best first.
+        max_sentences (int): The number of sentences of the answer.
+
+    Returns:
+        str: The answer.
+    """
+    sentences = extract_sentences(query, documents, max_sentences)
+    if not sentences:
+        return FALLBACK_NO_DOCUMENTS
+
+    lines = [FALLBACK_INTRODUCTION]
+    for sentence, doc in sentences:
+        source = doc.metadata.get("origin", "")
+        page = doc.metadata.get("page", "")
+        lines.append(f"- {sentence} (source : {source} - page {page})")
+    return "\n".join(lines)
@@ -1,22 +1,45 @@
+import hashlib
+import json
 import logging
 import os
 import re
 import tempfile
+from collections import deque
+from datetime import timedelta
+from functools import partial
+from itertools import islice
 
 from django.conf import settings
 from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
 from langchain.document_loaders import PDFPlumberLoader, TextLoader
 from langchain.schema import Document as LangchainDocument
-from langchain.text_splitter import SpacyTextSplitter
+import pdfplumber
 from ai.services.hints import parse_hints
 
+from ai.models import CollectionVersion
 from documents.models import Category, Correction, Document
 
-from . import vector_database_service
+from . import embedding_cache, vector_database_service
+from .aio import get_executor
 from .chunk import split_markdown
+from .context import add_token_counts
+from .model_registry import get_text_splitter
 
 logger = logging.getLogger("cassandre")
 
+# The size of the blocks in which the files are copied and hashed
+FILE_BLOCK_SIZE = 1024 * 1024
+
+
+class CollectionValidationError(Exception):
+    """
+    Raised when a new version of a collection does not have the expected number
+    of points.
+    """
+
 
 def clean_text(text, full=True):
     """
@@ -65,6 +88,60 @@ def get_categories(category_id=None):
     )
 
 
+def iter_pdf_pages(file_name):
+    """
+    Loads the pages of a PDF file one at a time, in the format of PDFPlumberLoader
+    which loads all of them at once.
+
+    Args:
+        file_name (str): The path of the PDF file.
+
+    Yields:
+        Document: The text of each page, with its page number starting at 0.
+    """
+    with pdfplumber.open(file_name) as pdf:
+        metadata = {
+            key: value for key, value in pdf.metadata.items() if isinstance(value, (str, int))
+        }
+        for page in pdf.pages:
+            yield LangchainDocument(
+                page_content=page.extract_text() + "\n",
+                metadata={"page": page.page_number - 1, "total_pages": len(pdf.pages), **metadata},
+            )
+            # Releases the parsed objects of the page
+            page.flush_cache()
+
+
+def split_pdf_pages(pages, document):
+    """
+    Cleans, splits and hints the pages of a PDF document, one page at a time.
+
+    Args:
+        pages (iterable): The loaded pages of the PDF document.
+        document (Document): The document object.
+
+    Yields:
+        Document: The chunks of the pages.
+    """
+    text_splitter = get_text_splitter()
+    hint_mappings = parse_hints(getattr(document, "hints", ""))
+
+    for page in pages:
+        loaded_documents = process_loaded_documents([page], document)
+        for doc in text_splitter.split_documents(loaded_documents):
+            page_number = doc.metadata.get("page", 1)
+            specific_hints = hint_mappings.get(page_number, [])
+            all_hints = hint_mappings.get("all", [])
+
+            # Combine all hints applicable to this page
+            combined_hints = specific_hints + all_hints
+            if combined_hints:
+                doc.page_content = f"{' - '.join(combined_hints)}\n" + doc.page_content
+            else:
+                doc.page_content = f"{doc.metadata.get('origin', '')}\n" + doc.page_content
+            yield doc
+
+
 def load_and_split_pdf(temp_file, document):
     """
     Load and split a PDF document.
@@ -77,29 +154,7 @@ def load_and_split_pdf(temp_file, document):
         list: A list of split text documents.
     """
     loader = PDFPlumberLoader(temp_file.name)
-    loaded_documents = process_loaded_documents(loader.load(), document)
-
-    text_splitter = SpacyTextSplitter(
-        pipeline="fr_core_news_lg",
-        chunk_size=settings.SPLIT_CHUNK_SIZE,
-        chunk_overlap=settings.SPLIT_CHUNK_OVERLAP,
-    )
-    splitted_documents = text_splitter.split_documents(loaded_documents)
-
-    hint_mappings = parse_hints(getattr(document, "hints", ""))
-
-    for doc in splitted_documents:
-        page_number = doc.metadata.get("page", 1)
-        specific_hints = hint_mappings.get(page_number, [])
-        all_hints = hint_mappings.get("all", [])
-
-        # Combine all hints applicable to this page
-        combined_hints = specific_hints + all_hints
-        if combined_hints:
-            doc.page_content = f"{' - '.join(combined_hints)}\n" + doc.page_content
-        else:
-            doc.page_content = f"{doc.metadata.get('origin', '')}\n" + doc.page_content
-    return splitted_documents
+    return list(split_pdf_pages(loader.load(), document))
 
 
 def load_and_split_md(temp_file, document):
@@ -158,60 +213,488 @@ def process_loaded_documents(loaded_documents, document, full_clean=True):
     return loaded_documents
 
 
-def index_documents(category_id=None):
+def hash_metadata(digest, document):
+    """
+    Adds the title (the origin of the chunks) and the hints of a document to the
+    hash of its file, and returns the hash of its indexed content.
     """
-    Indexes all the documents in the specified category.
+    for text in (document.title, document.hints):
+        digest.update(b"\0" + (text or "").encode())
+    return digest.hexdigest()
 
-    :param category_id: The ID of the category to index documents for.
-    If not specified, all categories will be indexed.
+
+def hash_document(document, file_content):
     """
-    categories = get_categories(category_id)
+    Returns the hash of the indexed content of a document: its file, its title
+    and its hints.
 
-    for category in categories:
-        documents = Document.objects.filter(category=category)
-        texts = []
-
-        for document in documents:
-            with default_storage.open(document.file.name, "rb") as file:
-                file_content = file.read()
-                file_ext = os.path.splitext(document.file.name)[-1]
-
-                with tempfile.NamedTemporaryFile(
-                    suffix=file_ext, delete=False
-                ) as temp_file:
-                    logger.info("Loading: %s", document.title or document.file)
-                    temp_file.write(file_content)
-                    temp_file.flush()
-
-                    if file_ext == ".pdf":
-                        texts.extend(load_and_split_pdf(temp_file, document))
-                    elif file_ext == ".md":
-                        texts.extend(load_and_split_md(temp_file, document))
-
-                    logger.info(
-                        "Successfully loaded document: %s",
-                        document.title or document.file,
-                    )
-
-        corrections = Correction.objects.filter(category=category)
-        for correction in corrections:
-            document = LangchainDocument(
+    Args:
+        document (Document): The document.
+        file_content (bytes): The content of its file.
+
+    Returns:
+        str: The hexadecimal SHA-256 hash.
+    """
+    return hash_metadata(hashlib.sha256(file_content), document)
+
+
+def copy_document_file(document, temp_file):
+    """
+    Copies the file of a document to a temporary file, block by block, and
+    returns the hash of the indexed content of the document (see hash_document).
+    """
+    digest = hashlib.sha256()
+    with default_storage.open(document.file.name, "rb") as file:
+        for block in iter(partial(file.read, FILE_BLOCK_SIZE), b""):
+            digest.update(block)
+            temp_file.write(block)
+    temp_file.flush()
+    return hash_metadata(digest, document)
+
+
+def iter_chunks(document, file_name):
+    """
+    Loads, cleans, splits and hints the file of a document, one page at a time
+    for the PDF files.
+
+    Args:
+        document (Document): The document.
+        file_name (str): The path of a local copy of its file.
+
+    Yields:
+        Document: The chunks of the document, none for the unsupported formats.
+    """
+    file_ext = os.path.splitext(document.file.name)[-1]
+    if file_ext == ".pdf":
+        chunks = split_pdf_pages(iter_pdf_pages(file_name), document)
+    elif file_ext == ".md":
+        with open(file_name, "rb") as temp_file:
+            chunks = load_and_split_md(temp_file, document)
+    else:
+        return
+
+    for chunk in chunks:
+        # The loaders set the path of the temporary file, which changes at each indexing
+        metadata = {**chunk.metadata, "source": document.file.name}
+        metadata.pop("file_path", None)
+        chunk.metadata = metadata
+        yield chunk
+
+
+def batched(iterable, size):
+    """
+    Yields the items of an iterable by lists of the given size (the last one may
+    be shorter).
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def upsert_chunks(collection_name, chunks):
+    """
+    Embeds and upserts chunks by batches of INDEX_BATCH_SIZE, with at most
+    INDEX_MAX_IN_FLIGHT_BATCHES batches being embedded and upserted while the next
+    chunks are loaded: the memory used does not depend on the number of chunks.
+    The stored embeddings of the chunks are read and the new ones saved by the
+    calling thread, the threads of the pool only embed and upsert.
+
+    Args:
+        collection_name (str): The name of the collection.
+        chunks (iterable): The point id, the chunk and the payload fields
+            identifying its origin, of each chunk.
+
+    Returns:
+        int: The number of upserted chunks.
+    """
+    max_in_flight = settings.INDEX_MAX_IN_FLIGHT_BATCHES
+    executor = get_executor("indexing", max_in_flight)
+    in_flight = deque()
+    count = 0
+    try:
+        for batch in batched(chunks, settings.INDEX_BATCH_SIZE):
+            if len(in_flight) >= max_in_flight:
+                embedding_cache.store_embeddings(in_flight.popleft().result())
+            point_ids, texts, fields = zip(*batch)
+            add_token_counts(texts)
+            stored = embedding_cache.get_stored_embeddings([text.page_content for text in texts])
+            in_flight.append(
+                executor.submit(
+                    vector_database_service.upsert_texts,
+                    collection_name,
+                    list(texts),
+                    list(point_ids),
+                    list(fields),
+                    stored=stored,
+                )
+            )
+            count += len(batch)
+    finally:
+        # Waits for the batches in flight, raising their error if any
+        while in_flight:
+            embedding_cache.store_embeddings(in_flight.popleft().result())
+    return count
+
+
+def get_chunk_point_id(document, index, chunk):
+    """
+    Returns the deterministic id of the point of a chunk of a document, which
+    changes with the content and the metadata of the chunk.
+    """
+    content = json.dumps([chunk.page_content, chunk.metadata], sort_keys=True, default=str)
+    return vector_database_service.get_point_id(
+        "document", document.id, index, hashlib.sha256(content.encode()).hexdigest()
+    )
+
+
+def index_document(collection_name, document, force=False):
+    """
+    Indexes a document if its content changed since its last indexing: the new
+    chunks are embedded and upserted as they are loaded (see upsert_chunks), the
+    points of the chunks which are gone are deleted, and the hash and the point
+    ids of the document are saved.
+
+    Args:
+        collection_name (str): The collection of the category of the document.
+        document (Document): The document.
+        force (bool, optional): Indexes the document even if it did not change.
+
+    Returns:
+        bool: True if the document was indexed.
+    """
+    file_ext = os.path.splitext(document.file.name)[-1]
+    with tempfile.NamedTemporaryFile(suffix=file_ext) as temp_file:
+        content_hash = copy_document_file(document, temp_file)
+        if not force and content_hash == document.content_hash:
+            return False
+
+        logger.info("Loading: %s", document.title or document.file)
+        indexed = set() if force else set(document.point_ids)
+        point_ids = []
+        fields = {vector_database_service.DOCUMENT_ID_FIELD: document.id}
+
+        def new_chunks():
+            for index, chunk in enumerate(iter_chunks(document, temp_file.name)):
+                point_id = get_chunk_point_id(document, index, chunk)
+                point_ids.append(point_id)
+                if point_id not in indexed:
+                    yield point_id, chunk, fields
+
+        upserted = upsert_chunks(collection_name, new_chunks())
+
+    if vector_database_service.collection_exists(collection_name):
+        vector_database_service.delete_document_points(collection_name, document.id, point_ids)
+
+    document.content_hash = content_hash
+    document.point_ids = point_ids
+    document.save(update_fields=["content_hash", "point_ids"])
+    logger.info(
+        "Indexed %s: %s new chunk(s) out of %s",
+        document.title or document.file,
+        upserted,
+        len(point_ids),
+    )
+    return True
+
+
+def get_correction_point_id(correction):
+    """
+    Returns the deterministic id of the point of a correction, which changes with
+    its query and its answer.
+    """
+    content = f"{correction.query}\n{correction.answer}"
+    return vector_database_service.get_point_id(
+        "correction", correction.id, hashlib.sha256(content.encode()).hexdigest()
+    )
+
+
+def index_corrections(collection_name, corrections, force=False):
+    """
+    Indexes the new or changed corrections of a category and deletes the points
+    of the others.
+
+    Args:
+        collection_name (str): The collection of the category.
+        corrections (QuerySet): The corrections of the category.
+        force (bool, optional): Indexes all the corrections.
+
+    Returns:
+        int: The number of indexed or deleted corrections.
+    """
+    corrections = {get_correction_point_id(correction): correction for correction in corrections}
+    indexed = set()
+    if not force and vector_database_service.collection_exists(collection_name):
+        indexed = vector_database_service.get_point_ids(
+            collection_name, vector_database_service.CORRECTION_ID_FIELD
+        )
+
+    new_chunks = (
+        (
+            point_id,
+            LangchainDocument(
                 page_content=f"Question: {correction.query}\nRéponse: {correction.answer}",
                 metadata={
                     "origin": "correction manuelle",
                     "source": f"correction-{correction.id}",
                     "page": 1,
                 },
-            )
-            texts.append(document)
+            ),
+            {vector_database_service.CORRECTION_ID_FIELD: correction.id},
+        )
+        for point_id, correction in corrections.items()
+        if point_id not in indexed
+    )
+    upserted = upsert_chunks(collection_name, new_chunks)
+    deleted_ids = indexed - set(corrections)
+    vector_database_service.delete_points(collection_name, deleted_ids)
+    return upserted + len(deleted_ids)
+
+
+def get_active_version(category):
+    """
+    Returns the version of the collection of the category served by its alias,
+    None if the category has none.
+    """
+    return category.collection_versions.filter(
+        activated_at__isnull=False, retired_at__isnull=True
+    ).first()
 
-        vector_database_service.create_collection(category.slug, texts)
 
+def update_collection(category, collection_name, progress=None):
+    """
+    Indexes incrementally the documents and the corrections of a category in its
+    active collection: only the new or changed documents and corrections are
+    embedded, and the points of the deleted ones are removed.
+
+    Args:
+        category (Category): The category.
+        collection_name (str): The name of its active collection.
+        progress (callable, optional): Called with the category, the number of
+            documents done and their total, after each document.
+    """
+    documents = Document.objects.filter(category=category).order_by("id")
+    total = documents.count()
+    indexed = 0
+    for done, document in enumerate(documents.iterator(), 1):
+        if index_document(collection_name, document):
+            indexed += 1
+        report_progress(progress, category, done, total)
+
+    corrections = Correction.objects.filter(category=category)
+    changed = index_corrections(collection_name, corrections)
+
+    # The points of the deleted documents
+    removed = vector_database_service.delete_other_points(
+        collection_name,
+        vector_database_service.DOCUMENT_ID_FIELD,
+        documents.values_list("id", flat=True),
+    )
+    if indexed or changed or removed:
+        vector_database_service.collection_updated.send(
+            sender=update_collection, collection_name=category.slug
+        )
+
+    logger.info(
+        "Successfully indexed %s out of %s document(s) and %s correction(s) for category %s",
+        indexed,
+        total,
+        changed,
+        category.name,
+    )
+
+
+def report_progress(progress, category, done, total):
+    """
+    Logs the progress of the indexing of a category and reports it to the
+    progress callback, if any.
+    """
+    logger.info("Category %s: %s/%s document(s) indexed", category.name, done, total)
+    if progress is not None:
+        progress(category, done, total)
+
+
+def create_version(category):
+    """
+    Creates the next version of the collection of a category, to be built.
+    """
+    last_version = category.collection_versions.aggregate(Max("version"))["version__max"]
+    version = (last_version or 0) + 1
+    return CollectionVersion.objects.create(
+        category=category,
+        version=version,
+        name=vector_database_service.get_version_name(category.slug, version),
+    )
+
+
+def get_unfinished_version(category):
+    """
+    Returns the last version of the collection of the category whose build was
+    interrupted, None if there is none.
+    """
+    return category.collection_versions.filter(activated_at__isnull=True).first()
+
+
+def discard_version(collection_version):
+    """
+    Deletes a version of a collection which could not be built. Its documents
+    were saved with the point ids of the version, they are indexed again from
+    scratch by the next update or build.
+    """
+    collection_name = collection_version.name
+    if vector_database_service.collection_exists(collection_name):
+        vector_database_service.get_qdrant_client().delete_collection(collection_name)
+    documents = Document.objects.filter(category=collection_version.category_id)
+    if collection_version.last_document_id is not None:
+        documents.filter(id__lte=collection_version.last_document_id).update(
+            content_hash="", point_ids=[]
+        )
+    collection_version.delete()
+
+
+def rebuild_collection(category, collection_version=None, progress=None):
+    """
+    Indexes all the documents and the corrections of a category in a new version
+    of its collection. Once its number of points is checked, the new version is
+    served by the alias of the category in place of the active one, which is
+    retired: the searches never see a partial collection.
+
+    The documents are indexed one at a time in the order of their ids, and the
+    last indexed one is saved with the version: an interrupted build resumes
+    after it.
+
+    Args:
+        category (Category): The category.
+        collection_version (CollectionVersion, optional): The unfinished version
+            to resume, a new version is created otherwise.
+        progress (callable, optional): See update_collection.
+
+    Raises:
+        CollectionValidationError: If the new version misses points, it is then
+        deleted and the active version stays in use.
+    """
+    if collection_version is None:
+        collection_version = create_version(category)
+        logger.info("Building the collection %s", collection_version.name)
+    else:
         logger.info(
-            "Successfully indexed %s document(s) and %s correction(s) for category %s",
-            documents.count(),
-            corrections.count(),
-            category.name,
+            "Resuming the build of the collection %s after the document %s",
+            collection_version.name,
+            collection_version.last_document_id,
         )
+    collection_name = collection_version.name
+
+    documents = Document.objects.filter(category=category).order_by("id")
+    corrections = list(Correction.objects.filter(category=category))
+    # Number of points of the documents in the new version, by document id: the
+    # documents added or re-indexed into the active version during the build do
+    # not change it
+    indexed_points = {}
+    try:
+        total = documents.count()
+        if collection_version.last_document_id is not None:
+            indexed_points = {
+                document_id: len(point_ids)
+                for document_id, point_ids in documents.filter(
+                    id__lte=collection_version.last_document_id
+                ).values_list("id", "point_ids")
+            }
+            documents = documents.filter(id__gt=collection_version.last_document_id)
+        for document in documents.iterator():
+            index_document(collection_name, document, force=True)
+            indexed_points[document.id] = len(document.point_ids)
+            collection_version.last_document_id = document.id
+            collection_version.save(update_fields=["last_document_id"])
+            report_progress(progress, category, len(indexed_points), total)
+
+        index_corrections(collection_name, corrections, force=True)
+        document_ids = set(
+            Document.objects.filter(category=category).values_list("id", flat=True)
+        )
+        if vector_database_service.collection_exists(collection_name):
+            # The points of the documents deleted during the build
+            vector_database_service.delete_other_points(
+                collection_name, vector_database_service.DOCUMENT_ID_FIELD, document_ids
+            )
+        else:
+            # A category without any chunk
+            vector_database_service.ensure_collection(
+                collection_name, vector_database_service.get_vector_size()
+            )
+
+        expected = len(corrections) + sum(
+            count
+            for document_id, count in indexed_points.items()
+            if document_id in document_ids
+        )
+        points_count = vector_database_service.count_points(collection_name)
+        if points_count != expected:
+            raise CollectionValidationError(
+                f"The collection {collection_name} has {points_count} points "
+                f"instead of {expected}"
+            )
+    except CollectionValidationError:
+        discard_version(collection_version)
+        raise
+
+    with transaction.atomic():
+        now = timezone.now()
+        category.collection_versions.filter(
+            activated_at__isnull=False, retired_at__isnull=True
+        ).update(retired_at=now)
+        collection_version.points_count = points_count
+        collection_version.activated_at = now
+        collection_version.save(update_fields=["points_count", "activated_at"])
+        vector_database_service.switch_alias(category.slug, collection_name)
+
+    logger.info(
+        "Successfully built the collection %s with %s point(s) for category %s",
+        collection_name,
+        points_count,
+        category.name,
+    )
+
+
+def delete_retired_versions(category):
+    """
+    Deletes the collections of the category retired for more than
+    COLLECTION_RETENTION_SECONDS.
+    """
+    deadline = timezone.now() - timedelta(seconds=settings.COLLECTION_RETENTION_SECONDS)
+    versions = category.collection_versions.filter(retired_at__lt=deadline)
+    for collection_version in versions:
+        logger.info("Deleting the collection %s", collection_version.name)
+        if vector_database_service.collection_exists(collection_version.name):
+            vector_database_service.get_qdrant_client().delete_collection(collection_version.name)
+        collection_version.delete()
+
+
+def index_documents(category_id=None, rebuild=False, progress=None):
+    """
+    Indexes the documents and the corrections of the specified category.
+
+    The active collection of a category is updated incrementally, see
+    update_collection. A category without an active collection (or all of them
+    with rebuild) is indexed in a new collection version, see rebuild_collection.
+    An interrupted build is resumed first.
+
+    :param category_id: The ID of the category to index documents for.
+    If not specified, all categories will be indexed.
+    :param rebuild: Rebuilds the collections from scratch, without interrupting
+    the searches.
+    :param progress: Called with the category, the number of documents done and
+    their total, after each document.
+    """
+    categories = get_categories(category_id)
+
+    for category in categories:
+        unfinished = get_unfinished_version(category)
+        active = get_active_version(category)
+        if unfinished is not None:
+            rebuild_collection(category, unfinished, progress=progress)
+        elif active is None or rebuild:
+            rebuild_collection(category, progress=progress)
+        else:
+            update_collection(category, active.name, progress=progress)
+        delete_retired_versions(category)
 
     logger.info("Successfully indexed all documents")
@@ -0,0 +1,324 @@
+"""
+This module provides a process-wide registry for the heavy NLP objects used by
+the application (NER anonymizer, spaCy text splitter, local embeddings,
+tiktoken encoding).
+
+Each model is loaded lazily on first use, exactly once per process, and then
+shared by every caller (views, Celery tasks, management commands). When the
+MODEL_SERVER_SOCKET setting is set, the NLP models are hosted once per node by
+the model server (see ai.services.model_server) and the registry holds clients
+for them instead.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger("cassandre")
+
+
+def get_resident_memory():
+    """
+    Returns the resident set size of the current process.
+
+    Returns:
+        int: The resident memory in bytes, or 0 if it cannot be determined.
+    """
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class ModelRegistry:
+    """
+    This class holds one instance per registered model for the whole process.
+    Models are built by their loader on first access, under a per-model lock so
+    that concurrent threads never load the same model twice. The registry also
+    records, for each model, the time spent loading it and the growth of the
+    resident memory observed during the load.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._instances = {}
+        self._stats = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        """
+        Registers a loader for the given model name.
+
+        Args:
+            name (str): The name of the model.
+            loader (callable): A callable without arguments returning the model.
+        """
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+            self._instances.pop(name, None)
+            self._stats.pop(name, None)
+
+    def get(self, name):
+        """
+        Returns the instance of the given model, loading it if necessary.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            object: The model instance.
+
+        Raises:
+            KeyError: If no loader is registered under this name.
+        """
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        if name not in self._locks:
+            raise KeyError(f"No model registered under the name '{name}'")
+
+        with self._locks[name]:
+            instance = self._instances.get(name)
+            if instance is None:
+                instance = self._load(name)
+        return instance
+
+    def _load(self, name):
+        rss_before = get_resident_memory()
+        start = time.perf_counter()
+        instance = self._loaders[name]()
+        load_seconds = time.perf_counter() - start
+        rss_delta = max(get_resident_memory() - rss_before, 0)
+
+        self._stats[name] = {"load_seconds": load_seconds, "rss_delta": rss_delta}
+        self._instances[name] = instance
+        logger.info(
+            "Loaded model %s in %.2fs (+%.1f MB resident)",
+            name,
+            load_seconds,
+            rss_delta / (1024 * 1024),
+        )
+        return instance
+
+    def is_loaded(self, name):
+        """
+        Returns True if the given model has already been loaded in this process.
+        """
+        return name in self._instances
+
+    def names(self):
+        """
+        Returns the names of all registered models.
+        """
+        return list(self._loaders)
+
+    def warm_up(self, names=None):
+        """
+        Loads the given models (all registered models by default) ahead of the
+        first request.
+
+        Args:
+            names (list, optional): The names of the models to load.
+        """
+        for name in self.names() if names is None else names:
+            self.get(name)
+
+    def memory_usage(self):
+        """
+        Returns the accounting of the loaded models.
+
+        The memory figures are the growth of the resident memory observed
+        while each model was loading, so they are approximate when several
+        models are loaded concurrently.
+
+        Returns:
+            dict: A mapping of model names to their load time and memory delta.
+        """
+        return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def unload(self, name):
+        """
+        Drops the instance of the given model, it will be reloaded on next access.
+        """
+        with self._locks.get(name, self._lock):
+            self._instances.pop(name, None)
+            self._stats.pop(name, None)
+
+
+def load_local_anonymizer(micro_batching=None):
+    """
+    Builds the Anonymizer in the current process from the settings.
+
+    Args:
+        micro_batching (bool, optional): Wraps the Anonymizer in a MicroBatcher.
+            Defaults to the ANONYMIZER_MICRO_BATCHING setting.
+    """
+    # pylint: disable=import-outside-toplevel
+    from .anonymize_service import Anonymizer, MicroBatcher, NamePrescreen
+
+    if micro_batching is None:
+        micro_batching = settings.ANONYMIZER_MICRO_BATCHING
+
+    prescreen = None
+    if settings.ANONYMIZER_PRESCREEN:
+        prescreen = NamePrescreen.from_file(settings.ANONYMIZER_FIRST_NAMES_FILE)
+
+    anonymizer = Anonymizer(
+        batch_size=settings.ANONYMIZER_BATCH_SIZE,
+        prescreen=prescreen,
+        backend=settings.ANONYMIZER_BACKEND,
+        model_path=settings.ANONYMIZER_ONNX_MODEL_DIR,
+    )
+    if micro_batching:
+        return MicroBatcher(
+            anonymizer,
+            max_batch_size=settings.ANONYMIZER_BATCH_SIZE,
+            max_wait_ms=settings.ANONYMIZER_MICRO_BATCH_WAIT_MS,
+        )
+    return anonymizer
+
+
+def load_local_text_splitter():
+    """
+    Builds the spaCy text splitter in the current process from the settings.
+    """
+    # pylint: disable=import-outside-toplevel
+    from langchain.text_splitter import SpacyTextSplitter
+
+    return SpacyTextSplitter(
+        pipeline="fr_core_news_lg",
+        chunk_size=settings.SPLIT_CHUNK_SIZE,
+        chunk_overlap=settings.SPLIT_CHUNK_OVERLAP,
+    )
+
+
+def load_local_embeddings():
+    """
+    Builds the sentence-transformers model named by LOCAL_EMBEDDING_MODEL in
+    the current process.
+    """
+    # pylint: disable=import-outside-toplevel
+    from langchain.embeddings import SentenceTransformerEmbeddings
+
+    return SentenceTransformerEmbeddings(model_name=settings.LOCAL_EMBEDDING_MODEL)
+
+
+def _load_token_encoding():
+    # pylint: disable=import-outside-toplevel
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _remote_model(cls, fallback_loader):
+    # pylint: disable=import-outside-toplevel
+    from .model_server import ModelClient
+
+    client = ModelClient(settings.MODEL_SERVER_SOCKET, timeout=settings.MODEL_SERVER_TIMEOUT)
+    return cls(client, fallback_loader, retry_interval=settings.MODEL_SERVER_RETRY_INTERVAL)
+
+
+def _load_anonymizer():
+    if settings.MODEL_SERVER_SOCKET:
+        # pylint: disable=import-outside-toplevel
+        from .model_server import RemoteAnonymizer
+
+        return _remote_model(RemoteAnonymizer, load_local_anonymizer)
+    return load_local_anonymizer()
+
+
+def _load_text_splitter():
+    if settings.MODEL_SERVER_SOCKET:
+        # pylint: disable=import-outside-toplevel
+        from .model_server import RemoteModel, RemoteTextSplitter
+
+        return RemoteTextSplitter(
+            _remote_model(RemoteModel, load_local_text_splitter),
+            chunk_size=settings.SPLIT_CHUNK_SIZE,
+            chunk_overlap=settings.SPLIT_CHUNK_OVERLAP,
+        )
+    return load_local_text_splitter()
+
+
+def _load_embeddings():
+    if settings.MODEL_SERVER_SOCKET:
+        # pylint: disable=import-outside-toplevel
+        from .model_server import RemoteEmbeddings
+
+        return _remote_model(RemoteEmbeddings, load_local_embeddings)
+    return load_local_embeddings()
+
+
+def build_server_registry():
+    """
+    Returns a registry of the models loaded in the current process, as hosted
+    by the model server. The anonymizer always batches the concurrent requests.
+    """
+    models = ModelRegistry()
+    models.register("anonymizer", lambda: load_local_anonymizer(micro_batching=True))
+    models.register("text_splitter", load_local_text_splitter)
+    if settings.LOCAL_EMBEDDING_MODEL:
+        models.register("embeddings", load_local_embeddings)
+    return models
+
+
+registry = ModelRegistry()
+registry.register("anonymizer", _load_anonymizer)
+registry.register("text_splitter", _load_text_splitter)
+registry.register("token_encoding", _load_token_encoding)
+if settings.LOCAL_EMBEDDING_MODEL:
+    registry.register("embeddings", _load_embeddings)
+
+
+def get_anonymizer():
+    """
+    Returns the shared Anonymizer of the current process, wrapped in a
+    MicroBatcher when ANONYMIZER_MICRO_BATCHING is enabled, or the client of the
+    model server when MODEL_SERVER_SOCKET is set.
+    """
+    return registry.get("anonymizer")
+
+
+def get_text_splitter():
+    """
+    Returns the shared spaCy text splitter of the current process.
+    """
+    return registry.get("text_splitter")
+
+
+def get_local_embeddings():
+    """
+    Returns the shared local embedding model of the current process, see the
+    LOCAL_EMBEDDING_MODEL setting.
+    """
+    return registry.get("embeddings")
+
+
+def get_token_encoding():
+    """
+    Returns the shared tiktoken encoding of the current process.
+    """
+    return registry.get("token_encoding")
+
+
+def warm_up_models():
+    """
+    Loads the models listed in the MODEL_REGISTRY_WARMUP setting and builds the
+    engines listed in the ENGINE_WARMUP setting.
+    """
+    names = settings.MODEL_REGISTRY_WARMUP
+    if names:
+        registry.warm_up(names)
+
+    if settings.ENGINE_WARMUP:
+        # pylint: disable=import-outside-toplevel
+        from .engines import warm_up_engines
+
+        warm_up_engines(settings.ENGINE_WARMUP)
@@ -0,0 +1,351 @@
+"""
+This module provides a local model server hosting the NLP models shared by the
+processes of a node (NER anonymizer, spaCy text splitter, local embeddings),
+and the thin clients used to reach it over a Unix socket.
+
+Messages are JSON documents prefixed by their length on 4 bytes. A request is
+{"method": ..., "args": [...]} and the response is {"result": ...} or
+{"error": ...}. When the server cannot be reached, the clients fall back to
+loading the model in the calling process.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from langchain.embeddings.base import Embeddings
+from langchain.text_splitter import TextSplitter
+
+logger = logging.getLogger("cassandre")
+
+HEADER = struct.Struct(">I")
+
+
+class ModelServerUnavailable(Exception):
+    """
+    Raised when the model server cannot be reached.
+    """
+
+
+class ModelServerError(Exception):
+    """
+    Raised when the model server failed to process a request.
+    """
+
+
+def send_message(sock, payload):
+    """
+    Sends a length-prefixed JSON message on the socket.
+    """
+    data = json.dumps(payload).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def receive_message(sock):
+    """
+    Receives a length-prefixed JSON message from the socket.
+
+    Returns:
+        object: The decoded message.
+
+    Raises:
+        ConnectionError: If the connection is closed before a full message is read.
+    """
+    (size,) = HEADER.unpack(_receive_exactly(sock, HEADER.size))
+    return json.loads(_receive_exactly(sock, size).decode("utf-8"))
+
+
+class ModelServerHandler(socketserver.BaseRequestHandler):
+    """
+    This class serves the requests of one client connection until it is closed.
+    """
+
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.request)
+            except (ConnectionError, OSError):
+                return
+
+            method = self.server.methods.get(request.get("method"))
+            if method is None:
+                send_message(self.request, {"error": f"Unknown method: {request.get('method')}"})
+                continue
+
+            try:
+                response = {"result": method(*request.get("args", []))}
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception("Model server request failed")
+                response = {"error": f"{type(error).__name__}: {error}"}
+
+            try:
+                send_message(self.request, response)
+            except OSError:
+                return
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    This class hosts the models of a ModelRegistry and serves them over a Unix
+    socket, one thread per client connection. Single anonymization requests
+    from all the clients are grouped by the MicroBatcher of the hosted
+    anonymizer before running the NER model.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, models):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.models = models
+        self.methods = {
+            "redact_many": self.redact_many,
+            "split_text": self.split_text,
+            "embed_documents": self.embed_documents,
+            "embed_query": self.embed_query,
+        }
+        self._splitter_lock = threading.Lock()
+        super().__init__(socket_path, ModelServerHandler)
+
+    def redact_many(self, texts):
+        """
+        Anonymizes the texts and returns the serialized RedactionResults.
+        """
+        anonymizer = self.models.get("anonymizer")
+        if len(texts) == 1:
+            results = [anonymizer.redact(texts[0])]
+        else:
+            results = anonymizer.redact_many(texts)
+        return [[result.text, [list(span) for span in result.redactions]] for result in results]
+
+    def split_text(self, text):
+        """
+        Splits the text into chunks with the shared text splitter.
+        """
+        with self._splitter_lock:
+            return self.models.get("text_splitter").split_text(text)
+
+    def embed_documents(self, texts):
+        """
+        Embeds the texts with the local embedding model.
+        """
+        return self.models.get("embeddings").embed_documents(texts)
+
+    def embed_query(self, text):
+        """
+        Embeds the query with the local embedding model.
+        """
+        return self.models.get("embeddings").embed_query(text)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class ModelClient:
+    """
+    This class sends requests to the model server. Each thread keeps its own
+    connection, which is reopened after a fork or when the server restarted.
+    """
+
+    def __init__(self, socket_path, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._local.sock = sock
+        self._local.pid = os.getpid()
+        return sock
+
+    def _disconnect(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def _exchange(self, sock, payload):
+        send_message(sock, payload)
+        return receive_message(sock)
+
+    def call(self, method, *args):
+        """
+        Calls a method of the model server.
+
+        Args:
+            method (str): The name of the method.
+            *args: The JSON serializable arguments of the method.
+
+        Returns:
+            object: The result of the method.
+
+        Raises:
+            ModelServerUnavailable: If the server cannot be reached.
+            ModelServerError: If the server failed to process the request.
+        """
+        payload = {"method": method, "args": list(args)}
+        sock = getattr(self._local, "sock", None)
+        if sock is not None and self._local.pid != os.getpid():
+            # Never share a connection inherited from the parent process
+            self._local.sock = sock = None
+
+        try:
+            if sock is not None:
+                try:
+                    response = self._exchange(sock, payload)
+                except (ConnectionError, BrokenPipeError):
+                    # The server may have restarted since the connection was opened
+                    self._disconnect()
+                    sock = None
+            if sock is None:
+                response = self._exchange(self._connect(), payload)
+        except (OSError, ValueError) as error:
+            self._disconnect()
+            raise ModelServerUnavailable(str(error)) from error
+
+        if "error" in response:
+            raise ModelServerError(response["error"])
+        return response["result"]
+
+
+class RemoteModel:
+    """
+    This class is the base of the model clients. It forwards the calls to the
+    model server and falls back on a model loaded in the current process while
+    the server is unavailable, trying the server again after retry_interval
+    seconds.
+    """
+
+    def __init__(self, client, fallback_loader, retry_interval=30):
+        self.client = client
+        self.retry_interval = retry_interval
+        self._fallback_loader = fallback_loader
+        self._fallback = None
+        self._fallback_lock = threading.Lock()
+        self._retry_at = 0
+
+    def local_model(self):
+        """
+        Returns the model loaded in the current process, loading it if necessary.
+        """
+        with self._fallback_lock:
+            if self._fallback is None:
+                self._fallback = self._fallback_loader()
+        return self._fallback
+
+    def call(self, method, *args, decode=None):
+        """
+        Calls the method on the model server, or on the local model while the
+        server is unavailable.
+
+        Args:
+            method (str): The name of the method, on the server and on the local model.
+            *args: The arguments of the method.
+            decode (callable, optional): Converts the result of the server into the
+                type returned by the local model.
+        """
+        if time.monotonic() >= self._retry_at:
+            try:
+                result = self.client.call(method, *args)
+                return decode(result) if decode else result
+            except ModelServerUnavailable as error:
+                logger.warning(
+                    "Model server %s unavailable (%s), using in-process models",
+                    self.client.socket_path,
+                    error,
+                )
+                self._retry_at = time.monotonic() + self.retry_interval
+        return getattr(self.local_model(), method)(*args)
+
+
+def _decode_redactions(results):
+    # pylint: disable=import-outside-toplevel
+    from .anonymize_service import Redaction, RedactionResult
+
+    return [
+        RedactionResult(text, [Redaction(*span) for span in redactions])
+        for text, redactions in results
+    ]
+
+
+class RemoteAnonymizer(RemoteModel):
+    """
+    This class exposes the Anonymizer interface on top of the model server.
+    """
+
+    def anonymize(self, text):
+        """
+        Anonymizes a text, see Anonymizer.anonymize.
+        """
+        return self.redact(text).text
+
+    def anonymize_many(self, texts, batch_size=None):
+        """
+        Anonymizes several texts, see Anonymizer.anonymize_many.
+        """
+        return [result.text for result in self.redact_many(texts, batch_size)]
+
+    def redact(self, text):
+        """
+        Anonymizes a text and reports the redactions, see Anonymizer.redact.
+        """
+        return self.redact_many([text])[0]
+
+    def redact_many(self, texts, batch_size=None):  # pylint: disable=unused-argument
+        """
+        Anonymizes several texts and reports the redactions, see Anonymizer.redact_many.
+        The batch size is chosen by the server.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.call("redact_many", texts, decode=_decode_redactions)
+
+
+class RemoteTextSplitter(TextSplitter):
+    """
+    This class is a text splitter delegating the splitting to the model server.
+    """
+
+    def __init__(self, remote, **kwargs):
+        super().__init__(**kwargs)
+        self.remote = remote
+
+    def split_text(self, text):
+        return self.remote.call("split_text", text)
+
+
+class RemoteEmbeddings(RemoteModel, Embeddings):
+    """
+    This class exposes the embeddings of the local embedding model hosted by
+    the model server.
+    """
+
+    def embed_documents(self, texts):
+        return self.call("embed_documents", list(texts))
+
+    def embed_query(self, text):
+        return self.call("embed_query", text)
@@ -1,48 +1,58 @@
-# pylint: disable=no-name-in-module
-# pylint: disable=no-self-argument
-# pylint: disable=abstract-class-instantiated
-# pylint: disable=arguments-differ
 # pylint: disable=unused-argument
-import locale
+import asyncio
 import logging
-import os
 import re
-from datetime import datetime
+import threading
+import time
+from functools import partial
 from typing import List
 
 import openai
-import qdrant_client
 import requests
-import tiktoken
+from asgiref.sync import async_to_sync
 from django.conf import settings
-from langchain import HuggingFacePipeline
-from langchain.chains import RetrievalQA
-from langchain.chat_models import ChatOpenAI, ChatVertexAI
-from langchain.llms import OpenAI, VertexAI
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
 from langchain.prompts import PromptTemplate
-from langchain.schema import BaseRetriever, Document
+from langchain.schema import Document, Generation, LLMResult
 from langchain.vectorstores import Qdrant
-from paradigm_client.remote_model import RemoteModel
-from pydantic import BaseModel
-from transformers import AutoTokenizer, pipeline
 
-from ai.services.anonymize_service import Anonymizer
-from ai.services.embedding import get_embedding, get_query_prefix
+from ai.services.aio import get_executor, run_in_executor, use_shared_openai_session
+from ai.services.context import pack_context
+from ai.services.correction_service import afind_correction, find_correction
+from ai.services.embedding import get_query_prefix
+from ai.services.embedding_cache import get_query_embedding
+from ai.services.engines import DEFAULT_ENGINE, get_engine
+from ai.services.execution import aexecute, forward, get_engine_plan
+from ai.services.extractive import extractive_answer
+from ai.services.model_registry import get_anonymizer
+from ai.services.single_flight import coalesce, flight_key
+from ai.services.vector_database_service import (
+    collection_updated,
+    get_async_qdrant_client,
+    get_qdrant_client,
+)
 from documents.models import Category
 
 logger = logging.getLogger("cassandre")
 
+# Chunks whose sentences make the extractive answers
+EXTRACTIVE_DOCUMENTS = 3
 
-class DocsRetriever(BaseRetriever, BaseModel):
-    """Simple BaseRetriever for qa chain"""
-
-    documents: List[Document]
-
-    def get_relevant_documents(self, query: str) -> List[Document]:
-        return self.documents
-
-    async def aget_relevant_documents(self, query: str) -> List[Document]:
-        raise NotImplementedError
+# Errors of the providers and of the network answered with an extractive answer,
+# the other ones are bugs or misconfigurations and propagate
+ENGINE_ERRORS = (
+    asyncio.TimeoutError,
+    TimeoutError,
+    requests.RequestException,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+)
 
 
 class DocumentSearch:
@@ -57,10 +67,10 @@ class DocumentSearch:
             "iff": "indemnité forfaitaire de formation",
         }
         self.category = category
-        self.embeddings = get_embedding()
+        self.embeddings = get_query_embedding()
         self.query_prefix = get_query_prefix()
-        url = settings.QDRANT_URL
-        self.client = qdrant_client.QdrantClient(url=url, prefer_grpc=True)
+        self.client = get_qdrant_client()
+        # The slug is the alias of the active version of the collection
         self.docsearch = Qdrant(
             self.client, self.category.slug, self.embeddings.embed_query
         )
@@ -81,10 +91,48 @@ class DocumentSearch:
         query = self.normalize_query(query)
         k = self.category.k if k is None else k
         res = self.docsearch.similarity_search_with_score(query, k=k)
+        return self.filter_results(res, threshold)
+
+    async def aget_relevant_documents(self, query, threshold=0.80, k=None):
+        """
+        This method is the async version of get_relevant_documents: the query is
+        embedded and searched without blocking the event loop, the search going
+        through the async gRPC client of Qdrant of the running event loop.
+
+        Args:
+            query (str): The search query.
+            threshold (float, optional): The similarity score threshold. Defaults to 0.80.
+
+        Returns:
+            List[Document]: A list of relevant documents.
+        """
+        query = self.normalize_query(query)
+        k = self.category.k if k is None else k
+        embedding = await self.embeddings.aembed_query(query)
+        # The async gRPC channel of the shared client is bound to its first event loop
+        docsearch = Qdrant(
+            get_async_qdrant_client(), self.category.slug, self.embeddings.embed_query
+        )
+        res = await docsearch.asimilarity_search_with_score_by_vector(embedding, k=k)
+        return self.filter_results(res, threshold)
+
+    def filter_results(self, results, threshold):
+        """
+        This method keeps the documents scoring above the threshold and appends
+        their source to their content.
+
+        Args:
+            results (list): The documents found, with their score.
+            threshold (float): The similarity score threshold.
+
+        Returns:
+            List[Document]: The relevant documents.
+        """
         documents: List[Document] = []
-        for doc, score in res:
+        for doc, score in results:
             if score < threshold:
                 continue
+            doc.metadata["score"] = score
             page = doc.metadata.get("page", "")
             source = doc.metadata.get("origin", "")
 
@@ -131,364 +179,385 @@ class DocumentSearch:
         return f"{self.query_prefix}{query}"
 
 
-def search_documents(
-    query,
-    engine="gpt-3.5-turbo",
-    category_slug="documents",
-    prompt=None,
-    k=None,
-    callback=None,
-):
+_document_searches = {}
+_document_searches_lock = threading.Lock()
+
+
+def get_document_search(category):
     """
-    This function searches for documents based on the provided query and category.
+    Returns the DocumentSearch of the category, built once per process and reused
+    by the following searches.
 
     Args:
-        query (str): The search query.
-        engine (str, optional): The search engine to use. Defaults to "gpt-3.5-turbo".
-        category_slug (str): The category of the documents to search.
-        callback (function, optional): A callback function to handle the search results.
-            Defaults to None.
+        category (Category): The category to search, its current settings (k,
+            prompt...) replace the ones of the cached instance.
 
     Returns:
-        list: A list of relevant documents.
+        DocumentSearch: The shared DocumentSearch of the category.
     """
-    query = Anonymizer().anonymize(query)
-    category = Category.objects.get(slug=category_slug)
-
-    document_search = DocumentSearch(category=category)
-    documents = document_search.get_relevant_documents(query, k=k)
+    document_search = _document_searches.get(category.slug)
+    if document_search is None:
+        with _document_searches_lock:
+            document_search = _document_searches.get(category.slug)
+            if document_search is None:
+                document_search = DocumentSearch(category=category)
+                _document_searches[category.slug] = document_search
+    document_search.category = category
+    return document_search
+
+
+def clear_document_searches(slug=None):
+    """
+    Drops the cached DocumentSearch of the given category slug, or all of them.
+    """
+    with _document_searches_lock:
+        if slug is None:
+            _document_searches.clear()
+        else:
+            _document_searches.pop(slug, None)
 
-    engine_query_map = {
-        "falcon": query_falcon,
-        "mistral_instruct": query_mistral_instruct,
-        "paradigm": query_lighton,
-        "fastchat": query_fastchat,
-        "vertexai": query_vertexai,
-    }
 
-    query_function = engine_query_map.get(engine, query_openai)
-    prompt = category.prompt if prompt is None else prompt
-    return query_function(prompt, query, documents, engine, callback=callback)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_search(sender, instance, **kwargs):
+    """
+    Drops the cached DocumentSearch when its category is saved or deleted.
+    """
+    clear_document_searches()
 
 
-def query_lighton(prompt, query, documents, engine, callback):
+@receiver(collection_updated)
+def invalidate_collection_search(sender, collection_name, **kwargs):
     """
-    This function queries the LightOn model for answers based on the provided query and documents.
+    Drops the cached DocumentSearch of a category once its collection is reindexed.
+    """
+    clear_document_searches(collection_name)
 
-    Args:
-        prompt (str): The prompt.
-        query (str): The search query.
-        documents (list): The list of relevant documents.
-        engine (str, optional): The search engine to use. Defaults to "gpt-3.5-turbo".
-        callback (function, optional): A callback function to handle the search results.
-            Defaults to None.
 
-    Returns:
-        dict: A dictionary containing the search results.
+def correction_results(correction, callback=None):
     """
-    host_ip = os.environ["PARADIGM_HOST"]
-    model = RemoteModel(host_ip, model_name="llm-mini")
-
-    context = "###\n".join([doc.page_content for doc in documents])
-    prompt_template = PromptTemplate(
-        input_variables=["question", "context"], template=prompt
-    )
+    Returns the results of a search answered by a correction, after streaming
+    its answer to the callback.
+    """
+    if callback is not None:
+        callback.on_llm_new_token(correction.answer)
+        callback.on_llm_end(LLMResult(generations=[[Generation(text=correction.answer)]]))
+    return {"result": correction.answer, "correction_id": correction.id}
 
-    # Utilise l'API Tokenize pour obtenir les ID de tokens pour "Je ne sais pas"
-    tokenize_response = model.tokenize("Je ne sais pas")
 
-    # Récupére les ID de tokens à partir de la réponse
-    token_ids = [list(token.values())[0] for token in tokenize_response.tokens]
+def get_sources(documents):
+    """
+    Returns the origin, page and score of the documents of the context.
+    """
+    return [
+        {
+            "origin": doc.metadata.get("origin", ""),
+            "page": doc.metadata.get("page", ""),
+            "score": doc.metadata.get("score"),
+        }
+        for doc in documents
+    ]
 
-    # Ajoute un biais positif pour ces tokens
-    biases = {token_id: 5 for token_id in token_ids}
 
-    prompt = prompt_template.format(context=context, question=query)
+def log_context(context):
+    """
+    Logs the token budget of the packed context.
+    """
+    logger.debug(
+        "Context: %d chunk(s), %d token(s), %d chunk(s) dropped",
+        len(context.documents),
+        context.context_tokens,
+        context.dropped,
+    )
 
-    logger.debug("### paradigm")
-    logger.debug("Prompt: %s", prompt)
-    logger.debug("Number of tokens: %d", len(model.tokenize(prompt).tokens))
 
-    stop_words = [
-        "\n\n",
-        "\nQuestion:",
-    ]  # List of stopping strings to use during the generation
-    parameters = {
-        "n_tokens": 200,
-        "temperature": 0,
-        "biases": biases,
-        "stop_regex": r"(?i)(" + "|".join(re.escape(word) for word in stop_words) + ")",
-    }
+def add_context_results(results, context):
+    """
+    Adds the token count and the sources of the packed context to the results.
+    """
+    results["token_count"] = context.prompt_tokens + context.context_tokens
+    results["dropped_chunks"] = context.dropped
+    results["sources"] = get_sources(context.documents)
+    return results
 
-    paradigm_result = model.create(prompt, **parameters)
-    if hasattr(paradigm_result, "completions") and len(paradigm_result.completions) > 0:
-        return {"result": paradigm_result.completions[0].output_text}
-    else:
-        return {"result": "No completions found"}
 
+async def answer(prompt, query, documents, engine, callback=None):
+    """
+    Answers the query with the given engine, from the retrieved documents packed
+    into its context window.
+    """
+    llm_engine = get_engine(engine)
+    context = pack_context(llm_engine.context_window, prompt, query, documents)
+    log_context(context)
 
-def format_content(content):
-    lines = content.split("\n")
-    if lines:
-        lines[0] = f"### {lines[0]}"
-    return "\n".join(lines)
+    results = await llm_engine.aquery(prompt, query, context.documents, callback=callback)
+    return add_context_results(results, context)
 
 
-def query_openai(prompt, query, documents, engine, callback):
+def fallback_results(query, documents):
+    """
+    Returns the extractive answer given instead of the answer of the engines,
+    flagged with "fallback".
     """
-    This function queries the OpenAI model with a
-    given category, query, documents, engine, and callback.
+    return {
+        "result": extractive_answer(query, documents[:EXTRACTIVE_DOCUMENTS]),
+        "fallback": True,
+        "engine": None,
+        "token_count": 0,
+        "dropped_chunks": 0,
+        "sources": get_sources(documents[:EXTRACTIVE_DOCUMENTS]),
+    }
 
-    Args:
-        prompt (str): The prompt.
-        query (str): The search query.
-        documents (list): The list of relevant documents.
-        engine (str): The search engine to use.
-        callback (function, optional): A callback function
-            to handle the search results. Defaults to None.
 
-    Returns:
-        dict: A dictionary containing the search results.
+class StreamRecorder(BaseCallbackHandler):
+    """
+    Callback handler forwarding the tokens of an engine to the callback of the
+    search, and recording whether some of them were streamed.
     """
-    # Set the locale to French
-    locale.setlocale(locale.LC_TIME, "fr_FR.UTF-8")
 
-    now = datetime.now()
-    formatted_date_time = now.strftime("%d %B %Y à %H:%M")
+    raise_error = True
+    run_inline = True
 
-    prompt_template = PromptTemplate(
-        input_variables=["question", "context"],
-        template=f"Nous sommes le {formatted_date_time}\n{prompt}",
-    )
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+        self.streamed = False
 
-    context = "\n".join([format_content(doc.page_content) for doc in documents])
-    prompt = prompt_template.format(context=context, question=query)
-    enc = tiktoken.get_encoding("cl100k_base")
-    token_count = len(enc.encode(prompt))
+    def on_llm_new_token(self, token, **kwargs):
+        self.streamed = True
+        if self.callback is not None:
+            self.callback.on_llm_new_token(token, **kwargs)
 
-    logger.debug("Prompt: %s", prompt)
-    logger.debug("Number of tokens: %d", token_count)
+    def on_llm_end(self, response, **kwargs):
+        if self.callback is not None:
+            self.callback.on_llm_end(response, **kwargs)
 
-    callbacks = [callback] if callback is not None else []
+    def on_llm_error(self, error, **kwargs):
+        if self.callback is not None:
+            self.callback.on_llm_error(error, **kwargs)
 
-    max_tokens = 4096 - token_count
 
-    if engine == "gpt-3.5-turbo-instruct":
-        llm = OpenAI(
-            streaming=True,
-            temperature=0,
-            model_name=engine,
-            request_timeout=300,
-            callbacks=callbacks,
-            max_tokens=max_tokens,
-        )
-    else:
-        llm = ChatOpenAI(
-            streaming=True,
-            temperature=0,
-            model_name=engine,
-            request_timeout=300,
-            callbacks=callbacks,
-        )
+class AsyncStreamRecorder(AsyncCallbackHandler):
+    """
+    Async version of StreamRecorder, the callback of the search may be sync or async.
+    """
 
-    question_answer = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=DocsRetriever(documents=documents),
-    )
-    question_answer.combine_documents_chain.llm_chain.prompt = prompt_template
+    raise_error = True
 
-    results = question_answer({"query": query}, return_only_outputs=True)
-    return {"result": results["result"], "input": prompt, "token_count": token_count}
-    # return results
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+        self.streamed = False
 
+    async def on_llm_new_token(self, token, **kwargs):
+        self.streamed = True
+        await forward(self.callback, "on_llm_new_token", token, **kwargs)
 
-def query_falcon(prompt, query, documents, engine, callback):
-    """
-    This function queries the Falcon model with
-    a given category, query, documents, engine, and callback.
+    async def on_llm_end(self, response, **kwargs):
+        await forward(self.callback, "on_llm_end", response, **kwargs)
 
-    Args:
-        category (str): The category of the query.
-        query (str): The search query.
-        documents (list): The list of relevant documents.
-        engine (str): The search engine to use.
-        callback (function, optional): A callback function to handle the search results. Defaults to None.
+    async def on_llm_error(self, error, **kwargs):
+        await forward(self.callback, "on_llm_error", error, **kwargs)
 
-    Returns:
-        dict: A dictionary containing the search results.
+
+async def answer_before_deadline(engines, prompt, query, documents, callback, started_at):
+    """
+    Answers the query with the engines, and with an extractive answer when
+    SEARCH_EXTRACTIVE_FALLBACK is set and they fail on a provider or network
+    error, or do not start to answer within the SEARCH_DEADLINE of the search.
+    An engine failing after streaming tokens is not followed by an extractive
+    answer, its error propagates.
     """
-    now = datetime.now()
-    formatted_date_time = now.strftime("%d %B %Y à %H:%M")
+    timeout = None
+    if settings.SEARCH_DEADLINE:
+        timeout = max(0, settings.SEARCH_DEADLINE - (time.monotonic() - started_at))
+    recorder = AsyncStreamRecorder(callback)
+    try:
+        return await aexecute(
+            engines, partial(answer, prompt, query, documents), recorder, timeout=timeout
+        )
+    except ENGINE_ERRORS:
+        if not settings.SEARCH_EXTRACTIVE_FALLBACK or recorder.streamed:
+            raise
+        logger.exception("Engine %s failed or missed the deadline", engines[0])
+    return fallback_results(query, documents)
 
-    prompt_template = PromptTemplate(
-        input_variables=["question", "context"], template=f"{prompt}"
-    )
 
-    context = (
-        "\n***\n" + "\n***\n".join([doc.page_content for doc in documents]) + "\n***\n"
-    )
-    prompt = prompt_template.format(context=context, question=query)
-    logger.debug("Prompt: %s", prompt)
-
-    data = {
-        "system": "Only respond if the answer is contained in the text above",
-        "messages": [prompt],
-        "max_tokens": 500,
-        "temperature": 0.2,
-        "top_k": 10,
-        "top_p": 0.5,
-    }
+def search_documents(
+    query,
+    engine=DEFAULT_ENGINE,
+    category_slug="documents",
+    prompt=None,
+    k=None,
+    callback=None,
+    use_corrections=True,
+):
+    """
+    This function searches for documents based on the provided query and category.
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": "Bearer {}".format(settings.TEXT_SYNTH_API_KEY),
-    }
+    When a manual correction of the category matches the query, its answer is
+    returned (and streamed to the callback) without searching the documents nor
+    calling the LLM.
 
-    response = requests.post(
-        "https://api.textsynth.com/v1/engines/falcon_40B-chat/chat",
-        headers=headers,
-        json=data,
-    )
-    response_json = response.json()
-    return {"result": response_json["text"], "input": prompt}
+    An engine with a hedge (ENGINE_HEDGES) races with it, see ai.services.execution.
+    With SEARCH_EXTRACTIVE_FALLBACK, when the engines fail on a provider or network
+    error, or do not start to answer within SEARCH_DEADLINE seconds of the start of
+    the search, the answer is extracted from the retrieved chunks and flagged with
+    "fallback".
 
-def query_mistral_instruct(prompt, query, documents, engine, callback):
-    """
-    This function queries the Mistral instruct model with
-    a given category, query, documents, engine, and callback.
+    With SEARCH_SINGLE_FLIGHT, identical concurrent searches share their retrieval
+    and their answer, see ai.services.single_flight.
 
     Args:
-        category (str): The category of the query.
         query (str): The search query.
-        documents (list): The list of relevant documents.
-        engine (str): The search engine to use.
-        callback (function, optional): A callback function to handle the search results. 
-        Defaults to None.
+        engine (str, optional): The search engine to use. Defaults to "gpt-3.5-turbo".
+        category_slug (str): The category of the documents to search.
+        callback (function, optional): A callback function to handle the search results.
+            Defaults to None.
+        use_corrections (bool, optional): Answers with the matching correction, if any.
+            Defaults to True.
 
     Returns:
-        dict: A dictionary containing the search results.
+        dict: The answer in "result", and the id of the matching correction in
+        "correction_id" when the answer comes from a correction, else the
+        origin, page and score of the documents of the context in "sources".
     """
-    now = datetime.now()
-    formatted_date_time = now.strftime("%d %B %Y à %H:%M")
+    started_at = time.monotonic()
+    category = Category.objects.get(slug=category_slug)
 
-    prompt_template = PromptTemplate(
-        input_variables=["question", "context"], template=f"{prompt}"
-    )
+    if use_corrections:
+        correction = find_correction(category, query)
+        if correction is not None:
+            return correction_results(correction, callback)
 
-    context = (
-        "\n***\n" + "\n***\n".join([doc.page_content for doc in documents]) + "\n***\n"
-    )
-    prompt = prompt_template.format(context=context, question=query)
-    logger.debug("Prompt: %s", prompt)
-
-    data = {
-        "system": "Only respond if the answer is contained in the text above",
-        "messages": [prompt],
-        "max_tokens": 500,
-        "temperature": 0.2,
-        "top_k": 10,
-        "top_p": 0.5,
-        "stop": "\nQ:"
-    }
+    get_engine(engine)
+    query = get_anonymizer().anonymize(query)
+    prompt = category.prompt if prompt is None else prompt
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": "Bearer {}".format(settings.TEXT_SYNTH_API_KEY),
-    }
+    if settings.SEARCH_SINGLE_FLIGHT:
+        # Not the pool of the engines: the hedged engines and those without an async
+        # client run in it, from the thread of the flight
+        executor = get_executor("flights", settings.ENGINE_EXECUTOR_WORKERS)
+        run = partial(
+            run_in_executor,
+            executor,
+            partial(retrieve_and_answer, category, engine, prompt, query, k, started_at),
+        )
+        # The event loop ends with the search, which waits for the generation
+        return async_to_sync(coalesce)(
+            flight_key(category, engine, prompt, query, k), run, callback, detached=False
+        )
+    return retrieve_and_answer(category, engine, prompt, query, k, started_at, callback)
 
-    response = requests.post(
-        "https://api.textsynth.com/v1/engines/mistral_7B_instruct/chat",
-        headers=headers,
-        json=data,
-    )
-    response_json = response.json()
-    return {"result": response_json["text"], "input": prompt}
 
-def query_vertexai(prompt, query, documents, engine, callback):
+def retrieve_and_answer(category, engine, prompt, query, k, started_at, callback=None):
     """
-    This function queries the VertexAI model with a given category, query, documents, engine, and callback.
-
-    Args:
-        promt (str): The promt.
-        query (str): The search query.
-        documents (list): The list of relevant documents.
-        engine (str): The search engine to use.
-        callback (function, optional): A callback function to handle the search results. Defaults to None.
-
-    Returns:
-        dict: A dictionary containing the search results.
+    Retrieves the documents of an anonymized query and answers it, see
+    search_documents.
     """
-    now = datetime.now()
-    formatted_date_time = now.strftime("%d %B %Y à %H:%M")
+    llm_engine = get_engine(engine)
+    document_search = get_document_search(category)
+    documents = document_search.get_relevant_documents(query, k=k)
 
-    prompt_template = PromptTemplate(
-        input_variables=["question", "context"], template=f"{prompt}"
-    )
+    engines = get_engine_plan(engine)
+    if len(engines) > 1 or settings.SEARCH_DEADLINE:
+        # The hedged engines and the deadline run on an event loop
+        return async_to_sync(answer_before_deadline)(
+            engines, prompt, query, documents, callback, started_at
+        )
 
-    context = (
-        "\n***\n" + "\n***\n".join([doc.page_content for doc in documents]) + "\n***\n"
-    )
-    prompt = prompt_template.format(context=context, question=query)
-    logger.debug("Prompt: %s", prompt)
+    context = pack_context(llm_engine.context_window, prompt, query, documents)
+    log_context(context)
 
+    recorder = StreamRecorder(callback)
+    try:
+        results = llm_engine.query(prompt, query, context.documents, callback=recorder)
+    except ENGINE_ERRORS:
+        if not settings.SEARCH_EXTRACTIVE_FALLBACK or recorder.streamed:
+            raise
+        logger.exception("Engine %s failed", engine)
+        return fallback_results(query, documents)
+    results["engine"] = engine
+    return add_context_results(results, context)
 
-    qa = RetrievalQA.from_chain_type(
-        llm=ChatVertexAI(),
-        chain_type="stuff",
-        retriever=DocsRetriever(documents=documents),
-    )
-    qa.combine_documents_chain.llm_chain.prompt = prompt_template
 
-    results = qa({"query": query}, return_only_outputs=True)
-    return results
+async def asearch_documents(
+    query,
+    engine=DEFAULT_ENGINE,
+    category_slug="documents",
+    prompt=None,
+    k=None,
+    callback=None,
+    use_corrections=True,
+):
+    """
+    This function is the async version of search_documents, for the ASGI
+    deployment: the database, the embedding, the vector search and the LLM are
+    awaited, the blocking anonymization runs in a bounded thread pool
+    (ANONYMIZER_EXECUTOR_WORKERS), so that a process serves many concurrent
+    searches without a thread per request.
 
+    The callback may be an AsyncCallbackHandler, a correction answer is then
+    streamed to it without leaving the event loop.
 
-def query_fastchat(category, query, documents, engine, callback):
-    """
-    This function queries the FastChat model for answers based on the provided query and documents.
+    An engine with a hedge (ENGINE_HEDGES) races with it, see ai.services.execution.
+    With SEARCH_EXTRACTIVE_FALLBACK, when the engines fail on a provider or network
+    error, or do not start to answer within SEARCH_DEADLINE seconds of the start of
+    the search, the answer is extracted from the retrieved chunks and flagged with
+    "fallback".
+
+    With SEARCH_SINGLE_FLIGHT, identical concurrent searches share their retrieval
+    and their answer, see ai.services.single_flight.
 
     Args:
-        category (str): The category of the documents to search.
         query (str): The search query.
-        documents (list): The list of relevant documents.
         engine (str, optional): The search engine to use. Defaults to "gpt-3.5-turbo".
-        callback (function, optional): A callback function to handle the search results. Defaults to None.
+        category_slug (str): The category of the documents to search.
+        callback (BaseCallbackHandler, optional): A callback handler receiving the
+            tokens of the answer. Defaults to None.
+        use_corrections (bool, optional): Answers with the matching correction, if any.
+            Defaults to True.
 
     Returns:
-        dict: A dictionary containing the search results.
-    """
-    # model = "tiiuae/falcon-7b-instruct"
-    model = "lmsys/fastchat-t5-3b-v1.0"
-    tokenizer = AutoTokenizer.from_pretrained(model)
-    pipe = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        # torch_dtype=torch.bfloat16,
-        trust_remote_code=True,
-        device="mps",
-        model_kwargs={
-            # "load_in_8bit": False,
-            "max_length": 512,
-            "temperature": 0.0,
-        },
-    )
-    hf_llm = HuggingFacePipeline(pipeline=pipe)
+        dict: The answer in "result", and the id of the matching correction in
+        "correction_id" when the answer comes from a correction, else the
+        origin, page and score of the documents of the context in "sources".
+    """
+    started_at = time.monotonic()
+    category = await Category.objects.aget(slug=category_slug)
+
+    if use_corrections:
+        correction = await afind_correction(category, query)
+        if correction is not None:
+            if callback is not None and isinstance(callback, AsyncCallbackHandler):
+                await callback.on_llm_new_token(correction.answer)
+                await callback.on_llm_end(
+                    LLMResult(generations=[[Generation(text=correction.answer)]])
+                )
+                callback = None
+            return correction_results(correction, callback)
+
+    # Fails before the retrieval on an unknown engine
+    get_engine(engine)
+    executor = get_executor("anonymizer", settings.ANONYMIZER_EXECUTOR_WORKERS)
+    query = await run_in_executor(executor, get_anonymizer().anonymize, query)
 
-    now = datetime.now()
-    formatted_date_time = now.strftime("%d %B %Y à %H:%M")
+    prompt = category.prompt if prompt is None else prompt
 
-    prompt_template = PromptTemplate(
-        input_variables=["question", "context"], template=category.prompt
-    )
+    if settings.SEARCH_SINGLE_FLIGHT:
+        run = partial(aretrieve_and_answer, category, engine, prompt, query, k, started_at)
+        return await coalesce(flight_key(category, engine, prompt, query, k), run, callback)
+    return await aretrieve_and_answer(category, engine, prompt, query, k, started_at, callback)
 
-    qa = RetrievalQA.from_chain_type(
-        llm=hf_llm,
-        chain_type="stuff",
-        retriever=DocsRetriever(documents=documents),
-    )
-    qa.combine_documents_chain.llm_chain.prompt = prompt_template
 
-    results = qa({"query": query}, return_only_outputs=True)
-    return results
+async def aretrieve_and_answer(category, engine, prompt, query, k, started_at, callback=None):
+    """
+    Async version of retrieve_and_answer.
+    """
+    use_shared_openai_session()
+    document_search = get_document_search(category)
+    documents = await document_search.aget_relevant_documents(query, k=k)
+
+    return await answer_before_deadline(
+        get_engine_plan(engine), prompt, query, documents, callback, started_at
+    )
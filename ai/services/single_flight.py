@@ -0,0 +1,410 @@
+"""
+This module provides the coalescing of identical concurrent searches (single
+flight): the searches of the same anonymized question, in the same category,
+with the same engine and prompt, share one retrieval and one generation.
+
+The first search of a question in a process starts its flight, the following
+ones subscribe to it: they receive the tokens already generated, then the next
+ones, and the results of the flight.
+
+Across processes, the flight of a question is led by the process holding its
+lock in the shared cache. The leader publishes the tokens, coalesced like the
+streamed ones (see TokenCoalescer), and the results to the channel layer group
+of the flight, which the flights of the same question in the other processes
+follow instead of generating. The texts published so far are also kept in the
+shared cache, for the followers joining after the first ones. A follower whose
+leader fails, or stays silent for SEARCH_SINGLE_FLIGHT_TIMEOUT seconds,
+generates the answer itself.
+
+A search cancelled by its session only leaves the flight: the generation goes on
+for the other searches, and is cancelled with the last one.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import Generation, LLMResult
+
+from .aio import TokenCoalescer
+from .correction_service import normalize_query
+from .execution import GenerationCancelled, forward
+
+logger = logging.getLogger("cassandre")
+
+FLIGHT_CACHE_ALIAS = "shared"
+# Keeps the results for the followers joining as the leader finishes
+FLIGHT_RESULT_TTL = 10
+
+_flights = {}
+_flights_lock = threading.Lock()
+# The generations going on after their search left the flight
+_background = set()
+
+
+def flight_key(category, engine, prompt, query, k=None):
+    """
+    Returns the key of the flight of a search.
+
+    Args:
+        category (Category): The category of the documents searched.
+        engine (str): The name of the engine.
+        prompt (str): The prompt template, identified by its hash.
+        query (str): The anonymized query, normalized.
+        k (int, optional): The number of documents retrieved.
+
+    Returns:
+        str: The key.
+    """
+    prompt_version = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+    key = "\n".join([category.slug, engine, prompt_version, str(k), normalize_query(query)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def flight_group(key):
+    """
+    Returns the channel layer group of the flight of a key.
+    """
+    return f"flight_{key}"
+
+
+def lock_key(key):
+    """
+    Returns the cache key of the leader of the flight of a key.
+    """
+    return f"flight_lock_{key}"
+
+
+def result_key(key):
+    """
+    Returns the cache key of the results of the flight of a key.
+    """
+    return f"flight_result_{key}"
+
+
+def tokens_key(key):
+    """
+    Returns the cache key of the texts published so far by the leader of the
+    flight of a key.
+    """
+    return f"flight_tokens_{key}"
+
+
+class Flight:
+    """
+    This class holds the events of a flight in the process, the tokens generated
+    so far and its outcome, and delivers them to its subscribers, which may run
+    on different threads and event loops.
+
+    The events are ("token", text), then ("end", results), ("error", exception)
+    or ("cancelled", None).
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.tokens = []
+        self.outcome = None
+        self.muted = False
+        self.subscribers = set()
+        self.relay = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, relay=False):
+        """
+        This method returns a subscriber of the flight, whose queue receives the
+        tokens already generated, then the next events.
+
+        Args:
+            relay (bool): Subscribes the relay of the events to the other processes,
+                which does not keep the generation going.
+        """
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self.lock:
+            for token in self.tokens:
+                subscriber[1].put_nowait(("token", token))
+            if self.outcome is not None:
+                subscriber[1].put_nowait(self.outcome)
+            if relay:
+                self.relay = subscriber
+            else:
+                self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        This method removes a subscriber and returns the number of subscribers left.
+        """
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            return len(self.subscribers)
+
+    def publish(self, event):
+        """
+        This method delivers an event to the subscribers, from any thread.
+        """
+        with self.lock:
+            if event[0] == "token":
+                if self.muted:
+                    return
+                self.tokens.append(event[1])
+            else:
+                self.outcome = event
+            subscribers = list(self.subscribers)
+            if self.relay is not None:
+                subscribers.append(self.relay)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                # The event loop of the subscriber ended
+                pass
+
+
+class FlightCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler publishing the tokens of the generation of a flight. It is
+    called inline, from the event loop or from the thread of the generation, and
+    aborts the generations running in a thread once their flight was cancelled.
+    """
+
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, flight):
+        super().__init__()
+        self.flight = flight
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.flight.outcome is not None:
+            raise GenerationCancelled(self.flight.key)
+        self.flight.publish(("token", token))
+
+
+async def relay(flight, layer):
+    """
+    Publishes the events of the flight led by the process to its channel layer
+    group, until its outcome.
+    """
+    cache = caches[FLIGHT_CACHE_ALIAS]
+    group = flight_group(flight.key)
+    queue = flight.subscribe(relay=True)[1]
+    sent = []
+
+    async def send(text):
+        sent.append(text)
+        # Cached first: a follower joining the group meanwhile skips the text
+        await cache.aset(tokens_key(flight.key), sent, settings.SEARCH_SINGLE_FLIGHT_TIMEOUT)
+        await layer.group_send(
+            group, {"type": "flight.token", "token": text, "index": len(sent) - 1}
+        )
+
+    coalescer = TokenCoalescer(
+        send, settings.STREAMING_FLUSH_INTERVAL_MS / 1000, settings.STREAMING_FLUSH_CHARS
+    )
+    try:
+        while True:
+            kind, value = await queue.get()
+            if kind == "token":
+                await coalescer.add(value)
+                continue
+            if kind == "end":
+                await coalescer.flush()
+                await cache.aset(result_key(flight.key), value, FLIGHT_RESULT_TTL)
+                await layer.group_send(group, {"type": "flight.end", "results": value})
+            else:
+                await layer.group_send(group, {"type": "flight.error"})
+            return
+    finally:
+        coalescer.discard()
+
+
+async def follow(flight, layer):
+    """
+    Follows the flight led by another process, publishing its events.
+
+    Returns:
+        bool: True if the flight ended, False if its leader failed, stayed silent or
+        is gone.
+    """
+    cache = caches[FLIGHT_CACHE_ALIAS]
+    group = flight_group(flight.key)
+    channel = await layer.new_channel()
+    await layer.group_add(group, channel)
+    try:
+        # The leader may have ended before the subscription
+        results = await cache.aget(result_key(flight.key))
+        if results is None and await cache.aget(lock_key(flight.key)) is None:
+            return False
+        # The texts published before the subscription
+        received = 0
+        if results is None:
+            for text in await cache.aget(tokens_key(flight.key)) or []:
+                flight.publish(("token", text))
+                received += 1
+        while results is None:
+            try:
+                message = await asyncio.wait_for(
+                    layer.receive(channel), settings.SEARCH_SINGLE_FLIGHT_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                logger.warning("The leader of the flight %s stayed silent", flight.key)
+                return False
+            if message["type"] == "flight.token":
+                if message["index"] < received:
+                    continue
+                flight.publish(("token", message["token"]))
+                received = message["index"] + 1
+            elif message["type"] == "flight.end":
+                results = message["results"]
+            else:
+                return False
+    finally:
+        await layer.group_discard(group, channel)
+    flight.publish(("end", results))
+    return True
+
+
+async def release(key, leader_id):
+    """
+    Releases the lock of the flight of a key, if the leader still holds it.
+    """
+    cache = caches[FLIGHT_CACHE_ALIAS]
+    if await cache.aget(lock_key(key)) == leader_id:
+        await cache.adelete(lock_key(key))
+
+
+async def fly(flight, run):
+    """
+    Produces the events of a flight: follows its leader in another process, or
+    leads it and generates the answer.
+    """
+    layer = get_channel_layer()
+    cache = caches[FLIGHT_CACHE_ALIAS]
+    leader_id = uuid.uuid4().hex
+    locked = False
+    relay_task = None
+    outcome = ("cancelled", None)
+    try:
+        if layer is not None:
+            for _ in range(2):
+                locked = await cache.aadd(
+                    lock_key(flight.key), leader_id, settings.SEARCH_SINGLE_FLIGHT_TIMEOUT
+                )
+                if locked:
+                    break
+                if await follow(flight, layer):
+                    return
+                if flight.tokens:
+                    # The answer is generated again, only its results are delivered
+                    flight.muted = True
+        if locked:
+            relay_task = asyncio.create_task(relay(flight, layer))
+
+        try:
+            outcome = ("end", await run(FlightCallbackHandler(flight)))
+        except Exception as error:  # pylint: disable=broad-except
+            outcome = ("error", error)
+    finally:
+        with _flights_lock:
+            if _flights.get(flight.key) is flight:
+                del _flights[flight.key]
+        if flight.outcome is None:
+            flight.publish(outcome)
+        # The followers retry at once when the leader fails, after it ends otherwise
+        ended = flight.outcome[0] == "end"
+        if locked and not ended:
+            await release(flight.key, leader_id)
+        if relay_task is not None:
+            await asyncio.wait([relay_task])
+        if locked and ended:
+            await release(flight.key, leader_id)
+
+
+async def subscribe(flight, callback):
+    """
+    Forwards the events of a flight to the callback handler of a search.
+
+    Returns:
+        dict: The results of the flight, None if the flight was cancelled.
+
+    Raises:
+        GenerationCancelled: If the search was cancelled.
+        Exception: The error of the flight.
+    """
+    subscriber = flight.subscribe()
+    # The events are forwarded as those of a run of the search
+    run_id = uuid.uuid4()
+    try:
+        while True:
+            kind, value = await subscriber[1].get()
+            if kind == "token":
+                await forward(callback, "on_llm_new_token", value, run_id=run_id)
+            elif kind == "end":
+                response = LLMResult(generations=[[Generation(text=value["result"])]])
+                await forward(callback, "on_llm_end", response, run_id=run_id)
+                return dict(value)
+            elif kind == "error":
+                await forward(callback, "on_llm_error", value, run_id=run_id)
+                raise value
+            else:
+                return None
+    finally:
+        flight.unsubscribe(subscriber)
+
+
+async def coalesce(key, run, callback=None, detached=True):
+    """
+    Answers a search with the flight of its key, started by the search if there
+    is none in flight in the process.
+
+    Args:
+        key (str): The key of the flight, see flight_key.
+        run (coroutine function): Retrieves the documents and answers the search,
+            given the callback handler of the generation.
+        callback (BaseCallbackHandler, optional): Receives the tokens of the answer.
+        detached (bool): When the search starting the flight leaves it before the
+            others, the generation goes on in the background. False waits for the
+            generation instead, for the event loops ending with the search
+            (async_to_sync).
+
+    Returns:
+        dict: The results of the flight.
+    """
+    while True:
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = Flight(key)
+        if leader:
+            return await lead(flight, run, callback, detached)
+
+        logger.info("Search coalesced into the flight %s", key)
+        results = await subscribe(flight, callback)
+        if results is not None:
+            return results
+        # The flight was cancelled as the search joined it
+
+
+async def lead(flight, run, callback, detached):
+    """
+    Starts the flight of a search and answers the search with it.
+    """
+    task = asyncio.create_task(fly(flight, run))
+    try:
+        return await subscribe(flight, callback)
+    finally:
+        if not task.done():
+            if flight.outcome is None and not flight.subscribers:
+                task.cancel()
+                await asyncio.wait([task])
+            elif detached:
+                _background.add(task)
+                task.add_done_callback(_background.discard)
+            else:
+                await asyncio.wait([task])
@@ -1,30 +1,305 @@
+import asyncio
+import os
+import threading
+import uuid
+import weakref
 
 import qdrant_client
 from django.conf import settings
-from langchain.vectorstores import Qdrant
+from django.dispatch import Signal
+from qdrant_client.http import models
 
 from .embedding import get_embedding
+from .embedding_cache import embed_documents, embed_missing
 
+# Sent with the collection_name argument once a collection has been rebuilt
+collection_updated = Signal()
 
-def create_collection(collection_name, texts):
+# Namespace of the deterministic ids of the points
+POINT_ID_NAMESPACE = uuid.UUID("8a4e0e1c-3a53-4c8e-9a0f-0c6c1e5b7d21")
+# Payload fields identifying the origin of the points, indexed by the collections
+DOCUMENT_ID_FIELD = "document_id"
+CORRECTION_ID_FIELD = "correction_id"
+SCROLL_BATCH_SIZE = 256
+
+_clients = {}
+_clients_lock = threading.Lock()
+# The async gRPC channels are bound to their event loop
+_async_clients = weakref.WeakKeyDictionary()
+# The batches of a document are upserted concurrently
+_collections_lock = threading.Lock()
+
+
+def get_qdrant_client(url=None):
+    """
+    Returns the long-lived Qdrant client of the current process for the given URL.
+    The gRPC channel of the client is opened once and reused by every search.
+
+    Parameters:
+        url (str, optional): The URL of the Qdrant server. Defaults to QDRANT_URL.
+
+    Returns:
+        QdrantClient: The shared client.
+    """
+    url = url or settings.QDRANT_URL
+    key = (url, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                # gRPC channels must not be shared with a forked child process
+                for stale_key in [k for k in _clients if k[1] != os.getpid()]:
+                    del _clients[stale_key]
+                client = qdrant_client.QdrantClient(url=url, prefer_grpc=True)
+                _clients[key] = client
+    return client
+
+
+def get_async_qdrant_client(url=None):
     """
-    Create a collection with the given name and texts.
+    Returns the Qdrant client of the running event loop, whose async gRPC channel
+    is reused by the searches of the loop. The channel of a client cannot be used
+    from another loop, and the loops of async_to_sync end with their call.
 
     Parameters:
-        collection_name (str): The name of the collection to be created.
-        texts (List[str]): A list of texts to be added to the collection.
+        url (str, optional): The URL of the Qdrant server. Defaults to QDRANT_URL.
 
     Returns:
-        None
-    """
-    embeddings = get_embedding()
-    url = settings.QDRANT_URL
-    client = qdrant_client.QdrantClient(url=url, prefer_grpc=True)
-    client.delete_collection(collection_name)
-    Qdrant.from_documents(
-        documents=texts,
-        embedding=embeddings,
-        url=url,
-        prefer_grpc=True,
-        collection_name=collection_name,
+        QdrantClient: The client of the loop.
+    """
+    url = url or settings.QDRANT_URL
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(url)
+        if client is None:
+            client = qdrant_client.QdrantClient(url=url, prefer_grpc=True)
+            clients[url] = client
+    return client
+
+
+def clear_clients():
+    """
+    Drops the Qdrant clients of the current process, new ones are opened on next use.
+    """
+    with _clients_lock:
+        _clients.clear()
+        _async_clients.clear()
+
+
+def get_point_id(*parts):
+    """
+    Returns the deterministic id of a point, from the parts identifying it.
+    """
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, "/".join(str(part) for part in parts)))
+
+
+def collection_exists(collection_name):
+    """
+    Returns True if the collection exists.
+    """
+    collections = get_qdrant_client().get_collections().collections
+    return any(collection.name == collection_name for collection in collections)
+
+
+def get_version_name(alias, version):
+    """
+    Returns the name of a version of the collection served by an alias.
+    """
+    return f"{alias}__v{version}"
+
+
+def get_alias_target(alias):
+    """
+    Returns the name of the collection served by an alias, None if there is no
+    such alias.
+    """
+    aliases = get_qdrant_client().get_aliases().aliases
+    return next((item.collection_name for item in aliases if item.alias_name == alias), None)
+
+
+def switch_alias(alias, collection_name):
+    """
+    Makes an alias serve the given collection, atomically: the searches through
+    the alias use the previous collection until they use the new one.
+
+    A collection named like the alias (built before the versioned collections)
+    is deleted first, the alias taking its name.
+    """
+    client = get_qdrant_client()
+    operations = []
+    if get_alias_target(alias) is not None:
+        operations.append(
+            models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=alias))
+        )
+    elif collection_exists(alias):
+        client.delete_collection(alias)
+    operations.append(
+        models.CreateAliasOperation(
+            create_alias=models.CreateAlias(collection_name=collection_name, alias_name=alias)
+        )
+    )
+    client.update_collection_aliases(change_aliases_operations=operations)
+    collection_updated.send(sender=switch_alias, collection_name=alias)
+
+
+def count_points(collection_name):
+    """
+    Returns the exact number of points of the collection.
+    """
+    return get_qdrant_client().count(collection_name, exact=True).count
+
+
+def get_vector_size():
+    """
+    Returns the size of the embeddings of the embedding model.
+    """
+    return len(get_embedding().embed_query("vector size"))
+
+
+def ensure_collection(collection_name, vector_size):
+    """
+    Creates the collection, with the payload indexes on the origin of its points,
+    if it does not exist.
+
+    Parameters:
+        collection_name (str): The name of the collection.
+        vector_size (int): The size of the embeddings.
+    """
+    if collection_exists(collection_name):
+        return
+    with _collections_lock:
+        if collection_exists(collection_name):
+            return
+        client = get_qdrant_client()
+        client.create_collection(
+            collection_name,
+            vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.COSINE),
+        )
+        for field_name in (DOCUMENT_ID_FIELD, CORRECTION_ID_FIELD):
+            client.create_payload_index(
+                collection_name, field_name, field_schema=models.PayloadSchemaType.INTEGER
+            )
+
+
+def upsert_texts(collection_name, texts, point_ids, fields, stored=None):
+    """
+    Embeds the texts (only those never embedded before, see
+    embedding_cache.embed_documents) and upserts them with the given ids, in the
+    payload format of the langchain Qdrant vector store. The collection is created
+    on the first texts.
+
+    Parameters:
+        collection_name (str): The name of the collection.
+        texts (List[Document]): The chunks to upsert.
+        point_ids (List[str]): The ids of their points.
+        fields (List[dict]): The payload fields identifying the origin of each chunk.
+        stored (dict, optional): The stored embeddings of the texts, looked up by
+            the caller (see embedding_cache.get_stored_embeddings): the texts are
+            then upserted without querying the database, e.g. in another thread.
+
+    Returns:
+        list: The new embeddings to store (see embedding_cache.store_embeddings)
+        when the stored embeddings are given, else an empty list.
+    """
+    if not texts:
+        return []
+    contents = [text.page_content for text in texts]
+    new_embeddings = []
+    if stored is None:
+        vectors = embed_documents(contents)
+    else:
+        vectors, new_embeddings = embed_missing(contents, stored)
+    ensure_collection(collection_name, len(vectors[0]))
+    points = [
+        models.PointStruct(
+            id=point_id,
+            vector=vector,
+            payload={"page_content": text.page_content, "metadata": text.metadata, **origin},
+        )
+        for point_id, text, vector, origin in zip(point_ids, texts, vectors, fields)
+    ]
+    get_qdrant_client().upsert(collection_name, points=points)
+    return new_embeddings
+
+
+def delete_points(collection_name, point_ids):
+    """
+    Deletes the points of the given ids.
+    """
+    if not point_ids:
+        return
+    get_qdrant_client().delete(
+        collection_name, points_selector=models.PointIdsList(points=list(point_ids))
+    )
+
+
+def origin_filter(field, keep=()):
+    """
+    Returns the filter of the points having the given origin field, except those
+    of the given values.
+    """
+    return models.Filter(
+        must=[models.FieldCondition(key=field, range=models.Range(gte=0))],
+        must_not=[models.FieldCondition(key=field, match=models.MatchAny(any=list(keep)))]
+        if keep
+        else None,
+    )
+
+
+def get_point_ids(collection_name, field):
+    """
+    Returns the ids of the points having the given origin field.
+    """
+    client = get_qdrant_client()
+    point_ids = set()
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name,
+            scroll_filter=origin_filter(field),
+            limit=SCROLL_BATCH_SIZE,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        point_ids.update(str(point.id) for point in points)
+        if offset is None:
+            return point_ids
+
+
+def delete_other_points(collection_name, field, keep):
+    """
+    Deletes the points having the given origin field, except those of the given
+    values (e.g. the points of the deleted documents).
+
+    Returns:
+        int: The number of deleted points.
+    """
+    client = get_qdrant_client()
+    points_filter = origin_filter(field, keep)
+    count = client.count(collection_name, count_filter=points_filter, exact=True).count
+    if count:
+        client.delete(
+            collection_name, points_selector=models.FilterSelector(filter=points_filter)
+        )
+    return count
+
+
+def delete_document_points(collection_name, document_id, keep):
+    """
+    Deletes the points of a document, except those of the given ids (e.g. the
+    points of its chunks which are gone).
+    """
+    points_filter = models.Filter(
+        must=[
+            models.FieldCondition(
+                key=DOCUMENT_ID_FIELD, match=models.MatchValue(value=document_id)
+            )
+        ],
+        must_not=[models.HasIdCondition(has_id=list(keep))] if keep else None,
+    )
+    get_qdrant_client().delete(
+        collection_name, points_selector=models.FilterSelector(filter=points_filter)
     )
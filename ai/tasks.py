@@ -4,56 +4,119 @@ from django.conf import settings
 from requests.auth import HTTPBasicAuth
 
 from ai.services import index_service, search_service
+from ai.services.engines import DEFAULT_ENGINE
+from chat.streaming import (
+    GenerationCancelled,
+    SyncStreamingCallbackHandler,
+    end_message,
+    send_end,
+)
 
 
-@shared_task
-def index_documents():
+def report_progress(task):
+    """
+    Returns the progress callback of the indexing which stores the progress of
+    the task in its "PROGRESS" state.
+    """
+
+    def progress(category, done, total):
+        if task.request.id is None:
+            # The task is called directly
+            return
+        task.update_state(
+            state="PROGRESS", meta={"category": category.slug, "done": done, "total": total}
+        )
+
+    return progress
+
+
+@shared_task(bind=True)
+def index_documents(self):
     """
     This function indexes the documents.
     """
-    index_service.index_documents()
+    index_service.index_documents(progress=report_progress(self))
 
 
-@shared_task
-def index_documents_in_category(category_id):
+@shared_task(bind=True)
+def index_documents_in_category(self, category_id):
     """
     Indexes the documents in the specified category.
 
     Args:
         category_id (int): The ID of the category whose documents should be indexed.
     """
-    index_service.index_documents(category_id)
+    index_service.index_documents(category_id, progress=report_progress(self))
 
 
 @shared_task
-def async_search(callback_url, query, category_slug, engine="gpt-3.5-turbo"):
+def async_search(
+    callback_url,
+    query,
+    category_slug,
+    engine=DEFAULT_ENGINE,
+    session_id=None,
+    generation_id=None,
+):
     """
-    This function performs an asynchronous search operation.
-    It takes in a callback URL, a query, a category slug, and an engine type.
-    It then uses these parameters to perform a chat operation using the
-    specified chat service. The result of the chat operation is then sent
-    to the callback URL.
+    This function performs an asynchronous search operation, routed to the
+    "interactive" queue. Its results are:
+
+    - sent to the callback URL, if any;
+    - streamed to the websocket of the session, if any: the tokens of the
+      answer, then an "end" message with the answer and its sources;
+    - stored in the result backend otherwise.
+
+    The parameters keep the order of the first version of the task, for the
+    messages queued by its producers.
 
     Args:
-        callback_url (str): The URL to which the result of the chat operation will be sent.
+        callback_url (str): The URL to which the result of the chat operation will be
+          sent, None for the searches of a session.
         query (str): The query to be used in the chat operation.
         category_slug (str): The slug of the category to be used in the chat operation.
         engine (str, optional): The type of engine to be used in the chat operation.
           Defaults to "gpt-3.5-turbo".
+        session_id (str, optional): The search session whose websocket receives the answer.
+        generation_id (str, optional): The generation of the session, aborted when the
+          session asks another question or disconnects.
 
     Returns:
-        tuple: A tuple containing the status code and text of the response from the callback URL.
+        tuple: The status code and the text of the response of the callback URL, if
+        any. dict: The answer in "result", with its "correction_id" and "sources",
+        or "cancelled" when the generation was cancelled, otherwise.
     """
+    callback = None
+    if session_id:
+        callback = SyncStreamingCallbackHandler(session_id, generation_id=generation_id)
 
-    username = settings.PUBLIK_USERNAME
-    password = settings.PUBLIK_PASSWORD
+    try:
+        results = search_service.search_documents(
+            query=query, engine=engine, category_slug=category_slug, callback=callback
+        )
+    except GenerationCancelled:
+        return {"cancelled": True}
+    except Exception:
+        if session_id:
+            send_end(session_id, {"type": "error", "errors": {"message": "The search failed"}})
+        raise
 
-    result = search_service.search_documents(
-        query=query, engine=engine, category_slug=category_slug
-    )
+    result = {
+        "result": results["result"],
+        "correction_id": results.get("correction_id"),
+        "sources": results.get("sources", []),
+    }
+    if results.get("fallback"):
+        result["fallback"] = True
+    if session_id:
+        send_end(session_id, end_message(result))
 
-    response = requests.post(
-        callback_url, json=result, auth=HTTPBasicAuth(username, password), timeout=3600
-    )
+    if callback_url:
+        username = settings.PUBLIK_USERNAME
+        password = settings.PUBLIK_PASSWORD
+        response = requests.post(
+            callback_url, json=results, auth=HTTPBasicAuth(username, password), timeout=3600
+        )
+        return response.status_code, response.text
 
-    return response.status_code, response.text
+    return result
@@ -1,9 +1,22 @@
 # pylint: disable=missing-docstring
 # pylint: disable=line-too-long
 
+import os
+import threading
 import unittest
+from unittest.mock import MagicMock, patch
 
-from ai.services.anonymize_service import Anonymizer
+from ai.services.anonymize_service import (
+    Anonymizer,
+    MicroBatcher,
+    NamePrescreen,
+    Redaction,
+    RedactionResult,
+    apply_redactions,
+    find_entity_spans,
+    find_pattern_spans,
+    load_ner_model,
+)
 
 
 class TestAnonymizer(unittest.TestCase):
@@ -72,3 +85,173 @@ class TestAnonymizer(unittest.TestCase):
         text = "Vous pouvez également me joindre au 0123456789"
         anonymized_text = self.anonymizer.anonymize(text)
         self.assertEqual(anonymized_text, "Vous pouvez également me joindre au CONFIDENTIEL")
+
+    def test_anonymize_many(self):
+        texts = [
+            "Bonjour, je m'appelle John Doe, mon numen est le 46G9987654XYZ",
+            "Il n'y a rien à anonymiser ici",
+            "Appelez-moi au 01 23 45 67 89 ou écrivez à foo@bar.com",
+        ]
+        anonymized_texts = self.anonymizer.anonymize_many(texts, batch_size=2)
+        self.assertEqual(
+            anonymized_texts, [self.anonymizer.anonymize(text) for text in texts]
+        )
+        self.assertEqual(self.anonymizer.anonymize_many([]), [])
+
+    def test_redact_reports_offsets(self):
+        text = "Bonjour, je m'appelle John Doe, mon email est foo@bar.com"
+        result = self.anonymizer.redact(text)
+        self.assertEqual(result.text, self.anonymizer.anonymize(text))
+        for redaction in result.redactions:
+            self.assertEqual(text[redaction.start : redaction.end], redaction.text)
+        self.assertIn("email", [redaction.label for redaction in result.redactions])
+
+    def test_prescreen_skips_ner_without_changing_output(self):
+        texts = [
+            "Quelles sont les dates du mouvement inter-académique ?",
+            "Mon numéro INSEE est 198012301234567, mon email est foo@bar.com",
+            "Bonjour, je m'appelle John Doe",
+        ]
+        expected = [self.anonymizer.anonymize(text) for text in texts]
+
+        self.anonymizer.prescreen = NamePrescreen(["john"])
+        with patch.object(self.anonymizer, "nlp", wraps=self.anonymizer.nlp) as nlp:
+            self.assertEqual(self.anonymizer.anonymize_many(texts), expected)
+        nlp.assert_called_once()
+        self.assertEqual(nlp.call_args.args[0], [texts[2]])
+        self.assertEqual(self.anonymizer.prescreen.stats()["skipped"], 2)
+
+
+FIRST_NAMES_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "data", "first_names.txt"
+)
+
+
+class TestNamePrescreen(unittest.TestCase):
+    def setUp(self):
+        self.prescreen = NamePrescreen.from_file(FIRST_NAMES_FILE)
+
+    def test_questions_without_names_are_skipped(self):
+        for text in [
+            "quelles sont les dates du mouvement inter-académique ?",
+            "Quelles sont les dates du mouvement inter-académique ?",
+            "Comment est calculé le SFT ? Mon NUMEN est 46G9987654XYZ",
+            "Je suis affecté au rectorat, que puis-je faire ?",
+            "Existe-t-il une prime ? Puis-je la demander ?",
+        ]:
+            self.assertFalse(self.prescreen.has_candidates(text), text)
+
+    def test_texts_with_names_are_kept(self):
+        for text in [
+            "Jean Pierre habite à Paris",
+            "bonjour, je suis jérôme et je veux muter",
+            "Bien cordialement, Fatiah BENBARKA",
+            "je m'appelle dupont",
+            "Dupont a demandé sa mutation",
+        ]:
+            self.assertTrue(self.prescreen.has_candidates(text), text)
+
+    def test_stats(self):
+        self.prescreen.has_candidates("quelles sont les dates ?")
+        self.prescreen.has_candidates("Jean habite ici")
+        self.assertEqual(
+            self.prescreen.stats(), {"checked": 2, "skipped": 1, "skip_rate": 0.5}
+        )
+
+
+class TestRedactionEngine(unittest.TestCase):
+    def test_pattern_spans(self):
+        text = "Appelez le 01 23 45 67 89, numen 46G9987654XYZ, INSEE 198012301234567"
+        spans = find_pattern_spans(text)
+        self.assertEqual([span.label for span in spans], ["phone", "numen", "insee"])
+        for span in spans:
+            self.assertEqual(text[span.start : span.end], span.text)
+
+    def test_email_wins_over_numbers(self):
+        text = "écrivez à 198012301234567@example.org svp"
+        result = apply_redactions(text, find_pattern_spans(text))
+        self.assertEqual(result.text, "écrivez à private@example.com svp")
+        self.assertEqual([span.label for span in result.redactions], ["email"])
+
+    def test_overlapping_entity_and_pattern(self):
+        text = "contact: jean.dupont@example.org"
+        entity = Redaction(9, 20, "PER", "jean.dupont", "Madame/Monsieur")
+        result = apply_redactions(text, find_pattern_spans(text) + [entity])
+        self.assertEqual(result.text, "contact: private@example.com")
+
+    def test_longest_entity_wins(self):
+        text = "Jean Pierre et Jean"
+        spans = [
+            Redaction(0, 4, "PER", "Jean", "Madame/Monsieur"),
+            Redaction(15, 19, "PER", "Jean", "Madame/Monsieur"),
+            Redaction(0, 11, "PER", "Jean Pierre", "Madame/Monsieur"),
+        ]
+        result = apply_redactions(text, spans)
+        self.assertEqual(result.text, "Madame/Monsieur et Madame/Monsieur")
+        self.assertEqual([(span.start, span.end) for span in result.redactions], [(0, 11), (15, 19)])
+
+    def test_no_redaction(self):
+        text = "Il n'y a rien à anonymiser ici"
+        self.assertEqual(apply_redactions(text, find_pattern_spans(text)), (text, []))
+
+    def test_only_the_names_of_the_text_are_redacted(self):
+        text = "Mme Martin habite rue Martin à Lyon"
+        entities = [
+            {"entity_group": "PER", "word": "Martin"},
+            {"entity_group": "LOC", "word": "Lyon"},
+        ]
+        result = apply_redactions(text, find_entity_spans(text, entities))
+        self.assertEqual(result.text, "Mme Madame/Monsieur habite rue Madame/Monsieur à Lyon")
+
+        # A name of a previous text is not a name of this one
+        text = "Je travaille à Martin"
+        entities = [{"entity_group": "LOC", "word": "Martin"}]
+        self.assertEqual(find_entity_spans(text, entities), [])
+
+
+class TestNerBackends(unittest.TestCase):
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            load_ner_model("some-model", backend="tensorrt")
+
+    def test_onnx_requires_model_path(self):
+        with self.assertRaises(ValueError):
+            load_ner_model("some-model", backend="onnx")
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def setUp(self):
+        self.anonymizer = MagicMock()
+        self.anonymizer.redact_many.side_effect = lambda texts: [
+            RedactionResult(text.upper(), []) for text in texts
+        ]
+
+    def test_concurrent_calls_are_batched(self):
+        batcher = MicroBatcher(self.anonymizer, max_batch_size=8, max_wait_ms=200)
+        results = {}
+
+        def anonymize(text):
+            results[text] = batcher.anonymize(text)
+
+        threads = [
+            threading.Thread(target=anonymize, args=(f"texte {i}",)) for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {f"texte {i}": f"TEXTE {i}" for i in range(4)})
+        self.assertLess(self.anonymizer.redact_many.call_count, 4)
+
+    def test_batch_size_is_bounded(self):
+        batcher = MicroBatcher(self.anonymizer, max_batch_size=1, max_wait_ms=50)
+        self.assertEqual(batcher.anonymize("a"), "A")
+        self.assertEqual(batcher.anonymize("b"), "B")
+        self.assertEqual(self.anonymizer.redact_many.call_count, 2)
+
+    def test_errors_are_propagated(self):
+        self.anonymizer.redact_many.side_effect = RuntimeError("boom")
+        batcher = MicroBatcher(self.anonymizer, max_wait_ms=1)
+        with self.assertRaises(RuntimeError):
+            batcher.anonymize("texte")
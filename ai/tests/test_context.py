@@ -0,0 +1,76 @@
+# pylint: disable=missing-docstring
+import unittest
+from unittest.mock import MagicMock, patch
+
+from django.test import override_settings
+from langchain.schema import Document
+
+from ai.services.context import (
+    CHUNK_OVERHEAD_TOKENS,
+    add_token_counts,
+    pack_context,
+    pack_documents,
+)
+
+
+def chunk(text, score, token_count=None):
+    metadata = {"score": score}
+    if token_count is not None:
+        metadata["token_count"] = token_count
+    return Document(page_content=text, metadata=metadata)
+
+
+class TestContextPacking(unittest.TestCase):
+    def setUp(self):
+        # One token per word
+        encoding = MagicMock()
+        encoding.encode.side_effect = lambda text: text.split()
+        patcher = patch("ai.services.context.get_token_encoding", return_value=encoding)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_add_token_counts_copies_shared_metadata(self):
+        metadata = {"page": 1}
+        docs = [
+            Document(page_content="un deux trois", metadata=metadata),
+            Document(page_content="quatre", metadata=metadata),
+        ]
+        add_token_counts(docs)
+        self.assertEqual([doc.metadata["token_count"] for doc in docs], [3, 1])
+        self.assertEqual(metadata, {"page": 1})
+
+    def test_pack_documents_by_score(self):
+        overhead = CHUNK_OVERHEAD_TOKENS
+        docs = [
+            chunk("a", 0.81, token_count=100),
+            chunk("b", 0.95, token_count=300),
+            chunk("c", 0.90, token_count=50),
+        ]
+        selected, used, dropped = pack_documents(docs, budget=200 + 2 * overhead)
+
+        self.assertEqual([doc.page_content for doc in selected], ["c", "a"])
+        self.assertEqual(used, 150 + 2 * overhead)
+        self.assertEqual(dropped, 1)
+
+    def test_missing_token_count_is_computed(self):
+        selected, used, dropped = pack_documents([chunk("un deux", 0.9)], budget=100)
+        self.assertEqual(len(selected), 1)
+        self.assertEqual(used, 2 + CHUNK_OVERHEAD_TOKENS)
+        self.assertEqual(dropped, 0)
+
+    @override_settings(CONTEXT_ANSWER_TOKENS=500, CONTEXT_MAX_TOKENS=None)
+    def test_pack_context_uses_engine_window(self):
+        docs = [chunk(str(i), 0.9, token_count=400) for i in range(5)]
+        context = pack_context(2048, "Contexte: {context} Question: {question}", "congés", docs)
+
+        # 2048 - 5 prompt tokens - 500 answer tokens leaves room for 3 chunks
+        self.assertEqual(context.prompt_tokens, 5)
+        self.assertEqual(len(context.documents), 3)
+        self.assertEqual(context.context_tokens, 3 * (400 + CHUNK_OVERHEAD_TOKENS))
+        self.assertEqual(context.dropped, 2)
+
+    @override_settings(CONTEXT_ANSWER_TOKENS=500, CONTEXT_MAX_TOKENS=1000)
+    def test_pack_context_max_tokens(self):
+        docs = [chunk(str(i), 0.9, token_count=400) for i in range(5)]
+        context = pack_context(8192, "{context} {question}", "congés", docs)
+        self.assertEqual(len(context.documents), 2)
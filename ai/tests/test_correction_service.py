@@ -0,0 +1,58 @@
+# pylint: disable=missing-docstring
+from django.test import TestCase
+
+from ai.services.correction_service import (
+    afind_correction,
+    clear_corrections,
+    find_correction,
+    normalize_query,
+)
+from documents.models import Category, Correction
+
+
+class TestCorrectionService(TestCase):
+    def setUp(self):
+        clear_corrections()
+        self.category = Category.objects.create(name="Mutations")
+        self.correction = Correction.objects.create(
+            category=self.category,
+            query="Quelle est la date limite de mutation ?",
+            answer="Le 15 décembre.",
+        )
+
+    def test_normalize_query(self):
+        self.assertEqual(
+            normalize_query("  Quelle est la  DATE limite de mutation ?"),
+            "quelle est la date limite de mutation",
+        )
+        self.assertEqual(normalize_query("l'année"), "l année")
+
+    def test_exact_and_normalized_matches(self):
+        for query in (
+            "Quelle est la date limite de mutation ?",
+            "quelle est la date limite de mutation",
+            "Quelle est la date limite de mutation?!",
+        ):
+            match = find_correction(self.category, query)
+            self.assertEqual(match, (self.correction.id, "Le 15 décembre."))
+
+    def test_no_match(self):
+        self.assertIsNone(find_correction(self.category, "Quand ont lieu les mutations ?"))
+        other = Category.objects.create(name="Congés")
+        self.assertIsNone(find_correction(other, "Quelle est la date limite de mutation ?"))
+
+    def test_cache_is_invalidated(self):
+        find_correction(self.category, "Quelle est la date limite de mutation ?")
+
+        self.correction.answer = "Le 20 décembre."
+        self.correction.save()
+        match = find_correction(self.category, "quelle est la date limite de mutation")
+        self.assertEqual(match.answer, "Le 20 décembre.")
+
+        self.correction.delete()
+        self.assertIsNone(find_correction(self.category, "quelle est la date limite de mutation"))
+
+    async def test_async_lookup(self):
+        match = await afind_correction(self.category, "quelle est la date limite de mutation")
+        self.assertEqual(match, (self.correction.id, "Le 15 décembre."))
+        self.assertIsNone(await afind_correction(self.category, "Quand ?"))
@@ -0,0 +1,134 @@
+# pylint: disable=missing-docstring
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from ai.models import ChunkEmbedding
+from ai.services.embedding_cache import (
+    CachedEmbeddings,
+    decode_vector,
+    embed_documents,
+    embed_missing,
+    encode_vector,
+    get_stored_embeddings,
+    store_embeddings,
+)
+
+
+class TestCachedEmbeddings(unittest.TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.embeddings = MagicMock()
+        self.embeddings.model = "text-embedding-ada-002"
+        self.embeddings.embed_query.side_effect = lambda text: [0.5, float(len(text))]
+
+    def test_vector_round_trip(self):
+        self.assertEqual(decode_vector(encode_vector([0.25, -1.0, 3.0])), [0.25, -1.0, 3.0])
+        self.assertEqual(len(encode_vector([0.1] * 1536)), 1536 * 4)
+
+    def test_local_then_shared_hits(self):
+        cached = CachedEmbeddings(self.embeddings, cache_alias="default")
+        self.assertEqual(cached.embed_query("congé  maladie"), [0.5, 14.0])
+        self.assertEqual(cached.embed_query(" congé maladie "), [0.5, 14.0])
+
+        # A new process only shares the second tier
+        other = CachedEmbeddings(self.embeddings, cache_alias="default")
+        self.assertEqual(other.embed_query("congé maladie"), [0.5, 14.0])
+
+        self.embeddings.embed_query.assert_called_once_with("congé  maladie")
+        self.assertEqual(cached.stats()["local_hits"], 1)
+        self.assertEqual(other.stats()["shared_hits"], 1)
+        self.assertEqual(cached.stats()["misses"], 1)
+
+    def test_models_do_not_share_entries(self):
+        other_model = MagicMock()
+        other_model.model = "other-model"
+        other_model.embed_query.return_value = [1.0]
+
+        CachedEmbeddings(self.embeddings, cache_alias="default").embed_query("congé")
+        vector = CachedEmbeddings(other_model, cache_alias="default").embed_query("congé")
+
+        self.assertEqual(vector, [1.0])
+        other_model.embed_query.assert_called_once_with("congé")
+
+    def test_lru_eviction(self):
+        cached = CachedEmbeddings(self.embeddings, cache_alias="default", max_size=2)
+        for text in ("a", "b", "c"):
+            cached.embed_query(text)
+        caches["default"].clear()
+
+        cached.embed_query("c")
+        cached.embed_query("a")
+        self.assertEqual(self.embeddings.embed_query.call_count, 4)
+
+    def test_documents_are_not_cached(self):
+        self.embeddings.embed_documents.return_value = [[1.0], [2.0]]
+        cached = CachedEmbeddings(self.embeddings, cache_alias="default")
+        self.assertEqual(cached.embed_documents(["a", "b"]), [[1.0], [2.0]])
+        self.assertEqual(cached.stats()["misses"], 0)
+
+    def test_async_query_shares_the_cache(self):
+        self.embeddings.aembed_query = AsyncMock(return_value=[0.5, 5.0])
+        cached = CachedEmbeddings(self.embeddings, cache_alias="default")
+
+        self.assertEqual(asyncio.run(cached.aembed_query("congé")), [0.5, 5.0])
+        self.assertEqual(cached.embed_query("congé"), [0.5, 5.0])
+        other = CachedEmbeddings(self.embeddings, cache_alias="default")
+        self.assertEqual(asyncio.run(other.aembed_query("congé")), [0.5, 5.0])
+
+        self.embeddings.aembed_query.assert_awaited_once_with("congé")
+        self.embeddings.embed_query.assert_not_called()
+        self.assertEqual(other.stats()["shared_hits"], 1)
+
+
+class TestChunkEmbeddingStore(TestCase):
+    def setUp(self):
+        self.embeddings = MagicMock()
+        self.embeddings.model = "text-embedding-ada-002"
+        self.embeddings.embed_documents.side_effect = lambda texts: [
+            [0.5, float(len(text))] for text in texts
+        ]
+
+    def test_only_new_chunks_are_embedded(self):
+        vectors = embed_documents(["Date limite", "Barème"], self.embeddings)
+        self.assertEqual(vectors, [[0.5, 11.0], [0.5, 6.0]])
+
+        vectors = embed_documents(["Barème", "Calendrier", "Calendrier"], self.embeddings)
+        self.assertEqual(vectors, [[0.5, 6.0], [0.5, 10.0], [0.5, 10.0]])
+        self.assertEqual(
+            [call.args[0] for call in self.embeddings.embed_documents.call_args_list],
+            [["Date limite", "Barème"], ["Calendrier"]],
+        )
+        self.assertEqual(ChunkEmbedding.objects.count(), 3)
+
+    def test_missing_chunks_are_embedded_without_the_database(self):
+        embed_documents(["Date limite"], self.embeddings)
+        texts = ["Date limite", "Barème"]
+        stored = get_stored_embeddings(texts, self.embeddings)
+
+        with self.assertNumQueries(0):
+            vectors, new_embeddings = embed_missing(texts, stored, self.embeddings)
+        self.assertEqual(vectors, [[0.5, 11.0], [0.5, 6.0]])
+        self.assertEqual(len(new_embeddings), 1)
+
+        store_embeddings(new_embeddings)
+        self.assertEqual(ChunkEmbedding.objects.count(), 2)
+
+    def test_models_do_not_share_embeddings(self):
+        other_model = MagicMock()
+        other_model.model = "other-model"
+        other_model.embed_documents.return_value = [[1.0]]
+
+        embed_documents(["Date limite"], self.embeddings)
+        self.assertEqual(embed_documents(["Date limite"], other_model), [[1.0]])
+        other_model.embed_documents.assert_called_once_with(["Date limite"])
+
+    @override_settings(CHUNK_EMBEDDING_STORE=False)
+    def test_store_can_be_disabled(self):
+        embed_documents(["Date limite"], self.embeddings)
+        embed_documents(["Date limite"], self.embeddings)
+        self.assertEqual(self.embeddings.embed_documents.call_count, 2)
+        self.assertFalse(ChunkEmbedding.objects.exists())
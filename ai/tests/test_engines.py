@@ -0,0 +1,109 @@
+# pylint: disable=missing-docstring
+import asyncio
+import unittest
+from unittest.mock import MagicMock, patch
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.llms.fake import FakeListLLM
+from langchain.prompts import PromptTemplate
+from langchain.schema import Document
+
+from ai.services.engines import (
+    OpenAIChatEngine,
+    Engine,
+    TextSynthEngine,
+    aanswer_with_chain,
+    answer_with_chain,
+    engine_choices,
+    get_engine,
+    is_engine,
+    register_engine,
+)
+
+
+class RecordingHandler(BaseCallbackHandler):
+    def __init__(self):
+        self.ends = 0
+
+    def on_llm_end(self, response, **kwargs):
+        self.ends += 1
+
+
+class TestEngineRegistry(unittest.TestCase):
+    def test_engine_is_built_once(self):
+        factory = MagicMock(return_value=MagicMock(context_window=1024))
+        register_engine("test-engine", factory)
+
+        self.assertIs(get_engine("test-engine"), get_engine("test-engine"))
+        factory.assert_called_once_with()
+        self.assertTrue(is_engine("test-engine"))
+        self.assertNotIn("test-engine", dict(engine_choices()))
+
+    def test_choices(self):
+        choices = dict(engine_choices())
+        self.assertEqual(choices["gpt-3.5-turbo"], "ChatGPT 3.5")
+        self.assertIn("falcon", choices)
+
+    @patch("ai.services.engines.locale.setlocale")
+    def test_openai_models_are_engines(self, _):
+        self.assertTrue(is_engine("gpt-4-32k"))
+        engine = get_engine("gpt-4-32k")
+        self.assertIsInstance(engine, OpenAIChatEngine)
+        self.assertTrue(engine.streaming)
+        self.assertEqual(engine.llm.model_name, "gpt-4-32k")
+
+    def test_unknown_engine(self):
+        self.assertFalse(is_engine("unknown"))
+        with self.assertRaises(ValueError):
+            get_engine("unknown")
+
+
+class TestEngines(unittest.TestCase):
+    def test_callbacks_are_given_per_query(self):
+        llm = FakeListLLM(responses=["Le 15 décembre.", "Le 20 décembre."])
+        prompt = PromptTemplate(
+            input_variables=["question", "context"], template="{context}\n{question}"
+        )
+        documents = [Document(page_content="Date limite: 15 décembre")]
+
+        handler = RecordingHandler()
+        results = answer_with_chain(llm, prompt, "Date limite ?", documents, handler)
+        self.assertEqual(results["result"], "Le 15 décembre.")
+        self.assertEqual(handler.ends, 1)
+
+        answer_with_chain(llm, prompt, "Date limite ?", documents)
+        self.assertEqual(handler.ends, 1)
+
+    def test_async_chain(self):
+        llm = FakeListLLM(responses=["Le 15 décembre."])
+        prompt = PromptTemplate(
+            input_variables=["question", "context"], template="{context}\n{question}"
+        )
+        documents = [Document(page_content="Date limite: 15 décembre")]
+
+        handler = RecordingHandler()
+        results = asyncio.run(aanswer_with_chain(llm, prompt, "Date limite ?", documents, handler))
+        self.assertEqual(results["result"], "Le 15 décembre.")
+        self.assertEqual(handler.ends, 1)
+
+    def test_blocking_engines_run_in_threads(self):
+        engine = Engine("blocking")
+        engine.query = MagicMock(return_value={"result": "Réponse"})
+
+        results = asyncio.run(engine.aquery("{context}\n{question}", "Question ?", []))
+        self.assertEqual(results, {"result": "Réponse"})
+        engine.query.assert_called_once_with("{context}\n{question}", "Question ?", [], None)
+
+    def test_textsynth_session_is_reused(self):
+        engine = TextSynthEngine("falcon", "falcon_40B-chat", context_window=2048)
+        engine.session = MagicMock()
+        engine.session.post.return_value.json.return_value = {"text": "Réponse"}
+
+        documents = [Document(page_content="Contenu")]
+        for _ in range(2):
+            results = engine.query("{context}\n{question}", "Question ?", documents)
+            self.assertEqual(results["result"], "Réponse")
+
+        self.assertEqual(engine.session.post.call_count, 2)
+        url = engine.session.post.call_args.args[0]
+        self.assertEqual(url, "https://api.textsynth.com/v1/engines/falcon_40B-chat/chat")
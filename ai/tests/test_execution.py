@@ -0,0 +1,132 @@
+# pylint: disable=missing-docstring
+import asyncio
+
+from django.test import SimpleTestCase, override_settings
+from langchain.callbacks.base import AsyncCallbackHandler
+
+from ai.services.execution import (
+    LatencyTracker,
+    aexecute,
+    get_engine_plan,
+    get_hedge_delay,
+    latencies,
+)
+
+
+class RecordingHandler(AsyncCallbackHandler):
+    def __init__(self):
+        self.tokens = []
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+
+def streaming_engine(tokens, delay=0, error=None):
+    state = {"cancelled": False, "started": False}
+
+    async def run(name, callback):
+        state["started"] = True
+        try:
+            await asyncio.sleep(delay)
+            if error is not None:
+                raise error
+            for token in tokens:
+                await callback.on_llm_new_token(token)
+            return {"result": "".join(tokens)}
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    return run, state
+
+
+@override_settings(
+    ENGINE_HEDGES={"slow": "fast"},
+    ENGINE_HEDGE_DELAY=0.05,
+    ENGINE_HEDGE_MIN_DELAY=0,
+    ENGINE_LATENCY_MIN_SAMPLES=3,
+)
+class TestExecution(SimpleTestCase):
+    def setUp(self):
+        latencies.clear()
+        self.callback = RecordingHandler()
+
+    def engines(self, **engines):
+        async def run(name, callback):
+            return await engines[name][0](name, callback)
+
+        return run
+
+    def test_latency_percentiles(self):
+        tracker = LatencyTracker(window=4)
+        for seconds in (9.0, 1.0, 2.0, 3.0):
+            tracker.record("gpt-4", seconds)
+        self.assertEqual(tracker.percentile("gpt-4", 95), 9.0)
+        tracker.record("gpt-4", 4.0)
+        self.assertEqual(tracker.percentile("gpt-4", 95), 4.0)
+        self.assertEqual(tracker.stats()["gpt-4"]["count"], 4)
+        self.assertIsNone(tracker.percentile("falcon", 95))
+
+    def test_hedge_delay(self):
+        self.assertEqual(get_hedge_delay("slow"), 0.05)
+        for seconds in (0.2, 0.3, 0.4):
+            latencies.record("slow", seconds)
+        self.assertEqual(get_hedge_delay("slow"), 0.4)
+        self.assertEqual(get_engine_plan("slow"), ["slow", "fast"])
+        self.assertEqual(get_engine_plan("fast"), ["fast"])
+
+    async def test_single_engine(self):
+        primary = streaming_engine(["Le 15 ", "décembre."])
+        results = await aexecute(["fast"], self.engines(fast=primary), self.callback)
+
+        self.assertEqual(results, {"result": "Le 15 décembre.", "engine": "fast"})
+        self.assertEqual(self.callback.tokens, ["Le 15 ", "décembre."])
+
+    async def test_primary_answers_before_the_hedge_delay(self):
+        primary = streaming_engine(["Le 15 décembre."])
+        hedge = streaming_engine(["Le 20 décembre."])
+        run = self.engines(slow=primary, fast=hedge)
+
+        results = await aexecute(["slow", "fast"], run, self.callback)
+        self.assertEqual(results["engine"], "slow")
+        self.assertFalse(hedge[1]["started"])
+
+    async def test_hedge_wins_and_primary_is_cancelled(self):
+        primary = streaming_engine(["Le 15 décembre."], delay=5)
+        hedge = streaming_engine(["Le 20 ", "décembre."])
+        run = self.engines(slow=primary, fast=hedge)
+
+        results = await aexecute(["slow", "fast"], run, self.callback)
+        self.assertEqual(results, {"result": "Le 20 décembre.", "engine": "fast"})
+        self.assertEqual(self.callback.tokens, ["Le 20 ", "décembre."])
+        self.assertTrue(primary[1]["cancelled"])
+
+    async def test_failed_primary_falls_back_at_once(self):
+        primary = streaming_engine([], error=ValueError("timeout"))
+        hedge = streaming_engine(["Le 20 décembre."])
+        run = self.engines(slow=primary, fast=hedge)
+
+        with self.settings(ENGINE_HEDGE_DELAY=60):
+            results = await asyncio.wait_for(aexecute(["slow", "fast"], run, self.callback), 5)
+        self.assertEqual(results["engine"], "fast")
+
+    async def test_all_engines_fail(self):
+        primary = streaming_engine([], error=ValueError("primary"))
+        hedge = streaming_engine([], error=ValueError("hedge"))
+        run = self.engines(slow=primary, fast=hedge)
+
+        with self.assertRaisesRegex(ValueError, "hedge"):
+            await aexecute(["slow", "fast"], run, self.callback)
+
+    async def test_deadline(self):
+        primary = streaming_engine(["Le 15 décembre."], delay=5)
+        run = self.engines(fast=primary)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await aexecute(["fast"], run, self.callback, timeout=0.01)
+        self.assertTrue(primary[1]["cancelled"])
+
+    async def test_deadline_only_bounds_the_first_token(self):
+        primary = streaming_engine(["Le 15 décembre."])
+        results = await aexecute(["fast"], self.engines(fast=primary), self.callback, timeout=1)
+        self.assertEqual(results["engine"], "fast")
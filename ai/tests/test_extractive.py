@@ -0,0 +1,56 @@
+# pylint: disable=missing-docstring
+import unittest
+
+from langchain.schema import Document
+
+from ai.services.extractive import (
+    FALLBACK_INTRODUCTION,
+    FALLBACK_NO_DOCUMENTS,
+    extract_sentences,
+    extractive_answer,
+    split_sentences,
+)
+
+DOCUMENTS = [
+    Document(
+        page_content=(
+            "Le dossier est déposé en mairie. La date limite de dépôt est le 15 décembre."
+            "\nsource: guide.pdf - page 3\n"
+        ),
+        metadata={"origin": "guide.pdf", "page": 3},
+    ),
+    Document(
+        page_content="Les horaires d'ouverture sont affichés. Le dépôt se fait le matin.",
+        metadata={"origin": "horaires.pdf", "page": 1},
+    ),
+]
+
+
+class TestExtractive(unittest.TestCase):
+    def test_split_sentences(self):
+        self.assertEqual(
+            split_sentences(DOCUMENTS[0].page_content),
+            ["Le dossier est déposé en mairie.", "La date limite de dépôt est le 15 décembre."],
+        )
+
+    def test_best_sentences_first(self):
+        sentences = extract_sentences("Quelle est la date limite de dépôt ?", DOCUMENTS, 2)
+        self.assertEqual(
+            [sentence for sentence, _ in sentences],
+            ["La date limite de dépôt est le 15 décembre.", "Le dépôt se fait le matin."],
+        )
+
+    def test_without_common_words(self):
+        sentences = extract_sentences("Bonjour", DOCUMENTS, 1)
+        self.assertEqual(sentences, [("Le dossier est déposé en mairie.", DOCUMENTS[0])])
+
+    def test_answer(self):
+        answer = extractive_answer("Date limite ?", DOCUMENTS, 1)
+        self.assertEqual(
+            answer.splitlines(),
+            [
+                FALLBACK_INTRODUCTION,
+                "- La date limite de dépôt est le 15 décembre. (source : guide.pdf - page 3)",
+            ],
+        )
+        self.assertEqual(extractive_answer("Date limite ?", []), FALLBACK_NO_DOCUMENTS)
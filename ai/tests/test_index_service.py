@@ -1,16 +1,36 @@
 # pylint: disable=missing-docstring
+import io
 import unittest
 from unittest.mock import patch, MagicMock
-from ai.services.index_service import load_and_split_pdf
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from langchain.schema import Document as LangchainDocument
 
+from ai.models import CollectionVersion
+from ai.services.index_service import (
+    CollectionValidationError,
+    get_active_version,
+    hash_document,
+    index_document,
+    index_documents,
+    load_and_split_pdf,
+)
+from ai.services.vector_database_service import (
+    CORRECTION_ID_FIELD,
+    DOCUMENT_ID_FIELD,
+    get_point_id,
+    get_version_name,
+)
+from documents.models import Category, Correction, Document
+
 
 class TestLoadAndSplitPdf(unittest.TestCase):
     @patch("ai.services.index_service.PDFPlumberLoader")
-    @patch("ai.services.index_service.SpacyTextSplitter")
+    @patch("ai.services.index_service.get_text_splitter")
     @patch("ai.services.index_service.parse_hints")
     def test_load_and_split_pdf_with_hints(
-        self, mock_parse_hints, mock_SpacyTextSplitter, mock_PDFPlumberLoader
+        self, mock_parse_hints, mock_get_text_splitter, mock_PDFPlumberLoader
     ):
         # Set up the mock returns
         mock_PDFPlumberLoader.return_value.load.return_value = [
@@ -21,7 +41,7 @@ class TestLoadAndSplitPdf(unittest.TestCase):
         mock_text_splitter.split_documents.return_value = [
             LangchainDocument(page_content="split page content", metadata={"page": 1})
         ]
-        mock_SpacyTextSplitter.return_value = mock_text_splitter
+        mock_get_text_splitter.return_value = mock_text_splitter
 
         mock_document = MagicMock()
         mock_document.hints = "page:1: hint1; hint2"
@@ -36,3 +56,182 @@ class TestLoadAndSplitPdf(unittest.TestCase):
         self.assertIn("split page content", result_docs[0].page_content)
         self.assertIn("hint1", result_docs[0].page_content)
         self.assertIn("hint2", result_docs[0].page_content)
+
+
+@patch("ai.services.index_service.add_token_counts")
+@patch("ai.services.index_service.vector_database_service")
+@patch("ai.services.index_service.default_storage")
+class TestIncrementalIndexing(TestCase):
+    def setUp(self):
+        self.files = {}
+        self.category = Category.objects.create(name="Mobilité")
+        self.document = self.add_document("guide.md", "# Calendrier\nDate limite: 15 décembre")
+
+    def add_document(self, name, content):
+        self.files[name] = content.encode()
+        return Document.objects.create(file=name, title=name, category=self.category)
+
+    def configure(self, storage, vector_database):
+        storage.open.side_effect = lambda name, mode: io.BytesIO(self.files[name])
+        vector_database.get_point_id.side_effect = get_point_id
+        vector_database.upsert_texts.return_value = []
+        vector_database.DOCUMENT_ID_FIELD = DOCUMENT_ID_FIELD
+        vector_database.CORRECTION_ID_FIELD = CORRECTION_ID_FIELD
+
+    def upserted_ids(self, vector_database):
+        calls = vector_database.upsert_texts.call_args_list
+        return [point_id for call in calls for point_id in call.args[2]]
+
+    def test_hash_changes_with_the_hints(self, *_):
+        content_hash = hash_document(self.document, b"content")
+        self.document.hints = "page:1: mobilité"
+        self.assertNotEqual(hash_document(self.document, b"content"), content_hash)
+
+    def test_unchanged_document_is_skipped(self, storage, vector_database, _):
+        self.configure(storage, vector_database)
+
+        self.assertTrue(index_document("mobilite", self.document))
+        self.document.refresh_from_db()
+        self.assertEqual(len(self.document.point_ids), 1)
+        self.assertEqual(self.upserted_ids(vector_database), self.document.point_ids)
+        upserted = vector_database.upsert_texts.call_args
+        self.assertEqual(upserted.args[3], [{DOCUMENT_ID_FIELD: self.document.id}])
+
+        vector_database.reset_mock()
+        self.assertFalse(index_document("mobilite", self.document))
+        vector_database.upsert_texts.assert_not_called()
+
+    def test_only_new_chunks_are_embedded(self, storage, vector_database, _):
+        self.configure(storage, vector_database)
+        index_document("mobilite", self.document)
+        self.document.refresh_from_db()
+        first_ids = list(self.document.point_ids)
+
+        self.files["guide.md"] += "\n# Barème\n100 points par enfant".encode()
+        vector_database.reset_mock()
+        self.assertTrue(index_document("mobilite", self.document))
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.point_ids[0], first_ids[0])
+        self.assertEqual(self.upserted_ids(vector_database), self.document.point_ids[1:])
+        vector_database.delete_document_points.assert_called_with(
+            "mobilite", self.document.id, self.document.point_ids
+        )
+
+    @override_settings(INDEX_BATCH_SIZE=1, INDEX_MAX_IN_FLIGHT_BATCHES=1)
+    def test_chunks_are_upserted_by_batches(self, storage, vector_database, _):
+        self.configure(storage, vector_database)
+        self.files["guide.md"] += "\n# Barème\n100 points par enfant".encode()
+
+        index_document("mobilite", self.document)
+
+        self.document.refresh_from_db()
+        self.assertEqual(vector_database.upsert_texts.call_count, 2)
+        self.assertEqual(self.upserted_ids(vector_database), self.document.point_ids)
+
+    def test_points_of_deleted_documents_and_corrections_are_removed(
+        self, storage, vector_database, _
+    ):
+        self.configure(storage, vector_database)
+        CollectionVersion.objects.create(
+            category=self.category, version=1, name="mobilite__v1", activated_at=timezone.now()
+        )
+        vector_database.collection_exists.return_value = True
+        vector_database.get_point_ids.return_value = {"stale-correction"}
+        vector_database.delete_other_points.return_value = 2
+        correction = Correction.objects.create(
+            category=self.category, query="Date limite ?", answer="Le 15 décembre."
+        )
+
+        index_documents(self.category.id)
+
+        vector_database.switch_alias.assert_not_called()
+        deleted = vector_database.delete_other_points.call_args
+        self.assertEqual(deleted.args[:2], ("mobilite__v1", DOCUMENT_ID_FIELD))
+        self.assertEqual(list(deleted.args[2]), [self.document.id])
+        vector_database.delete_points.assert_called_with("mobilite__v1", {"stale-correction"})
+        correction_upsert = vector_database.upsert_texts.call_args_list[-1]
+        self.assertEqual(correction_upsert.args[3], [{CORRECTION_ID_FIELD: correction.id}])
+        vector_database.collection_updated.send.assert_called_once()
+        self.assertEqual(
+            vector_database.collection_updated.send.call_args.kwargs["collection_name"], "mobilite"
+        )
+
+    @override_settings(COLLECTION_RETENTION_SECONDS=0)
+    def test_rebuild_switches_the_alias(self, storage, vector_database, _):
+        self.configure(storage, vector_database)
+        vector_database.get_version_name.side_effect = get_version_name
+        vector_database.count_points.return_value = 1
+
+        index_documents(self.category.id)
+        vector_database.switch_alias.assert_called_once_with("mobilite", "mobilite__v1")
+        self.document.refresh_from_db()
+        self.assertEqual(len(self.document.point_ids), 1)
+        self.assertEqual(get_active_version(self.category).name, "mobilite__v1")
+
+        index_documents(self.category.id, rebuild=True)
+        vector_database.switch_alias.assert_called_with("mobilite", "mobilite__v2")
+        # The first version is deleted once retired for the retention period
+        self.assertEqual(
+            list(self.category.collection_versions.values_list("name", flat=True)),
+            ["mobilite__v2"],
+        )
+        client = vector_database.get_qdrant_client.return_value
+        client.delete_collection.assert_called_once_with("mobilite__v1")
+
+    def test_incomplete_rebuild_is_discarded(self, storage, vector_database, _):
+        self.configure(storage, vector_database)
+        vector_database.get_version_name.side_effect = get_version_name
+        vector_database.count_points.return_value = 0
+
+        with self.assertRaises(CollectionValidationError):
+            index_documents(self.category.id)
+
+        vector_database.switch_alias.assert_not_called()
+        client = vector_database.get_qdrant_client.return_value
+        client.delete_collection.assert_called_once_with("mobilite__v1")
+        self.assertFalse(self.category.collection_versions.exists())
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.point_ids, [])
+
+    def test_documents_indexed_during_the_rebuild_are_not_expected(
+        self, storage, vector_database, _
+    ):
+        self.configure(storage, vector_database)
+        vector_database.get_version_name.side_effect = get_version_name
+        vector_database.count_points.return_value = 1
+
+        def add_live_document(*args):
+            # Indexed into the active version while the new one is built
+            Document.objects.create(
+                file="bareme.md", category=self.category, point_ids=["live-1", "live-2"]
+            )
+
+        index_documents(self.category.id, progress=add_live_document)
+
+        vector_database.switch_alias.assert_called_once_with("mobilite", "mobilite__v1")
+        self.assertEqual(get_active_version(self.category).points_count, 1)
+
+    @override_settings(COLLECTION_RETENTION_SECONDS=0)
+    def test_interrupted_rebuild_is_resumed(self, storage, vector_database, _):
+        self.configure(storage, vector_database)
+        vector_database.get_version_name.side_effect = get_version_name
+        vector_database.count_points.return_value = 2
+        other = self.add_document("bareme.md", "# Barème\n100 points par enfant")
+        index_document("mobilite__v1", self.document, force=True)
+        CollectionVersion.objects.create(
+            category=self.category,
+            version=1,
+            name="mobilite__v1",
+            last_document_id=self.document.id,
+        )
+        vector_database.reset_mock()
+        progress = []
+
+        index_documents(self.category.id, progress=lambda *args: progress.append(args[1:]))
+
+        other.refresh_from_db()
+        self.assertEqual(self.upserted_ids(vector_database), other.point_ids)
+        self.assertEqual(progress, [(2, 2)])
+        vector_database.switch_alias.assert_called_once_with("mobilite", "mobilite__v1")
+        self.assertEqual(get_active_version(self.category).name, "mobilite__v1")
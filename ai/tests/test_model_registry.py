@@ -0,0 +1,72 @@
+# pylint: disable=missing-docstring
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from ai.services.model_registry import ModelRegistry
+
+
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = ModelRegistry()
+
+    def test_model_is_loaded_lazily_and_once(self):
+        loader = MagicMock(return_value="model")
+        self.registry.register("ner", loader)
+
+        self.assertFalse(self.registry.is_loaded("ner"))
+        loader.assert_not_called()
+
+        self.assertEqual(self.registry.get("ner"), "model")
+        self.assertEqual(self.registry.get("ner"), "model")
+        loader.assert_called_once_with()
+        self.assertTrue(self.registry.is_loaded("ner"))
+
+    def test_concurrent_access_loads_once(self):
+        calls = []
+
+        def slow_loader():
+            calls.append(1)
+            time.sleep(0.05)
+            return object()
+
+        self.registry.register("ner", slow_loader)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.registry.get("ner")))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+    def test_unknown_model(self):
+        with self.assertRaises(KeyError):
+            self.registry.get("unknown")
+
+    def test_warm_up_and_memory_usage(self):
+        self.registry.register("ner", lambda: "ner")
+        self.registry.register("splitter", lambda: "splitter")
+
+        self.registry.warm_up(["ner"])
+        self.assertEqual(list(self.registry.memory_usage()), ["ner"])
+
+        self.registry.warm_up()
+        usage = self.registry.memory_usage()
+        self.assertEqual(set(usage), {"ner", "splitter"})
+        self.assertIn("load_seconds", usage["ner"])
+        self.assertGreaterEqual(usage["ner"]["rss_delta"], 0)
+
+    def test_unload(self):
+        loader = MagicMock(side_effect=["first", "second"])
+        self.registry.register("ner", loader)
+
+        self.assertEqual(self.registry.get("ner"), "first")
+        self.registry.unload("ner")
+        self.assertFalse(self.registry.is_loaded("ner"))
+        self.assertEqual(self.registry.get("ner"), "second")
@@ -0,0 +1,104 @@
+# pylint: disable=missing-docstring
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from ai.services.anonymize_service import Redaction, RedactionResult
+from ai.services.model_registry import ModelRegistry
+from ai.services.model_server import (
+    ModelClient,
+    ModelServer,
+    ModelServerError,
+    RemoteAnonymizer,
+    RemoteModel,
+    RemoteTextSplitter,
+)
+
+
+class FakeAnonymizer:
+    def redact(self, text):
+        return self.redact_many([text])[0]
+
+    def redact_many(self, texts):
+        results = []
+        for text in texts:
+            start = text.find("Marie")
+            if start < 0:
+                results.append(RedactionResult(text, []))
+                continue
+            span = Redaction(start, start + 5, "PER", "Marie", "Madame/Monsieur")
+            results.append(
+                RedactionResult(text[:start] + span.placeholder + text[span.end :], [span])
+            )
+        return results
+
+
+class FakeSplitter:
+    def split_text(self, text):
+        if not text:
+            raise ValueError("empty text")
+        return text.split(". ")
+
+
+class TestModelServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.directory.name, "models.sock")
+
+        models = ModelRegistry()
+        models.register("anonymizer", FakeAnonymizer)
+        models.register("text_splitter", FakeSplitter)
+        self.server = ModelServer(self.socket_path, models)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = ModelClient(self.socket_path, timeout=5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def test_remote_anonymizer(self):
+        fallback = MagicMock()
+        anonymizer = RemoteAnonymizer(self.client, fallback)
+
+        self.assertEqual(anonymizer.anonymize("Bonjour Marie"), "Bonjour Madame/Monsieur")
+        results = anonymizer.redact_many(["Marie", "Personne"])
+        self.assertEqual(
+            results,
+            [
+                RedactionResult(
+                    "Madame/Monsieur", [Redaction(0, 5, "PER", "Marie", "Madame/Monsieur")]
+                ),
+                RedactionResult("Personne", []),
+            ],
+        )
+        fallback.assert_not_called()
+
+    def test_remote_text_splitter(self):
+        splitter = RemoteTextSplitter(RemoteModel(self.client, MagicMock()), chunk_size=1000)
+        documents = splitter.create_documents(["Un. Deux"], [{"source": "a.pdf"}])
+        self.assertEqual([document.page_content for document in documents], ["Un", "Deux"])
+        self.assertEqual(documents[1].metadata, {"source": "a.pdf"})
+
+    def test_server_error_is_raised(self):
+        with self.assertRaises(ModelServerError):
+            self.client.call("split_text", "")
+        with self.assertRaises(ModelServerError):
+            self.client.call("unknown")
+        # The connection is still usable
+        self.assertEqual(self.client.call("split_text", "a. b"), ["a", "b"])
+
+
+class TestRemoteModelFallback(unittest.TestCase):
+    def test_fallback_when_server_is_unavailable(self):
+        client = ModelClient("/nonexistent/models.sock", timeout=1)
+        local = FakeAnonymizer()
+        loader = MagicMock(return_value=local)
+        anonymizer = RemoteAnonymizer(client, loader, retry_interval=60)
+
+        self.assertEqual(anonymizer.anonymize("Marie"), "Madame/Monsieur")
+        self.assertEqual(anonymizer.anonymize("Bonjour"), "Bonjour")
+        loader.assert_called_once_with()
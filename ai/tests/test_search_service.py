@@ -0,0 +1,65 @@
+# pylint: disable=missing-docstring
+import asyncio
+import time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.schema import Document
+
+from ai.services.search_service import answer_before_deadline
+
+DOCUMENTS = [
+    Document(
+        page_content="La demande est à déposer avant le 31 mars.",
+        metadata={"origin": "guide.pdf", "page": 2, "score": 0.9},
+    )
+]
+
+
+class RecordingHandler(AsyncCallbackHandler):
+    def __init__(self):
+        self.tokens = []
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+
+def failing_answer(error, tokens=()):
+    async def answer(prompt, query, documents, engine, callback=None):
+        for token in tokens:
+            await callback.on_llm_new_token(token)
+        raise error
+
+    return answer
+
+
+@override_settings(ENGINE_HEDGES={}, SEARCH_DEADLINE=None, SEARCH_EXTRACTIVE_FALLBACK=True)
+class TestAnswerBeforeDeadline(SimpleTestCase):
+    def setUp(self):
+        self.callback = RecordingHandler()
+
+    async def run_answer(self, answer):
+        with patch("ai.services.search_service.answer", answer):
+            return await answer_before_deadline(
+                ["engine"], "prompt", "Date limite ?", DOCUMENTS, self.callback, time.monotonic()
+            )
+
+    async def test_fallback_on_timeout(self):
+        results = await self.run_answer(failing_answer(asyncio.TimeoutError()))
+        self.assertTrue(results["fallback"])
+        self.assertEqual(results["sources"][0]["origin"], "guide.pdf")
+
+    @override_settings(SEARCH_EXTRACTIVE_FALLBACK=False)
+    async def test_no_fallback_by_default(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.run_answer(failing_answer(asyncio.TimeoutError()))
+
+    async def test_bugs_propagate(self):
+        with self.assertRaises(ValueError):
+            await self.run_answer(failing_answer(ValueError("bug")))
+
+    async def test_no_fallback_after_streamed_tokens(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.run_answer(failing_answer(asyncio.TimeoutError(), ["La ", "demande"]))
+        self.assertEqual(self.callback.tokens, ["La ", "demande"])
@@ -0,0 +1,188 @@
+# pylint: disable=missing-docstring
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+from langchain.callbacks.base import AsyncCallbackHandler
+
+from ai.services.execution import GenerationCancelled
+from ai.services.single_flight import (
+    FLIGHT_CACHE_ALIAS,
+    coalesce,
+    flight_group,
+    flight_key,
+    lock_key,
+    tokens_key,
+)
+from documents.models import Category
+
+CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "flights"},
+}
+
+
+class RecordingHandler(AsyncCallbackHandler):
+    def __init__(self, cancel_after=None):
+        self.tokens = []
+        self.ends = 0
+        self.cancel_after = cancel_after
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if self.cancel_after is not None and len(self.tokens) >= self.cancel_after:
+            raise GenerationCancelled()
+        self.tokens.append(token)
+
+    async def on_llm_end(self, response, **kwargs):
+        self.ends += 1
+
+
+def generation(tokens, delay=0.01):
+    state = {"calls": 0, "cancelled": False}
+
+    async def run(callback):
+        state["calls"] += 1
+        try:
+            for token in tokens:
+                await asyncio.sleep(delay)
+                callback.on_llm_new_token(token)
+            return {"result": "".join(tokens), "engine": "gpt-3.5-turbo"}
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    return run, state
+
+
+@override_settings(CHANNEL_LAYERS=CHANNEL_LAYERS, CACHES=CACHES, SEARCH_SINGLE_FLIGHT_TIMEOUT=5)
+class TestSingleFlight(SimpleTestCase):
+    def setUp(self):
+        caches[FLIGHT_CACHE_ALIAS].clear()
+
+    def test_key(self):
+        category = Category(slug="documents")
+        key = flight_key(category, "gpt-4", "{context}", "Date limite ?")
+        self.assertEqual(key, flight_key(category, "gpt-4", "{context}", "date  limite"))
+        self.assertNotEqual(key, flight_key(category, "gpt-4", "{question}", "Date limite ?"))
+        self.assertNotEqual(key, flight_key(category, "falcon", "{context}", "Date limite ?"))
+
+    async def test_identical_searches_share_the_generation(self):
+        run, state = generation(["Le 15 ", "décembre."])
+        handlers = [RecordingHandler() for _ in range(3)]
+
+        results = await asyncio.gather(*(coalesce("key", run, handler) for handler in handlers))
+
+        self.assertEqual(state["calls"], 1)
+        for handler, result in zip(handlers, results):
+            self.assertEqual(result["result"], "Le 15 décembre.")
+            self.assertEqual(handler.tokens, ["Le 15 ", "décembre."])
+            self.assertEqual(handler.ends, 1)
+
+    async def test_late_search_receives_the_previous_tokens(self):
+        run, state = generation(["Le ", "15 ", "décembre."])
+        leader = asyncio.create_task(coalesce("key", run, RecordingHandler()))
+        await asyncio.sleep(0.025)
+
+        handler = RecordingHandler()
+        results = await coalesce("key", run, handler)
+        await leader
+        self.assertEqual(state["calls"], 1)
+        self.assertEqual(results["result"], "Le 15 décembre.")
+        self.assertEqual(handler.tokens, ["Le ", "15 ", "décembre."])
+
+    async def test_cancelled_search_leaves_the_flight(self):
+        run, state = generation(["Le ", "15 ", "décembre."])
+        leader = asyncio.create_task(coalesce("key", run, RecordingHandler(cancel_after=1)))
+        follower = asyncio.create_task(coalesce("key", run, RecordingHandler()))
+
+        with self.assertRaises(GenerationCancelled):
+            await leader
+        results = await follower
+        self.assertEqual(results["result"], "Le 15 décembre.")
+        self.assertFalse(state["cancelled"])
+
+    async def test_generation_is_cancelled_with_the_last_search(self):
+        run, state = generation(["Le ", "15 ", "décembre."])
+
+        with self.assertRaises(GenerationCancelled):
+            await coalesce("key", run, RecordingHandler(cancel_after=1))
+        self.assertTrue(state["cancelled"])
+        self.assertIsNone(await caches[FLIGHT_CACHE_ALIAS].aget(lock_key("key")))
+
+    async def test_leader_publishes_to_the_other_processes(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(flight_group("key"), channel)
+        run, _ = generation(["Le 15 ", "décembre."])
+
+        await coalesce("key", run)
+
+        messages = [await layer.receive(channel) for _ in range(2)]
+        # The tokens are coalesced into one frame, also kept for the late followers
+        self.assertEqual([message["type"] for message in messages], ["flight.token", "flight.end"])
+        self.assertEqual(messages[0]["token"], "Le 15 décembre.")
+        self.assertEqual(messages[1]["results"]["result"], "Le 15 décembre.")
+        cached = await caches[FLIGHT_CACHE_ALIAS].aget(tokens_key("key"))
+        self.assertEqual(cached, ["Le 15 décembre."])
+        # The lock is released once the results are published
+        await asyncio.sleep(0.05)
+        self.assertIsNone(await caches[FLIGHT_CACHE_ALIAS].aget(lock_key("key")))
+
+    async def test_search_follows_the_leader_of_another_process(self):
+        layer = get_channel_layer()
+        await caches[FLIGHT_CACHE_ALIAS].aset(lock_key("key"), "other-process")
+        run, state = generation(["Le 20 décembre."])
+        handler = RecordingHandler()
+
+        follower = asyncio.create_task(coalesce("key", run, handler))
+        await asyncio.sleep(0.05)
+        await layer.group_send(
+            flight_group("key"), {"type": "flight.token", "token": "Le 15 ", "index": 0}
+        )
+        await layer.group_send(
+            flight_group("key"), {"type": "flight.end", "results": {"result": "Le 15 décembre."}}
+        )
+
+        results = await follower
+        self.assertEqual(state["calls"], 0)
+        self.assertEqual(results, {"result": "Le 15 décembre."})
+        self.assertEqual(handler.tokens, ["Le 15 "])
+
+    async def test_late_follower_receives_the_previous_tokens(self):
+        layer = get_channel_layer()
+        cache = caches[FLIGHT_CACHE_ALIAS]
+        await cache.aset(lock_key("key"), "other-process")
+        await cache.aset(tokens_key("key"), ["Le 15 "])
+        run, state = generation(["Le 20 décembre."])
+        handler = RecordingHandler()
+
+        follower = asyncio.create_task(coalesce("key", run, handler))
+        await asyncio.sleep(0.05)
+        # The frame cached as the follower joined is received once
+        for index, token in enumerate(["Le 15 ", "décembre."]):
+            await layer.group_send(
+                flight_group("key"), {"type": "flight.token", "token": token, "index": index}
+            )
+        await layer.group_send(
+            flight_group("key"), {"type": "flight.end", "results": {"result": "Le 15 décembre."}}
+        )
+
+        await follower
+        self.assertEqual(state["calls"], 0)
+        self.assertEqual(handler.tokens, ["Le 15 ", "décembre."])
+
+    async def test_search_answers_when_the_leader_of_another_process_fails(self):
+        layer = get_channel_layer()
+        await caches[FLIGHT_CACHE_ALIAS].aset(lock_key("key"), "other-process")
+        run, state = generation(["Le 20 décembre."])
+
+        follower = asyncio.create_task(coalesce("key", run))
+        await asyncio.sleep(0.05)
+        await caches[FLIGHT_CACHE_ALIAS].adelete(lock_key("key"))
+        await layer.group_send(flight_group("key"), {"type": "flight.error"})
+
+        results = await follower
+        self.assertEqual(state["calls"], 1)
+        self.assertEqual(results["result"], "Le 20 décembre.")
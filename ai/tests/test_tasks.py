@@ -0,0 +1,68 @@
+# pylint: disable=missing-docstring
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.test import SimpleTestCase, override_settings
+
+from ai.tasks import async_search
+from chat.streaming import GenerationCancelled, start_generation
+
+CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def fake_search(query, engine, category_slug, callback=None):
+    callback.on_llm_new_token("Le 15 ")
+    callback.on_llm_new_token("décembre.")
+    callback.on_llm_end(None)
+    return {"result": "Le 15 décembre.", "input": "prompt", "sources": [{"origin": "a.pdf"}]}
+
+
+@override_settings(CHANNEL_LAYERS=CHANNEL_LAYERS)
+class TestAsyncSearch(SimpleTestCase):
+    def setUp(self):
+        self.channel_layer = get_channel_layer()
+        self.channel = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)("chat_abc", self.channel)
+
+    def receive(self):
+        return async_to_sync(self.channel_layer.receive)(self.channel)
+
+    @patch("ai.tasks.search_service.search_documents", side_effect=fake_search)
+    def test_answer_is_streamed_to_the_session(self, _):
+        generation_id = start_generation("abc")
+        result = async_search(
+            None, "Date limite ?", "mutations", session_id="abc", generation_id=generation_id
+        )
+
+        expected = {
+            "result": "Le 15 décembre.",
+            "correction_id": None,
+            "sources": [{"origin": "a.pdf"}],
+        }
+        self.assertEqual(result, expected)
+        self.assertEqual(self.receive(), {"type": "send.token", "token": "Le 15 décembre."})
+        self.assertEqual(
+            self.receive(), {"type": "send.end", "message": {"type": "end", **expected}}
+        )
+
+    @patch("ai.tasks.search_service.search_documents", side_effect=GenerationCancelled())
+    def test_cancelled_search(self, _):
+        self.assertEqual(
+            async_search(None, "Date ?", "mutations", session_id="abc"), {"cancelled": True}
+        )
+
+    @patch("ai.tasks.requests.post")
+    @patch("ai.tasks.search_service.search_documents")
+    def test_callback_url(self, mock_search_documents, mock_post):
+        mock_search_documents.return_value = {"result": "Réponse"}
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.text = "OK"
+
+        # The positional order of the messages queued by the first version of the task
+        result = async_search("http://example.com/cb/", "Date ?", "mutations")
+
+        self.assertEqual(result, (200, "OK"))
+        self.assertEqual(mock_post.call_args.args, ("http://example.com/cb/",))
+        self.assertEqual(mock_post.call_args.kwargs["json"], {"result": "Réponse"})
+        self.assertIsNone(mock_search_documents.call_args.kwargs["callback"])
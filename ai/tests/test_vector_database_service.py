@@ -1,30 +1,117 @@
 # pylint: disable=missing-docstring
 
+import asyncio
 from unittest.mock import Mock, patch
 
 from django.test import TestCase
+from langchain.schema import Document as LangchainDocument
 
-from ai.services.vector_database_service import create_collection
+from ai.services.vector_database_service import (
+    DOCUMENT_ID_FIELD,
+    clear_clients,
+    collection_updated,
+    get_async_qdrant_client,
+    get_point_id,
+    get_qdrant_client,
+    get_version_name,
+    switch_alias,
+    upsert_texts,
+)
 
 
 class TestVectorDatabaseService(TestCase):
-    @patch("ai.services.embedding.get_embedding")
-    @patch("qdrant_client.QdrantClient")
-    @patch("langchain.vectorstores.Qdrant.from_documents")
-    def test_create_collection(
-        self, mock_from_documents, mock_qdrant_client, mock_get_embedding
-    ):
-        # Mocking out external calls
-        mock_get_embedding.return_value = "some_embedding"
+    def setUp(self):
+        clear_clients()
+
+    def tearDown(self):
+        clear_clients()
 
-        create_collection("test_collection", ["text1", "text2"])
+    @patch("qdrant_client.QdrantClient")
+    def test_client_is_pooled(self, mock_qdrant_client):
+        first = get_qdrant_client()
+        second = get_qdrant_client("http://localhost:6333")
 
-        # Validate QdrantClient was initialized with the right parameters
+        self.assertIs(first, second)
         mock_qdrant_client.assert_called_once_with(
             url="http://localhost:6333", prefer_grpc=True
         )
-        mock_client = mock_qdrant_client.return_value
-        mock_client.delete_collection.assert_called_once_with("test_collection")
 
-        mock_from_documents.assert_called()  # Add further assertions based on expected behavior
+        get_qdrant_client("http://qdrant:6333")
+        self.assertEqual(mock_qdrant_client.call_count, 2)
+
+    @patch("qdrant_client.QdrantClient")
+    def test_switch_alias(self, mock_qdrant_client):
+        client = mock_qdrant_client.return_value
+        client.get_aliases.return_value.aliases = [
+            Mock(alias_name="documents", collection_name="documents__v1")
+        ]
+        received = []
+
+        def handler(sender, collection_name, **kwargs):
+            received.append(collection_name)
+
+        collection_updated.connect(handler)
+        try:
+            switch_alias("documents", "documents__v2")
+        finally:
+            collection_updated.disconnect(handler)
+
+        operations = client.update_collection_aliases.call_args.kwargs["change_aliases_operations"]
+        self.assertEqual(operations[0].delete_alias.alias_name, "documents")
+        self.assertEqual(operations[1].create_alias.collection_name, "documents__v2")
+        client.delete_collection.assert_not_called()
+        self.assertEqual(received, ["documents"])
+
+    @patch("qdrant_client.QdrantClient")
+    def test_switch_alias_replaces_the_collection_named_like_it(self, mock_qdrant_client):
+        client = mock_qdrant_client.return_value
+        client.get_aliases.return_value.aliases = []
+        client.get_collections.return_value.collections = [Mock()]
+        client.get_collections.return_value.collections[0].name = "documents"
+
+        switch_alias("documents", "documents__v1")
+
+        client.delete_collection.assert_called_once_with("documents")
+        operations = client.update_collection_aliases.call_args.kwargs["change_aliases_operations"]
+        self.assertEqual(len(operations), 1)
+        self.assertEqual(get_version_name("documents", 1), "documents__v1")
+
+    def test_point_ids_are_deterministic(self):
+        point_id = get_point_id("document", 1, 0, "abc")
+        self.assertEqual(point_id, get_point_id("document", 1, 0, "abc"))
+        self.assertNotEqual(point_id, get_point_id("document", 2, 0, "abc"))
+
+    @patch("ai.services.embedding_cache.get_embedding")
+    @patch("qdrant_client.QdrantClient")
+    def test_upsert_texts_creates_the_collection(self, mock_qdrant_client, mock_get_embedding):
+        mock_get_embedding.return_value.embed_documents.return_value = [[0.1, 0.2]]
+        client = mock_qdrant_client.return_value
+        client.get_collections.return_value.collections = []
+        text = LangchainDocument(page_content="Date limite", metadata={"page": 1})
+
+        upsert_texts("test_collection", [text], ["point-id"], [{DOCUMENT_ID_FIELD: 7}])
+
+        vectors_config = client.create_collection.call_args.kwargs["vectors_config"]
+        self.assertEqual(vectors_config.size, 2)
+        indexed_fields = [call.args[1] for call in client.create_payload_index.call_args_list]
+        self.assertIn(DOCUMENT_ID_FIELD, indexed_fields)
+        point = client.upsert.call_args.kwargs["points"][0]
+        self.assertEqual(point.id, "point-id")
+        self.assertEqual(
+            point.payload,
+            {"page_content": "Date limite", "metadata": {"page": 1}, DOCUMENT_ID_FIELD: 7},
+        )
+
+    @patch("qdrant_client.QdrantClient")
+    def test_async_client_per_event_loop(self, mock_qdrant_client):
+        mock_qdrant_client.side_effect = lambda **kwargs: Mock()
+
+        async def get_clients():
+            return get_async_qdrant_client(), get_async_qdrant_client()
 
+        first, same = asyncio.run(get_clients())
+        other, _ = asyncio.run(get_clients())
+        self.assertIs(first, same)
+        # The async gRPC channel of the first loop is closed with it
+        self.assertIsNot(first, other)
+        self.assertIsNot(first, get_qdrant_client())
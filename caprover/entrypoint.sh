@@ -13,7 +13,7 @@ python manage.py migrate
 python manage.py create_superuser
 
 # Start Celery worker in the background
-celery -A cassandre worker --loglevel=info &
+celery -A cassandre worker -Q celery,interactive --loglevel=info &
 
 # Start Daphne
 daphne cassandre.asgi:application
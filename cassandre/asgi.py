@@ -12,13 +12,19 @@ import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-import chat.routing
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cassandre.settings')
 
+# Sets up the app registry before the consumers import the models
+django_asgi_app = get_asgi_application()
+
+from ai.services.model_registry import warm_up_models  # pylint: disable=wrong-import-position
+import chat.routing  # pylint: disable=wrong-import-position
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": URLRouter(
         chat.routing.websocket_urlpatterns
     ),
-})
\ No newline at end of file
+})
+
+warm_up_models()
@@ -173,6 +173,17 @@ LOGGING = {
     },
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Cache shared by all the processes (query embeddings...)
+    "shared": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "shared",
+    },
+}
+
 # Use the Redis broker
 CELERY_BROKER_URL = "redis://localhost:6379"
 CELERY_RESULT_BACKEND = "django-db"
@@ -182,12 +193,102 @@ CELERY_CACHE_BACKEND = "django-cache"
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
+# The searches have their own queue, so that they do not wait behind indexing
+CELERY_TASK_ROUTES = {"ai.tasks.async_search": {"queue": "interactive"}}
+# Runs the searches of the search page on the Celery workers instead of the web process
+SEARCH_OFFLOAD_TO_CELERY = False
 
 # Index settings
 SPLIT_CHUNK_SIZE = 1000
 SPLIT_CHUNK_OVERLAP = 0
 TEXT_SYNTH_API_KEY = os.environ.get("TEXT_SYNTH_API_KEY")
 
+# Models loaded once per process at startup (see ai.services.model_registry)
+MODEL_REGISTRY_WARMUP = []
+# Engines built once per process at startup (see ai.services.engines)
+ENGINE_WARMUP = []
+
+# Streamed tokens are sent to the websocket in frames of at most this delay (in
+# milliseconds) or at least this size (in characters)
+STREAMING_FLUSH_INTERVAL_MS = 100
+STREAMING_FLUSH_CHARS = 80
+
+# Hedged engines: a query to an engine of this map also starts its hedge engine
+# when no token was received after the ENGINE_HEDGE_PERCENTILE of its latencies
+# (ENGINE_HEDGE_DELAY seconds until ENGINE_LATENCY_MIN_SAMPLES are known), the
+# first engine streaming its answer wins, e.g. {"gpt-4": "gpt-3.5-turbo"}
+ENGINE_HEDGES = {}
+ENGINE_HEDGE_PERCENTILE = 95
+ENGINE_HEDGE_DELAY = 5
+ENGINE_HEDGE_MIN_DELAY = 0.5
+# Latencies kept per engine
+ENGINE_LATENCY_WINDOW = 200
+ENGINE_LATENCY_MIN_SAMPLES = 20
+
+# Seconds given to the engines to start answering, counted from the start of the
+# search (None for no deadline), and opt-in degradation mode answering from the
+# retrieved chunks when they miss it or fail on a provider or network error
+SEARCH_DEADLINE = None
+SEARCH_EXTRACTIVE_FALLBACK = False
+
+# Identical concurrent searches share one retrieval and one generation, across the
+# processes sharing the "shared" cache and the channel layer; a search following
+# the generation of another process gives up after this many seconds of silence.
+# Off by default: each search then takes a lock and relays its frames through the
+# shared cache and the channel layer
+SEARCH_SINGLE_FLIGHT = False
+SEARCH_SINGLE_FLIGHT_TIMEOUT = 120
+
+# Seconds a collection version replaced by a reindexing is kept before its deletion
+COLLECTION_RETENTION_SECONDS = 3600
+
+# Chunks embedded and upserted per request by the indexing, and batches of a
+# document being embedded while its next chunks are loaded
+INDEX_BATCH_SIZE = 64
+INDEX_MAX_IN_FLIGHT_BATCHES = 2
+
+# Threads of the async search pipeline running the blocking steps: the
+# anonymization and the queries of the engines without an async client
+ANONYMIZER_EXECUTOR_WORKERS = 4
+ENGINE_EXECUTOR_WORKERS = 16
+
+# Unix socket of the model server (python manage.py run_model_server) hosting the
+# NLP models once per node, None to load them in every process
+MODEL_SERVER_SOCKET = None
+MODEL_SERVER_TIMEOUT = 30
+MODEL_SERVER_RETRY_INTERVAL = 30
+
+# sentence-transformers model used instead of the OpenAI embeddings, if any
+LOCAL_EMBEDDING_MODEL = None
+
+# Prompt token budget: tokens kept for the answer, maximum tokens of context
+# (None to fill the context window of the engine)
+CONTEXT_ANSWER_TOKENS = 512
+CONTEXT_MAX_TOKENS = None
+
+# Lifetime in seconds of the corrections kept in memory by each process
+CORRECTION_CACHE_TTL = 60
+
+# Query embeddings cache: entries kept in each process, lifetime in seconds
+EMBEDDING_CACHE_SIZE = 1024
+EMBEDDING_CACHE_TTL = 30 * 24 * 3600
+# Stores the embeddings of the indexed chunks in the database, so that a
+# reindexing only embeds the new chunks
+CHUNK_EMBEDDING_STORE = True
+
+# Anonymization settings
+# NER backend: "torch" (fp32), "torch_int8" (dynamic quantization) or "onnx"
+# (int8 ONNX Runtime model exported by the export_ner_model command)
+ANONYMIZER_BACKEND = "torch"
+ANONYMIZER_ONNX_MODEL_DIR = os.path.join(BASE_DIR, "models/camembert-ner-int8")
+ANONYMIZER_BATCH_SIZE = 16
+# Gather concurrent anonymizations for a few milliseconds into one forward pass
+ANONYMIZER_MICRO_BATCHING = False
+ANONYMIZER_MICRO_BATCH_WAIT_MS = 5
+# Skip the NER model on texts without any person name candidate
+ANONYMIZER_PRESCREEN = True
+ANONYMIZER_FIRST_NAMES_FILE = os.path.join(BASE_DIR, "ai/data/first_names.txt")
+
 # Access to publik
 PUBLIK_USERNAME = os.environ.get("PUBLIK_USERNAME")
 PUBLIK_PASSWORD = os.environ.get("PUBLIK_PASSWORD")
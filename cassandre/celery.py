@@ -1,10 +1,22 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cassandre.dev_settings')
 
 app = Celery('cassandre')
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
\ No newline at end of file
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@worker_process_init.connect
+def warm_up_worker_models(**_kwargs):
+    """
+    Loads the heavy models once in each worker process, before the first task.
+    """
+    # pylint: disable=import-outside-toplevel
+    from ai.services.model_registry import warm_up_models
+
+    warm_up_models()
@@ -33,6 +33,10 @@ CHANNEL_LAYERS = {
     },
 }
 CELERY_BROKER_URL = "redis://redis:6379"
+CACHES['shared'] = {
+    'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+    'LOCATION': 'redis://redis:6379/1',
+}
 WEBSOCKET_URL = 'ws://0.0.0.0:8000'
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
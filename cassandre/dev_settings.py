@@ -32,6 +32,11 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+CACHES['shared'] = {
+    'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+    'LOCATION': 'redis://127.0.0.1:6379/1',
+}
 WEBSOCKET_URL = 'ws://localhost:8000'
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
@@ -27,13 +27,64 @@ MEDIA_ROOT = '/media'
 MEDIA_URL = '/media/'
 
 CELERY_BROKER_URL= os.environ.get('CELERY_BROKER_URL')
+SEARCH_OFFLOAD_TO_CELERY = os.environ.get('SEARCH_OFFLOAD_TO_CELERY', 'false').lower() == 'true'
 
 # Index settings
 SPLIT_CHUNK_SIZE = int(os.environ.get('SPLIT_CHUNK_SIZE', 1000))
 SPLIT_CHUNK_OVERLAP = int(os.environ.get('SPLIT_CHUNK_OVERLAP', 100))
 
+# Anonymization settings
+ANONYMIZER_BACKEND = os.environ.get('ANONYMIZER_BACKEND', 'torch')
+ANONYMIZER_ONNX_MODEL_DIR = os.environ.get('ANONYMIZER_ONNX_MODEL_DIR', ANONYMIZER_ONNX_MODEL_DIR)
+ANONYMIZER_MICRO_BATCHING = os.environ.get('ANONYMIZER_MICRO_BATCHING', 'false').lower() == 'true'
+ANONYMIZER_MICRO_BATCH_WAIT_MS = int(os.environ.get('ANONYMIZER_MICRO_BATCH_WAIT_MS', 5))
+ANONYMIZER_PRESCREEN = os.environ.get('ANONYMIZER_PRESCREEN', 'true').lower() == 'true'
+
+# Models and engines loaded once per process at startup
+MODEL_REGISTRY_WARMUP = [
+    name for name in os.environ.get('MODEL_REGISTRY_WARMUP', 'anonymizer,token_encoding').split(',') if name
+]
+ENGINE_WARMUP = [
+    name for name in os.environ.get('ENGINE_WARMUP', 'gpt-3.5-turbo').split(',') if name
+]
+# Hedged engines, as "primary:hedge,primary:hedge"
+ENGINE_HEDGES = dict(
+    pair.split(':', 1)
+    for pair in os.environ.get('ENGINE_HEDGES', '').split(',')
+    if ':' in pair
+)
+ENGINE_HEDGE_DELAY = float(os.environ.get('ENGINE_HEDGE_DELAY', 5))
+SEARCH_DEADLINE = (
+    float(os.environ['SEARCH_DEADLINE']) if os.environ.get('SEARCH_DEADLINE') else None
+)
+SEARCH_EXTRACTIVE_FALLBACK = (
+    os.environ.get('SEARCH_EXTRACTIVE_FALLBACK', 'false').lower() == 'true'
+)
+SEARCH_SINGLE_FLIGHT = os.environ.get('SEARCH_SINGLE_FLIGHT', 'false').lower() == 'true'
+SEARCH_SINGLE_FLIGHT_TIMEOUT = int(os.environ.get('SEARCH_SINGLE_FLIGHT_TIMEOUT', 120))
+COLLECTION_RETENTION_SECONDS = int(os.environ.get('COLLECTION_RETENTION_SECONDS', 3600))
+INDEX_BATCH_SIZE = int(os.environ.get('INDEX_BATCH_SIZE', 64))
+INDEX_MAX_IN_FLIGHT_BATCHES = int(os.environ.get('INDEX_MAX_IN_FLIGHT_BATCHES', 2))
+STREAMING_FLUSH_INTERVAL_MS = int(os.environ.get('STREAMING_FLUSH_INTERVAL_MS', 100))
+STREAMING_FLUSH_CHARS = int(os.environ.get('STREAMING_FLUSH_CHARS', 80))
+ANONYMIZER_EXECUTOR_WORKERS = int(os.environ.get('ANONYMIZER_EXECUTOR_WORKERS', 4))
+ENGINE_EXECUTOR_WORKERS = int(os.environ.get('ENGINE_EXECUTOR_WORKERS', 16))
+
+# Model server shared by the processes of the node
+MODEL_SERVER_SOCKET = os.environ.get('MODEL_SERVER_SOCKET') or None
+MODEL_SERVER_TIMEOUT = float(os.environ.get('MODEL_SERVER_TIMEOUT', 30))
+LOCAL_EMBEDDING_MODEL = os.environ.get('LOCAL_EMBEDDING_MODEL') or None
+
 WEBSOCKET_URL = os.environ.get('WEBSOCKET_URL')
 
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('CACHE_REDIS_URL'),
+    }
+EMBEDDING_CACHE_TTL = int(os.environ.get('EMBEDDING_CACHE_TTL', EMBEDDING_CACHE_TTL))
+CHUNK_EMBEDDING_STORE = os.environ.get('CHUNK_EMBEDDING_STORE', 'true').lower() == 'true'
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cassandre.settings')
 
 application = get_wsgi_application()
+
+from ai.services.model_registry import warm_up_models  # pylint: disable=wrong-import-position
+
+warm_up_models()
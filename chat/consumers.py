@@ -1,21 +1,177 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
+import asyncio
+import contextlib
 import json
-from .global_registry import websockets
+import logging
+import time
+from functools import partial
+
+from django.conf import settings
+
+from ai.services.aio import run_in_executor
+from ai.services.search_service import asearch_documents
+from ai.tasks import async_search
+from documents.models import Category
+
+from .forms import SearchForm
+from .streaming import (
+    GenerationCancelled,
+    StreamingCallbackHandler,
+    acancel_generation,
+    astart_generation,
+    end_message,
+    session_group,
+)
+
+logger = logging.getLogger("cassandre")
+
+
+class SocketCallbackHandler(StreamingCallbackHandler):
+    """
+    Callback handler streaming the tokens of the answer to the websocket the
+    query was received on, and recording the time of the first token.
+    """
+
+    def __init__(self, consumer, *args, **kwargs):
+        super().__init__(consumer.session_id, *args, **kwargs)
+        self.consumer = consumer
+        self.first_token_at = None
+
+    async def send_token(self, token):
+        await self.consumer.send_message({'token': token})
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        await super().on_llm_new_token(token, **kwargs)
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    The websocket of a search session.
+
+    It receives the tokens of the searches of the session, and answers the
+    queries sent on the socket:
+
+        {"type": "query", "query": "...", "engine": "...", "category": "<slug>"}
+
+    The answer is streamed as {"token": "..."} messages, followed by an "end"
+    message with the answer, the correction id, the sources and the timings of
+    the search, or by an "error" message.
+
+    With SEARCH_OFFLOAD_TO_CELERY, the query is answered by a Celery worker,
+    which streams the tokens and the end message to the group of the session.
+
+    A session answers one query at a time: a new query cancels the search in
+    flight, as does the disconnection of the socket, which aborts the upstream
+    LLM stream.
+    """
+
     async def connect(self):
         self.session_id = self.scope['url_route']['kwargs']['session_id']
-        websockets[self.session_id] = self
+        self.group_name = session_group(self.session_id)
+        self.search_task = None
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
 
     async def disconnect(self, close_code):
-        del websockets[self.session_id]
+        await self.cancel_search()
+        await acancel_generation(self.session_id)
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def cancel_search(self):
+        """
+        Cancels the search in flight on the socket, if any.
+        """
+        task = self.search_task
+        self.search_task = None
+        if task is not None and not task.done():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message = json.loads(text_data or '')
+        except ValueError:
+            await self.send_message({'type': 'error', 'errors': {'message': 'Invalid JSON'}})
+            return
+        if not isinstance(message, dict) or message.get('type') != 'query':
+            return
+
+        form = SearchForm(message)
+        if not form.is_valid():
+            await self.send_message({'type': 'error', 'errors': form.errors})
+            return
+
+        await self.cancel_search()
+        # Also supersedes a generation of the session running in another process
+        generation_id = await astart_generation(self.session_id)
+        if settings.SEARCH_OFFLOAD_TO_CELERY:
+            # The worker streams the answer and its end message to the session group
+            await run_in_executor(
+                None,
+                partial(
+                    async_search.delay,
+                    callback_url=None,
+                    query=form.cleaned_data['query'],
+                    category_slug=message.get('category') or 'documents',
+                    engine=form.cleaned_data['engine'],
+                    session_id=self.session_id,
+                    generation_id=generation_id,
+                ),
+            )
+            return
+
+        # The search runs as a task so that the consumer keeps receiving messages
+        self.search_task = asyncio.create_task(
+            self.answer(
+                form.cleaned_data['query'],
+                form.cleaned_data['engine'],
+                message.get('category') or 'documents',
+                generation_id,
+            )
+        )
+
+    async def answer(self, query, engine, category_slug, generation_id=None):
+        """
+        Searches the answer of a query and streams it to the socket.
+        """
+        started_at = time.monotonic()
+        callback = SocketCallbackHandler(self, generation_id=generation_id)
+        try:
+            results = await asearch_documents(query, engine, category_slug, callback=callback)
+        except asyncio.CancelledError:
+            callback.coalescer.discard()
+            raise
+        except GenerationCancelled:
+            return
+        except Category.DoesNotExist:
+            await self.send_message(
+                {'type': 'error', 'errors': {'category': 'Unknown category'}}
+            )
+            return
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Search failed on the websocket of %s", self.session_id)
+            await self.send_message(
+                {'type': 'error', 'errors': {'message': 'The search failed'}}
+            )
+            return
+
+        ended_at = time.monotonic()
+        timings = {'total_ms': round((ended_at - started_at) * 1000)}
+        if callback.first_token_at is not None:
+            timings['first_token_ms'] = round((callback.first_token_at - started_at) * 1000)
+        await self.send_message(end_message(results, timings))
+
+    async def send_message(self, message):
+        await self.send(text_data=json.dumps(message))
 
-    async def receive(self, text_data):
-        pass  # handle received messages if necessary
+    async def send_end(self, event):
+        await self.send_message(event['message'])
 
     async def send_token(self, event):
         token = event['token']
         await self.send(text_data=json.dumps({
             'token': token,
-        }))
\ No newline at end of file
+        }))
@@ -1,6 +1,7 @@
 # chat/forms.py
 from django import forms
 
+from ai.services.engines import DEFAULT_ENGINE, engine_choices, is_engine
 from documents.models import Category
 
 
@@ -26,12 +27,21 @@ class SearchForm(forms.Form):
         label="",
     )
     engine = forms.CharField(
-        widget=forms.HiddenInput(), required=False, initial="gpt-3.5-turbo"
+        widget=forms.HiddenInput(), required=False, initial=DEFAULT_ENGINE
     )  # Set the default value for the "engine" field
     history = forms.CharField(
         widget=forms.HiddenInput(), required=False
     )  # Add a hidden input field for the history
 
+    def clean_engine(self):
+        """
+        Checks that the engine is known, an empty engine selects the default one.
+        """
+        engine = self.cleaned_data["engine"] or DEFAULT_ENGINE
+        if not is_engine(engine):
+            raise forms.ValidationError(f"Unknown engine: {engine}")
+        return engine
+
 
 class DebugForm(forms.ModelForm):
     """
@@ -42,15 +52,7 @@ class DebugForm(forms.ModelForm):
     The 'query' field is used to input the query.
     """
 
-    ENGINE_CHOICES = [
-        ("gpt-3.5-turbo", "ChatGPT 3.5"),
-        ("gpt-3.5-turbo-instruct", "GPT 3.5 instruct"),
-        ("gpt-4", "ChatGPT 4"),
-        ("mistral_instruct", "Mistral Instruct"),
-        ("falcon", "Falcon"),
-        ("paradigm", "LightOn"),
-        ("vertexai", "VertexAI"),
-    ]
+    ENGINE_CHOICES = engine_choices()
     engine = forms.ChoiceField(choices=ENGINE_CHOICES)
     category = forms.ModelChoiceField(
         queryset=Category.objects.all(),
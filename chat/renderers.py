@@ -0,0 +1,45 @@
+"""
+This module provides the renderers of the streamed search API responses:
+Server-Sent Events ("text/event-stream", ?format=sse) and newline-delimited
+JSON ("application/x-ndjson", ?format=ndjson).
+
+The streamed responses bypass the renderers, which only render the non
+streamed ones (validation errors) in the negotiated format.
+"""
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+def format_sse(event):
+    """
+    Returns an event as a Server-Sent Event: its type as the event name, its
+    other fields as JSON data.
+    """
+    data = {key: value for key, value in event.items() if key != "type"}
+    return f"event: {event['type']}\ndata: {json.dumps(data)}\n\n"
+
+
+def format_ndjson(event):
+    """
+    Returns an event as a line of JSON.
+    """
+    return json.dumps(event) + "\n"
+
+
+class EventStreamRenderer(BaseRenderer):
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+    stream_formatter = staticmethod(format_sse)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return self.stream_formatter({"type": "error", "errors": data}).encode(self.charset)
+
+
+class NDJSONRenderer(EventStreamRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    stream_formatter = staticmethod(format_ndjson)
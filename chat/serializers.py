@@ -1,7 +1,14 @@
 from rest_framework import serializers
 
+from ai.services.engines import DEFAULT_ENGINE, is_engine
+
 class AsyncSearchSerializer(serializers.Serializer):
     callback_url = serializers.CharField(required=True)
     query = serializers.CharField(required=True)
-    engine = serializers.CharField(default="gpt-3.5-turbo")
+    engine = serializers.CharField(default=DEFAULT_ENGINE)
     category_slug = serializers.CharField(required=True)
+
+    def validate_engine(self, value):
+        if not is_engine(value):
+            raise serializers.ValidationError(f"Unknown engine: {value}")
+        return value
@@ -0,0 +1,391 @@
+"""
+This module provides the streaming of the answers to the browser: the tokens
+are published to the channel layer group of the search session, which the
+websocket of the session joined, whatever the process running the search.
+
+The tokens are coalesced into frames sent every STREAMING_FLUSH_INTERVAL_MS
+milliseconds or STREAMING_FLUSH_CHARS characters, instead of one channel layer
+message and one websocket frame per token.
+
+The searches of the API stream their events through an in-process queue (see
+start_search).
+
+The searches run by the Celery workers stream with SyncStreamingCallbackHandler
+and publish their final result to the session group with send_end.
+
+A session has at most one generation in flight: starting a generation
+supersedes the previous one of the session, which is aborted on its next token,
+as is the generation of a session whose websocket disconnected.
+"""
+import asyncio
+import logging
+import queue
+import re
+import threading
+import time
+import uuid
+from typing import Any, Union
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.schema import LLMResult
+
+from ai.services.aio import TokenCoalescer, get_executor, run_in_executor
+from ai.services.execution import GenerationCancelled
+from ai.services.search_service import search_documents
+from documents.models import Category
+
+logger = logging.getLogger("cassandre")
+
+GENERATION_CACHE_ALIAS = "shared"
+GENERATION_TTL = 3600
+# The session ids of the websocket route (\w+), short enough for a group name
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_]{1,64}")
+
+
+def clean_session_id(session_id):
+    """
+    Returns the session id sent with a search, None if it cannot name the channel
+    layer group of a session: the search is then answered without streaming.
+    """
+    if session_id and SESSION_ID_PATTERN.fullmatch(session_id):
+        return session_id
+    if session_id:
+        logger.warning("Invalid search session id: %r", session_id[:100])
+    return None
+
+
+def session_group(session_id):
+    """
+    Returns the channel layer group of a search session.
+    """
+    return f"chat_{session_id}"
+
+
+def generation_key(session_id):
+    """
+    Returns the cache key of the generation in flight of a session.
+    """
+    return f"chat_generation_{session_id}"
+
+
+def start_generation(session_id):
+    """
+    Registers a new generation of the session, superseding the one in flight.
+
+    Returns:
+        str: The id of the generation.
+    """
+    generation_id = uuid.uuid4().hex
+    caches[GENERATION_CACHE_ALIAS].set(
+        generation_key(session_id), generation_id, GENERATION_TTL
+    )
+    return generation_id
+
+
+def cancel_generation(session_id):
+    """
+    Cancels the generation in flight of the session, if any.
+    """
+    caches[GENERATION_CACHE_ALIAS].delete(generation_key(session_id))
+
+
+def is_current_generation(session_id, generation_id):
+    """
+    Returns True if the generation is still the one in flight of the session.
+    """
+    return caches[GENERATION_CACHE_ALIAS].get(generation_key(session_id)) == generation_id
+
+
+async def astart_generation(session_id):
+    """
+    Async version of start_generation.
+    """
+    return await run_in_executor(None, start_generation, session_id)
+
+
+async def acancel_generation(session_id):
+    """
+    Async version of cancel_generation.
+    """
+    await run_in_executor(None, cancel_generation, session_id)
+
+
+class StreamingCallbackHandler(AsyncCallbackHandler):
+    """
+    Callback handler streaming the tokens of the answer to the websocket of the
+    session. Only works with LLMs that support streaming.
+
+    When a generation id is given, the handler checks at most once per flush
+    interval that the generation is still the one in flight of the session, and
+    aborts it with GenerationCancelled otherwise.
+    """
+
+    raise_error = True
+
+    def __init__(self, session_id, *args, generation_id=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session_id = session_id
+        self.generation_id = generation_id
+        self.channel_layer = get_channel_layer()
+        self.interval = settings.STREAMING_FLUSH_INTERVAL_MS / 1000
+        self.checked_at = time.monotonic()
+        self.coalescer = TokenCoalescer(
+            self.send_token, self.interval, settings.STREAMING_FLUSH_CHARS
+        )
+
+    async def send_token(self, token):
+        """
+        Sends a text to the websocket of the session, in the format of a token.
+        """
+        if not self.session_id or self.channel_layer is None:
+            return
+        await self.channel_layer.group_send(
+            session_group(self.session_id),
+            {
+                "type": "send.token",
+                "token": token,
+            },
+        )
+
+    async def check_cancelled(self):
+        """
+        Raises GenerationCancelled if the generation was superseded or cancelled.
+        """
+        if self.generation_id is None or not self.session_id:
+            return
+        now = time.monotonic()
+        if now - self.checked_at < self.interval:
+            return
+        self.checked_at = now
+        current = await run_in_executor(
+            None, is_current_generation, self.session_id, self.generation_id
+        )
+        if not current:
+            raise GenerationCancelled(self.generation_id)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        await self.check_cancelled()
+        await self.coalescer.add(token)
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        """Run when LLM ends running."""
+        await self.coalescer.flush()
+
+    async def on_llm_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        """Run when LLM errors."""
+        if isinstance(error, GenerationCancelled):
+            # The session moved on, its websocket must not receive these tokens
+            self.coalescer.discard()
+        else:
+            await self.coalescer.flush()
+
+
+class SyncStreamingCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler streaming the tokens of a search run synchronously (in a
+    Celery worker) to the websocket of the session. The tokens are coalesced in
+    the same way, the buffer being flushed on the token which exceeds the
+    interval or the size.
+    """
+
+    raise_error = True
+
+    def __init__(self, session_id, *args, generation_id=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session_id = session_id
+        self.generation_id = generation_id
+        self.channel_layer = get_channel_layer()
+        self.interval = settings.STREAMING_FLUSH_INTERVAL_MS / 1000
+        self.max_chars = settings.STREAMING_FLUSH_CHARS
+        self.buffer = []
+        self.size = 0
+        self.flushed_at = self.checked_at = time.monotonic()
+
+    def flush(self):
+        """
+        Sends the buffered text to the websocket of the session, if any.
+        """
+        self.flushed_at = time.monotonic()
+        if not self.buffer:
+            return
+        text = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if self.session_id and self.channel_layer is not None:
+            async_to_sync(self.channel_layer.group_send)(
+                session_group(self.session_id), {"type": "send.token", "token": text}
+            )
+
+    def check_cancelled(self):
+        """
+        Raises GenerationCancelled if the generation was superseded or cancelled.
+        """
+        if self.generation_id is None or not self.session_id:
+            return
+        now = time.monotonic()
+        if now - self.checked_at < self.interval:
+            return
+        self.checked_at = now
+        if not is_current_generation(self.session_id, self.generation_id):
+            raise GenerationCancelled(self.generation_id)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        self.check_cancelled()
+        self.buffer.append(token)
+        self.size += len(token)
+        if self.size >= self.max_chars or time.monotonic() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        """Run when LLM ends running."""
+        self.flush()
+
+    def on_llm_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        """Run when LLM errors."""
+        if isinstance(error, GenerationCancelled):
+            self.buffer = []
+            self.size = 0
+        else:
+            self.flush()
+
+
+def end_message(results, timings=None):
+    """
+    Returns the "end" message of a search, from its results.
+    """
+    message = {
+        "type": "end",
+        "result": results["result"],
+        "correction_id": results.get("correction_id"),
+        "sources": results.get("sources", []),
+    }
+    if results.get("fallback"):
+        message["fallback"] = True
+    if timings is not None:
+        message["timings"] = timings
+    return message
+
+
+def send_end(session_id, message):
+    """
+    Sends the end message of a search run out of the web process to the
+    websocket of the session.
+
+    Args:
+        session_id (str): The id of the session.
+        message (dict): The "end" or "error" message, with its type.
+    """
+    channel_layer = get_channel_layer()
+    if not session_id or channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(
+        session_group(session_id), {"type": "send.end", "message": message}
+    )
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler putting the tokens of the answer in a queue, and aborting
+    the generation once the reader of the queue has gone.
+    """
+
+    raise_error = True
+
+    def __init__(self, put, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.put = put
+        self.cancelled = threading.Event()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        if self.cancelled.is_set():
+            raise GenerationCancelled()
+        self.put({"type": "token", "token": token})
+
+
+def start_search(put, query, engine, category_slug):
+    """
+    Searches the answer of a query in a thread of the "streaming" pool, which
+    puts its events in a queue as they are produced: the tokens of the answer,
+    then an "end" event with the answer and its sources, or an "error" event,
+    then None.
+
+    Args:
+        put (callable): Puts an event in the queue, from the thread of the search.
+        query (str): The search query.
+        engine (str): The engine answering the query.
+        category_slug (str): The category of the documents to search.
+
+    Returns:
+        QueueCallbackHandler: The callback handler of the search, whose "cancelled"
+        event aborts the generation on its next token.
+    """
+    callback = QueueCallbackHandler(put)
+
+    def run():
+        try:
+            results = search_documents(query, engine, category_slug, callback=callback)
+            put(end_message(results))
+        except GenerationCancelled:
+            pass
+        except Category.DoesNotExist:
+            put({"type": "error", "errors": {"category": "Unknown category"}})
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Streamed search failed")
+            put({"type": "error", "errors": {"message": "The search failed"}})
+        finally:
+            put(None)
+            close_old_connections()
+
+    get_executor("streaming", settings.ENGINE_EXECUTOR_WORKERS).submit(run)
+    return callback
+
+
+def stream_search(query, engine, category_slug):
+    """
+    Yields the events of the search of a query (see start_search). Closing the
+    generator, when the client disconnects, aborts the generation.
+    """
+    events = queue.Queue()
+    callback = start_search(events.put, query, engine, category_slug)
+    try:
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            yield event
+    finally:
+        callback.cancelled.set()
+
+
+async def astream_search(query, engine, category_slug):
+    """
+    Async version of stream_search, for the streamed responses served by ASGI,
+    which would otherwise consume a synchronous iterator entirely before sending it.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def put(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    callback = start_search(put, query, engine, category_slug)
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                return
+            yield event
+    finally:
+        callback.cancelled.set()
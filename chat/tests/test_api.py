@@ -1,14 +1,23 @@
 # pylint: disable=missing-docstring
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
 
-from unittest.mock import patch
-
+from asgiref.sync import sync_to_async
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from chat.streaming import GenerationCancelled, astream_search, is_current_generation
 from documents.models import Category
 
 
+def fake_search(query, engine, category_slug, callback=None):
+    callback.on_llm_new_token("Le 15 ")
+    callback.on_llm_new_token("décembre.")
+    return {"result": "Le 15 décembre.", "sources": []}
+
+
 class ChatViewTest(APITestCase):
     def setUp(self):
         # Optionally set up a sample category if required
@@ -40,6 +49,64 @@ class ChatViewTest(APITestCase):
             payload["query"], payload["engine"], self.category.slug
         )
 
+    @patch("chat.streaming.search_documents", side_effect=fake_search)
+    def test_chat_api_event_stream(self, _):
+        response = self.client.post(
+            reverse("search_api", args=[self.category.slug]),
+            {"query": "Hello"},
+            format="json",
+            HTTP_ACCEPT="text/event-stream",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream; charset=utf-8")
+        self.assertEqual(
+            b"".join(response.streaming_content).decode(),
+            'event: token\ndata: {"token": "Le 15 "}\n\n'
+            'event: token\ndata: {"token": "d\\u00e9cembre."}\n\n'
+            'event: end\ndata: {"result": "Le 15 d\\u00e9cembre.", "correction_id": null, '
+            '"sources": []}\n\n',
+        )
+
+    @patch("chat.streaming.search_documents", side_effect=fake_search)
+    def test_chat_api_ndjson_stream(self, _):
+        response = self.client.post(
+            reverse("search_api", args=[self.category.slug]) + "?format=ndjson",
+            {"query": "Hello"},
+            format="json",
+        )
+
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [
+                {"type": "token", "token": "Le 15 "},
+                {"type": "token", "token": "décembre."},
+                {
+                    "type": "end",
+                    "result": "Le 15 décembre.",
+                    "correction_id": None,
+                    "sources": [],
+                },
+            ],
+        )
+
+    @patch("chat.streaming.search_documents", side_effect=fake_search)
+    async def test_async_event_stream(self, _):
+        events = [event async for event in astream_search("Hello", "gpt-4", "documents")]
+        self.assertEqual(events[0], {"type": "token", "token": "Le 15 "})
+        self.assertEqual(events[-1]["type"], "end")
+
+    def test_invalid_event_stream_call(self):
+        response = self.client.post(
+            reverse("search_api", args=[self.category.slug]) + "?format=sse",
+            {"query": ""},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(response.content.startswith(b"event: error\ndata: {\"errors\""))
+
     def test_invalid_chat_api_call(self):
         # You can add more tests, like what happens if data is invalid
         payload = {
@@ -56,6 +123,86 @@ class ChatViewTest(APITestCase):
         )  # Check that the error is about the 'query' field
 
 
+class SearchViewTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(
+            name="Example Category", slug="example-category"
+        )
+
+    @patch("chat.views.asearch_documents", new_callable=AsyncMock)
+    async def test_search(self, mock_search_documents):
+        mock_search_documents.return_value = {"result": "Réponse", "correction_id": 3}
+
+        response = await self.async_client.post(
+            reverse("search", args=[self.category.slug]),
+            {"query": "Hello", "engine": "gpt-3.5-turbo", "session_id": "abc"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {"result": "Réponse", "source_documents": [], "correction_id": 3},
+        )
+        args, kwargs = mock_search_documents.await_args
+        self.assertEqual(args, ("Hello", "gpt-3.5-turbo", self.category.slug))
+        self.assertEqual(kwargs["callback"].session_id, "abc")
+
+    @patch("chat.views.asearch_documents", new_callable=AsyncMock)
+    async def test_cancelled_search(self, mock_search_documents):
+        mock_search_documents.side_effect = GenerationCancelled()
+
+        response = await self.async_client.post(
+            reverse("search", args=[self.category.slug]),
+            {"query": "Hello", "session_id": "abc"},
+        )
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {"cancelled": True})
+        callback = mock_search_documents.await_args.kwargs["callback"]
+        self.assertTrue(await sync_to_async(is_current_generation)("abc", callback.generation_id))
+
+    @patch("chat.views.asearch_documents", new_callable=AsyncMock)
+    async def test_search_with_an_invalid_session_id(self, mock_search_documents):
+        mock_search_documents.return_value = {"result": "Réponse"}
+
+        for session_id in ["abc def", "a" * 100]:
+            response = await self.async_client.post(
+                reverse("search", args=[self.category.slug]),
+                {"query": "Hello", "session_id": session_id},
+            )
+
+            # The answer is not streamed
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["result"], "Réponse")
+            callback = mock_search_documents.await_args.kwargs["callback"]
+            self.assertIsNone(callback.session_id)
+            self.assertIsNone(callback.generation_id)
+
+    @override_settings(SEARCH_OFFLOAD_TO_CELERY=True)
+    @patch("chat.views.async_search.delay")
+    async def test_search_offloaded_to_celery(self, mock_delay):
+        mock_delay.return_value = MagicMock(id="task-1")
+
+        response = await self.async_client.post(
+            reverse("search", args=[self.category.slug]),
+            {"query": "Hello", "session_id": "abc"},
+        )
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"task_id": "task-1"})
+        kwargs = mock_delay.call_args.kwargs
+        self.assertEqual(kwargs["query"], "Hello")
+        self.assertEqual(kwargs["category_slug"], self.category.slug)
+        self.assertEqual(kwargs["session_id"], "abc")
+        self.assertTrue(
+            await sync_to_async(is_current_generation)("abc", kwargs["generation_id"])
+        )
+
+    async def test_search_form(self):
+        response = await self.async_client.get(reverse("search", args=[self.category.slug]))
+        self.assertEqual(response.status_code, 200)
+
+
 class AsyncSearchViewTest(APITestCase):
     def setUp(self):
         self.category = Category.objects.create(
@@ -96,3 +243,32 @@ class AsyncSearchViewTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn("callback_url", response.json())
+
+
+class SearchTaskViewTest(APITestCase):
+    @patch("chat.views.AsyncResult")
+    def test_task_result(self, mock_async_result):
+        mock_async_result.return_value.state = "SUCCESS"
+        mock_async_result.return_value.successful.return_value = True
+        mock_async_result.return_value.result = {"result": "Réponse", "sources": []}
+
+        response = self.client.get(reverse("search_task_api", args=["task-1"]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "task_id": "task-1",
+                "status": "SUCCESS",
+                "result": {"result": "Réponse", "sources": []},
+            },
+        )
+        mock_async_result.assert_called_once_with("task-1")
+
+    @patch("chat.views.AsyncResult")
+    def test_pending_task(self, mock_async_result):
+        mock_async_result.return_value.state = "PENDING"
+        mock_async_result.return_value.successful.return_value = False
+
+        response = self.client.get(reverse("search_task_api", args=["task-1"]))
+        self.assertEqual(response.json(), {"task_id": "task-1", "status": "PENDING"})
@@ -0,0 +1,207 @@
+# pylint: disable=missing-docstring
+import asyncio
+from unittest.mock import patch
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, override_settings
+from langchain.schema import LLMResult
+
+from chat.routing import websocket_urlpatterns
+from chat.streaming import (
+    GenerationCancelled,
+    StreamingCallbackHandler,
+    TokenCoalescer,
+    is_current_generation,
+    start_generation,
+)
+
+CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+class TokenCoalescerTest(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, text):
+        self.sent.append(text)
+
+    async def test_flush_on_size(self):
+        coalescer = TokenCoalescer(self.send, interval=60, max_chars=10)
+        for token in ("Le ", "15 ", "déc"):
+            await coalescer.add(token)
+        self.assertEqual(self.sent, [])
+        await coalescer.add("embre")
+        await coalescer.add(".")
+        self.assertEqual(self.sent, ["Le 15 décembre"])
+
+        await coalescer.flush()
+        await coalescer.flush()
+        self.assertEqual(self.sent, ["Le 15 décembre", "."])
+
+    async def test_flush_on_interval(self):
+        coalescer = TokenCoalescer(self.send, interval=0.01, max_chars=100)
+        await coalescer.add("Le ")
+        await coalescer.add("15")
+        self.assertEqual(self.sent, [])
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, ["Le 15"])
+        await coalescer.add(" décembre")
+        await coalescer.flush()
+        self.assertEqual(self.sent, ["Le 15", " décembre"])
+
+
+@override_settings(CHANNEL_LAYERS=CHANNEL_LAYERS)
+class StreamingTest(TestCase):
+    async def connect(self, session_id):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/chat/{session_id}/"
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_tokens_are_sent_to_the_session_group(self):
+        communicator = await self.connect("abc")
+        other = await self.connect("other")
+
+        # The handler of another process only knows the session id
+        handler = StreamingCallbackHandler("abc")
+        await handler.on_llm_new_token("Bon")
+        await handler.on_llm_new_token("jour")
+        await handler.on_llm_end(LLMResult(generations=[]))
+
+        self.assertEqual(await communicator.receive_json_from(), {"token": "Bonjour"})
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertTrue(await other.receive_nothing())
+
+        await communicator.disconnect()
+        await other.disconnect()
+
+    @override_settings(STREAMING_FLUSH_INTERVAL_MS=0)
+    async def test_superseded_generation_is_aborted(self):
+        communicator = await self.connect("abc")
+        generation_id = start_generation("abc")
+        handler = StreamingCallbackHandler("abc", generation_id=generation_id)
+        await handler.on_llm_new_token("Bon")
+
+        start_generation("abc")
+        with self.assertRaises(GenerationCancelled) as context:
+            await handler.on_llm_new_token("jour")
+        await handler.on_llm_error(context.exception)
+
+        self.assertEqual(await communicator.receive_json_from(), {"token": "Bon"})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_disconnect_leaves_the_group(self):
+        communicator = await self.connect("abc")
+        await communicator.disconnect()
+
+        channel_layer = get_channel_layer()
+        self.assertEqual(channel_layer.groups.get("chat_abc", {}), {})
+        await StreamingCallbackHandler("abc").on_llm_new_token("Bon")
+
+
+async def fake_search(query, engine, category_slug, callback=None):
+    await callback.on_llm_new_token("Le 15 ")
+    await callback.on_llm_new_token("décembre.")
+    await callback.on_llm_end(LLMResult(generations=[]))
+    return {"result": "Le 15 décembre.", "sources": [{"origin": "guide.pdf", "page": 3}]}
+
+
+@override_settings(CHANNEL_LAYERS=CHANNEL_LAYERS)
+class ChatConsumerTest(TestCase):
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/abc/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @patch("chat.consumers.asearch_documents", side_effect=fake_search)
+    async def test_query_is_answered_on_the_socket(self, mock_search):
+        communicator = await self.connect()
+        await communicator.send_json_to(
+            {"type": "query", "query": "Date limite ?", "category": "mutations"}
+        )
+
+        self.assertEqual(await communicator.receive_json_from(), {"token": "Le 15 décembre."})
+        end = await communicator.receive_json_from()
+        self.assertEqual(end["type"], "end")
+        self.assertEqual(end["result"], "Le 15 décembre.")
+        self.assertIsNone(end["correction_id"])
+        self.assertEqual(end["sources"], [{"origin": "guide.pdf", "page": 3}])
+        self.assertIn("first_token_ms", end["timings"])
+        self.assertIn("total_ms", end["timings"])
+        self.assertEqual(
+            mock_search.call_args.args, ("Date limite ?", "gpt-3.5-turbo", "mutations")
+        )
+        await communicator.disconnect()
+
+    async def test_invalid_query(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "query", "query": ""})
+
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["type"], "error")
+        self.assertIn("query", message["errors"])
+        await communicator.disconnect()
+
+    async def test_unknown_category(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "query", "query": "Date ?", "category": "none"})
+
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {"type": "error", "errors": {"category": "Unknown category"}})
+        await communicator.disconnect()
+
+    @patch("chat.consumers.asearch_documents")
+    async def test_new_query_cancels_the_one_in_flight(self, mock_search):
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def slow_search(query, engine, category_slug, callback=None):
+            if query == "Première ?":
+                started.set()
+                try:
+                    await asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+            return await fake_search(query, engine, category_slug, callback)
+
+        mock_search.side_effect = slow_search
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "query", "query": "Première ?"})
+        await started.wait()
+        await communicator.send_json_to({"type": "query", "query": "Seconde ?"})
+
+        self.assertEqual(await communicator.receive_json_from(), {"token": "Le 15 décembre."})
+        self.assertEqual((await communicator.receive_json_from())["type"], "end")
+        self.assertTrue(cancelled.is_set())
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    @patch("chat.consumers.asearch_documents")
+    async def test_disconnect_cancels_the_search(self, mock_search):
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def slow_search(query, engine, category_slug, callback=None):
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        mock_search.side_effect = slow_search
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "query", "query": "Date ?"})
+        await started.wait()
+        await communicator.disconnect()
+
+        self.assertTrue(cancelled.is_set())
+        self.assertTrue(is_current_generation("abc", None))
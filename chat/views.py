@@ -1,102 +1,55 @@
 # chat/views.py
-from typing import Any, Dict, List, Union
+from functools import partial
 
-from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.schema import AgentAction, AgentFinish, LLMResult
+from celery.result import AsyncResult
 from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from ai.services.search_service import DocumentSearch, search_documents
-from documents.models import Category, Correction
+from ai.services.aio import run_in_executor
+from ai.services.search_service import (
+    asearch_documents,
+    get_document_search,
+    search_documents,
+)
+from documents.models import Category
 
 from .forms import DebugForm, DebugVectorForm, SearchForm
-from .global_registry import websockets
+from .renderers import EventStreamRenderer, NDJSONRenderer
 from .serializers import AsyncSearchSerializer
+from .streaming import (
+    GenerationCancelled,
+    StreamingCallbackHandler,
+    astart_generation,
+    astream_search,
+    clean_session_id,
+    stream_search,
+)
 from ai.tasks import async_search
 
-class StreamingCallbackHandler(BaseCallbackHandler):
-    """Callback handler for streaming. Only works with LLMs that support streaming."""
-
-    def __init__(self, session_id, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.session_id = session_id
-
-    def on_chat_model_start(self, *args, **kwargs):
-        """Run when chat model starts running."""
-
-    def on_llm_start(
-        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
-    ) -> None:
-        """Run when LLM starts running."""
-
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        """Run on new LLM token. Only available when streaming is enabled."""
-        consumer = websockets.get(self.session_id)
-        if consumer:
-            async_to_sync(consumer.channel_layer.send)(
-                consumer.channel_name,
-                {
-                    "type": "send.token",
-                    "token": token,
-                },
-            )
-
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        """Run when LLM ends running."""
-
-    def on_llm_error(
-        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
-    ) -> None:
-        """Run when LLM errors."""
-
-    def on_chain_start(
-        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
-    ) -> None:
-        """Run when chain starts running."""
-
-    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
-        """Run when chain ends running."""
-
-    def on_chain_error(
-        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
-    ) -> None:
-        """Run when chain errors."""
-
-    def on_tool_start(
-        self, serialized: Dict[str, Any], input_str: str, **kwargs: Any
-    ) -> None:
-        """Run when tool starts running."""
-
-    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
-        """Run on agent action."""
-
-    def on_tool_end(self, output: str, **kwargs: Any) -> None:
-        """Run when tool ends running."""
-
-    def on_tool_error(
-        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
-    ) -> None:
-        """Run when tool errors."""
-
-    def on_text(self, text: str, **kwargs: Any) -> None:
-        """Run on arbitrary text."""
-
-    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
-        """Run on agent end."""
 
-
-def search(request, category_slug="documents"):
+async def search(request, category_slug="documents"):
     """
     This function handles the search request.
     It takes in a request and a category_slug as parameters.
 
+    The view is async: under ASGI, the search is awaited on the event loop of
+    the server instead of holding a thread for the whole generation. With
+    SEARCH_OFFLOAD_TO_CELERY, the search is queued on the "interactive" queue
+    instead and the view answers at once with the id of the task (202 status):
+    the answer is streamed to the websocket of the session and can be fetched
+    from the search_task_api endpoint.
+
     If the request method is POST, it processes the search query
-    and returns the search results in a JsonResponse.
+    and returns the search results in a JsonResponse, or a 409 status when
+    the generation was cancelled by a new question or the disconnection of
+    the session.
     If the request method is not POST, it renders the search form.
 
     Parameters:
@@ -108,32 +61,49 @@ def search(request, category_slug="documents"):
     HttpResponse: The search form if the request method is not POST.
     """
     if request.method == "POST":
-        session_id = request.POST.get("session_id")
-        callback = StreamingCallbackHandler(session_id)
+        session_id = clean_session_id(request.POST.get("session_id"))
         form = SearchForm(request.POST)
         if form.is_valid():
             query = form.cleaned_data["query"]
-            engine = (
-                form.cleaned_data["engine"] or "gpt-3.5-turbo"
-            )  # Set the engine value to "gpt-3.5-turbo" if it is null
-            results = search_documents(
-                query, engine, category_slug, prompt=None, k=None, callback=callback
-            )
-
-            category = Category.objects.get(slug=category_slug)
-            correction = Correction.objects.filter(
-                category_id=category.id, query=query
-            ).first()
-            correction_id = correction.id if correction is not None else None
+            engine = form.cleaned_data["engine"]
+            # A new question of the session cancels the one in flight
+            generation_id = await astart_generation(session_id) if session_id else None
+            if settings.SEARCH_OFFLOAD_TO_CELERY:
+                task = await run_in_executor(
+                    None,
+                    partial(
+                        async_search.delay,
+                        callback_url=None,
+                        query=query,
+                        category_slug=category_slug,
+                        engine=engine,
+                        session_id=session_id,
+                        generation_id=generation_id,
+                    ),
+                )
+                return JsonResponse({"task_id": task.id}, status=202)
+
+            callback = StreamingCallbackHandler(session_id, generation_id=generation_id)
+            try:
+                results = await asearch_documents(
+                    query, engine, category_slug, prompt=None, k=None, callback=callback
+                )
+            except GenerationCancelled:
+                return JsonResponse({"cancelled": True}, status=409)
+
+            correction_id = results.get("correction_id")
             response = {"result": results["result"], "source_documents": []}
             if correction_id is not None:
                 response["correction_id"] = correction_id
+            if results.get("fallback"):
+                response["fallback"] = True
             return JsonResponse(response)
     else:
         form = SearchForm()
 
-    category = Category.objects.get(slug=category_slug)
-    return render(
+    category = await Category.objects.aget(slug=category_slug)
+    # The context processors may query the database (request.user)
+    return await sync_to_async(render)(
         request,
         "chat/search.html",
         {"form": form, "category": category, "websocket_host": settings.WEBSOCKET_URL},
@@ -168,7 +138,9 @@ def debug(request):
             prompt = form.cleaned_data["prompt"]
             k = form.cleaned_data["k"]
             query = form.cleaned_data["query"]
-            results = search_documents(query, engine, category_slug, prompt, k)
+            results = search_documents(
+                query, engine, category_slug, prompt, k, use_corrections=False
+            )
 
     return render(request, "chat/debug.html", {"form": form, "results": results})
 
@@ -202,7 +174,7 @@ def debug_vector(request):
             query = form.cleaned_data["query"]
 
             category = Category.objects.get(id=category_id)
-            document_search = DocumentSearch(category=category)
+            document_search = get_document_search(category)
             documents = document_search.get_relevant_documents(query, k=k)
 
     return render(
@@ -210,12 +182,35 @@ def debug_vector(request):
     )
 
 
+def stream_events(request, renderer, query, engine, category_slug):
+    """
+    Returns the formatted events of a streamed search, as an async iterator when
+    served by ASGI.
+    """
+    if isinstance(request._request, ASGIRequest):  # pylint: disable=protected-access
+
+        async def aformat():
+            async for event in astream_search(query, engine, category_slug):
+                yield renderer.stream_formatter(event)
+
+        return aformat()
+    return (
+        renderer.stream_formatter(event)
+        for event in stream_search(query, engine, category_slug)
+    )
+
+
 class SearchAPIView(APIView):
     """
     This class-based view handles the search API request.
     It takes in a request and a category_slug as parameters.
     If the request method is POST, it processes the search query
     and returns the search results in a JsonResponse.
+
+    The answer is streamed when the client accepts "text/event-stream" (Server-Sent
+    Events) or "application/x-ndjson" (one JSON object per line), or asks for it
+    with ?format=sse or ?format=ndjson: "token" events as the answer is generated,
+    then an "end" event with the answer, the correction id and the sources.
     If the request method is not POST, it returns the form errors with a 400 status.
 
     Parameters:
@@ -227,6 +222,12 @@ class SearchAPIView(APIView):
     Response: The form errors with a 400 status if the request method is not POST.
     """
 
+    renderer_classes = [
+        *api_settings.DEFAULT_RENDERER_CLASSES,
+        EventStreamRenderer,
+        NDJSONRenderer,
+    ]
+
     def post(self, request, category_slug="documents"):
         """
         Handles the POST request for the search API.
@@ -242,10 +243,25 @@ class SearchAPIView(APIView):
         form = SearchForm(request.data)
         if form.is_valid():
             query = form.cleaned_data["query"]
-            engine = form.cleaned_data["engine"] or "gpt-3.5-turbo"
+            engine = form.cleaned_data["engine"]
+
+            renderer = request.accepted_renderer
+            if isinstance(renderer, EventStreamRenderer):
+                response = StreamingHttpResponse(
+                    stream_events(request, renderer, query, engine, category_slug),
+                    content_type=f"{renderer.media_type}; charset={renderer.charset}",
+                )
+                response["Cache-Control"] = "no-cache"
+                # Disables the buffering of the nginx reverse proxy
+                response["X-Accel-Buffering"] = "no"
+                return response
+
             results = search_documents(query, engine, category_slug)
 
-            return Response({"result": results["result"], "source_documents": []})
+            response = {"result": results["result"], "source_documents": []}
+            if results.get("fallback"):
+                response["fallback"] = True
+            return Response(response)
 
         return Response(form.errors, status=400)
 
@@ -290,3 +306,28 @@ class AsyncSearchView(APIView):
             return Response(status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class SearchTaskView(APIView):
+    """
+    API endpoint returning the state of a search queued on Celery, and its
+    results once it is done.
+    """
+
+    def get(self, request, task_id):
+        """
+        Handle a GET request for the results of a search task.
+
+        Args:
+            request (Request): DRF request object.
+            task_id (str): The id of the task, as returned by the search view.
+
+        Returns:
+            Response: The state of the task in "status", and its "result" when it
+            succeeded.
+        """
+        result = AsyncResult(task_id)
+        response = {"task_id": task_id, "status": result.state}
+        if result.successful():
+            response["result"] = result.result
+        return Response(response, status=status.HTTP_200_OK)
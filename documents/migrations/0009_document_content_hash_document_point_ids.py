@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_document_hints_alter_correction_query_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='point_ids',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
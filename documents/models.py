@@ -62,6 +62,10 @@ class Document(models.Model):
         null=True,
         help_text="Hints to augment the context for the document.",
     )
+    # Hash of the indexed content (file, title and hints) and ids of its points in
+    # the vector database, to reindex only the documents which changed
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+    point_ids = models.JSONField(default=list, blank=True, editable=False)
 
     def __str__(self):
         return str(self.title) or str(self.file)
@@ -93,10 +97,17 @@ class Correction(models.Model):
             ),
         ]
 
+    @staticmethod
+    def hash_query(query):
+        """
+        Returns the value of query_hash for the given query.
+        """
+        return hashlib.sha1(query.encode()).hexdigest()
+
     def save(self, *args, **kwargs):
         # Update the query_hash field whenever the object is saved
         # pylint: disable=no-member
-        self.query_hash = hashlib.sha1(self.query.encode()).hexdigest()
+        self.query_hash = self.hash_query(self.query)
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -18,14 +18,16 @@ def correct(request, category_id):
             if form.cleaned_data.get('mark_as_deleted'):
                 # The 'mark as deleted' box was checked
                 correction = Correction.objects.get(
-                    category=category, query=form.cleaned_data["query"]
+                    category=category,
+                    query_hash=Correction.hash_query(form.cleaned_data["query"]),
                 )
                 correction.delete()
             else:
                 try:
                     # Try to get an existing correction
                     correction = Correction.objects.get(
-                        category=category, query=form.cleaned_data["query"]
+                        category=category,
+                        query_hash=Correction.hash_query(form.cleaned_data["query"]),
                     )
                     # Update existing correction
                     correction.query = form.cleaned_data["query"]